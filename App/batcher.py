@@ -0,0 +1,190 @@
+import asyncio
+import queue
+import threading
+import time
+from typing import Awaitable, Callable, List
+
+
+class DynamicBatcher:
+    """
+    Collects individual requests into batches so that the model is called once per batch rather than once per request.
+    A batch is flushed when it reaches max_batch_size, or when the oldest request in it has waited max_wait_ms. Runs
+    handler in its own thread. The predictor batches with AsyncDynamicBatcher, this class is kept as the public API
+    for batching from synchronous code.
+    """
+
+    def __init__(self, handler: Callable[[List], None], max_batch_size: int = 32, max_wait_ms: float = 5.,
+                 max_queue_size: int = 1024):
+        """
+        :param handler: Function called with each flushed batch (list of submitted items)
+        :param max_batch_size: Maximum number of items passed to handler at once
+        :param max_wait_ms: Maximum time (milliseconds) the first item of a batch waits before the batch is flushed
+        :param max_queue_size: Maximum number of pending items, submit blocks once this is reached (0 = unbounded)
+        """
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be at least 1, got {max_batch_size}")
+
+        if max_wait_ms < 0:
+            raise ValueError(f"max_wait_ms must be positive, got {max_wait_ms}")
+
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def submit(self, item, timeout: float = None) -> None:
+        """
+        Add item to the pending queue, blocking while the queue is full so that consumers are slowed down
+        :param item: Request to be batched
+        :param timeout: Maximum time to block (seconds), None = block indefinitely
+        :return: None
+        """
+        self._queue.put(item, timeout=timeout)
+
+    def next_batch(self, poll_interval: float = 0.1) -> List:
+        """
+        Wait for the first item, then collect further items until the batch is full or the wait time has elapsed
+        :param poll_interval: Time (seconds) to wait for a first item before returning an empty batch
+        :return: List of items, empty if nothing arrived within poll_interval
+        """
+        try:
+            batch = [self._queue.get(timeout=poll_interval)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # Deadline passed, only take items that are already waiting
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def run(self) -> None:
+        """
+        Flush batches to handler until stopped, draining any remaining items before returning
+        :return: None
+        """
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = self.next_batch()
+            if not batch:
+                continue
+
+            try:
+                self.handler(batch)
+            except Exception as e:
+                # A failing batch should not take down the serving thread
+                print(f"Batch of {len(batch)} failed: {e!r}")
+
+    def start(self) -> threading.Thread:
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="DynamicBatcher", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: float = None) -> None:
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class AsyncDynamicBatcher:
+    """
+    Asyncio counterpart of DynamicBatcher. Requests from any number of producers share one bounded queue, drained by a
+    single worker that passes each batch to an async handler. Must be created inside a running event loop.
+    """
+
+    def __init__(self, handler: Callable[[List], Awaitable[None]], max_batch_size: int = 32, max_wait_ms: float = 5.,
+                 max_queue_size: int = 1024, on_queue_wait: Callable[[float], None] = None):
+        """
+        :param handler: Coroutine function awaited with each flushed batch (list of submitted items)
+        :param max_batch_size: Maximum number of items passed to handler at once
+        :param max_wait_ms: Maximum time (milliseconds) the first item of a batch waits before the batch is flushed
+        :param max_queue_size: Maximum number of pending items, submit waits once this is reached (0 = unbounded)
+        :param on_queue_wait: Called with the time (seconds) each item waited, from submit until its batch was flushed
+        """
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be at least 1, got {max_batch_size}")
+
+        if max_wait_ms < 0:
+            raise ValueError(f"max_wait_ms must be positive, got {max_wait_ms}")
+
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.on_queue_wait = on_queue_wait
+        self._loop = asyncio.get_running_loop()
+        # Items are queued with the time they were submitted
+        self._queue = asyncio.Queue(maxsize=max_queue_size)
+
+    async def submit(self, item) -> None:
+        """
+        Add item to the pending queue, waiting while the queue is full
+        :param item: Request to be batched
+        :return: None
+        """
+        await self._queue.put((self._loop.time(), item))
+
+    def submit_threadsafe(self, item) -> None:
+        """
+        Add item from a thread outside the event loop, blocking the calling thread while the queue is full. Used by
+        blocking broker consumers so that a full queue stops them pulling further messages
+        :param item: Request to be batched
+        :return: None
+        """
+        asyncio.run_coroutine_threadsafe(self.submit(item), self._loop).result()
+
+    async def next_batch(self) -> List:
+        """
+        Wait for the first item, then collect further items until the batch is full or the wait time has elapsed
+        :return: List of items
+        """
+        batch = [await self._queue.get()]
+
+        deadline = self._loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - self._loop.time()
+            try:
+                if remaining > 0:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+
+        if self.on_queue_wait is not None:
+            now = self._loop.time()
+            for submitted, _ in batch:
+                self.on_queue_wait(now - submitted)
+
+        return [item for _, item in batch]
+
+    async def run(self) -> None:
+        """
+        Flush batches to handler until cancelled
+        :return: None
+        """
+        while True:
+            batch = await self.next_batch()
+            try:
+                await self.handler(batch)
+            except Exception as e:
+                print(f"Batch of {len(batch)} failed: {e!r}")
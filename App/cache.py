@@ -0,0 +1,191 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class SqliteCacheBackend:
+    """
+    On-disk store shared by predictor replicas on the same host. Keys already include the model identity, so entries
+    from other models never match and are removed as they expire.
+    """
+
+    def __init__(self, path, dtype=np.float32):
+        """
+        :param path: Path to sqlite database file, created if it does not exist
+        :param dtype: dtype of the cached arrays
+        """
+        self.dtype = np.dtype(dtype)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, timeout=5)
+        # Write ahead logging allows readers in other processes while one replica writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions (key BLOB PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)"
+        )
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM predictions WHERE key = ? AND expires > ?", (key, time.time())
+            ).fetchone()
+
+        return None if row is None else np.frombuffer(row[0], dtype=self.dtype)
+
+    def put(self, key: bytes, value: np.ndarray, ttl: float) -> None:
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO predictions (key, value, expires) VALUES (?, ?, ?)",
+                (key, np.ascontiguousarray(value, dtype=self.dtype).tobytes(), time.time() + ttl),
+            )
+
+    def prune(self) -> int:
+        """
+        Remove expired entries
+        :return: Number of entries removed
+        """
+        with self._lock:
+            return self._conn.execute("DELETE FROM predictions WHERE expires <= ?", (time.time(),)).rowcount
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+class PredictionCache:
+    """
+    In-process LRU cache of predictions, keyed by a hash of the raw image bytes and the identity of the model that made
+    them. Entries expire after ttl seconds, and least recently used entries are evicted once max_bytes is exceeded.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 2 ** 20, ttl: float = 300., model_id: str = "",
+                 backend: SqliteCacheBackend = None):
+        """
+        :param max_bytes: Maximum size (bytes) of cached keys and values held in memory
+        :param ttl: Time (seconds) an entry remains valid
+        :param model_id: Identity of the model predictions are cached for
+        :param backend: Optional shared store consulted on in-memory misses
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.model_id = model_id
+        self.backend = backend
+
+        self._entries: "OrderedDict[bytes, Tuple[np.ndarray, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def key(self, image: np.ndarray) -> bytes:
+        """
+        :param image: Raw image array
+        :return: Digest of the model identity and image bytes
+        """
+        digest = hashlib.blake2b(self.model_id.encode("utf-8"), digest_size=16)
+        digest.update(np.ascontiguousarray(image).data)
+        return digest.digest()
+
+    def set_model(self, model_id: str) -> None:
+        """
+        Set the identity of the model in use, clearing cached predictions if it has changed
+        :param model_id: Identity of the model
+        :return: None
+        """
+        if model_id != self.model_id:
+            self.clear()
+            self.model_id = model_id
+
+    def get(self, key: bytes) -> Optional[np.ndarray]:
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                self._remove(key)
+                self.expirations += 1
+
+        value = self.backend.get(key) if self.backend is not None else None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._insert(key, value)
+
+        return value
+
+    def put(self, key: bytes, value: np.ndarray) -> None:
+
+        # Copying so that cached values do not hold on to (or change with) the batch they came from
+        value = np.array(value)
+        with self._lock:
+            self._insert(key, value)
+
+        if self.backend is not None:
+            self.backend.put(key, value, self.ttl)
+
+    def lookup(self, images: np.ndarray) -> Tuple[List[bytes], List[Optional[np.ndarray]]]:
+        """
+        Look up a batch of images
+        :param images: Array of images, first dimension is the batch
+        :return: Key of each image, and its cached prediction or None on a miss
+        """
+        keys = [self.key(image) for image in images]
+        return keys, [self.get(key) for key in keys]
+
+    def predict(self, images: np.ndarray, infer: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+        """
+        Predict a batch, only passing images without a cached prediction to infer
+        :param images: Array of images, first dimension is the batch
+        :param infer: Function predicting a batch of images
+        :return: Predictions, one row per image
+        """
+        keys, values = self.lookup(images)
+        missing = [i for i, value in enumerate(values) if value is None]
+
+        if missing:
+            for i, value in zip(missing, infer(images[missing])):
+                self.put(keys[i], value)
+                values[i] = value
+
+        return np.stack(values)
+
+    def clear(self) -> None:
+
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'expirations': self.expirations, 'entries': len(self._entries), 'bytes': self.nbytes}
+
+    def _insert(self, key: bytes, value: np.ndarray) -> None:
+
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self.nbytes += len(key) + value.nbytes
+
+        while self.nbytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: bytes) -> None:
+
+        value, _ = self._entries.pop(key)
+        self.nbytes -= len(key) + value.nbytes
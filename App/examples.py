@@ -0,0 +1,67 @@
+import gzip
+import pathlib
+import shutil
+import urllib.request
+import numpy as np
+from App.settings import EXAMPLE_DATA_URL, EXAMPLE_DATA_DIR
+
+# Offset of the first image/label in IDX files, after the magic number and dimensions
+IDX_OFFSETS = {'images': 16, 'labels': 8}
+
+
+def download(file_name: str, data_dir: pathlib.Path = EXAMPLE_DATA_DIR, url: str = EXAMPLE_DATA_URL) -> pathlib.Path:
+    """
+    :param file_name: File within url
+    :param data_dir: Directory files are cached in
+    :param url: Base url of files
+    :return: Path to cached file, downloaded if not already cached
+    """
+    path = pathlib.Path(data_dir, file_name)
+    if not path.exists():
+        data_dir.mkdir(parents=True, exist_ok=True)
+        print(f"Downloading {url + file_name}")
+        # Written under a temporary name, so that an interrupted download is not mistaken for a cached file
+        with urllib.request.urlopen(url + file_name) as response, open(path.with_suffix(".part"), "wb") as f:
+            shutil.copyfileobj(response, f)
+        path.with_suffix(".part").replace(path)
+
+    return path
+
+
+def read_idx(path: pathlib.Path, kind: str) -> np.ndarray:
+    """
+    :param path: Gzipped IDX file
+    :param kind: Either images or labels
+    :return: uint8 images of shape (n, 28, 28), or labels of shape (n,)
+    """
+    with gzip.open(path, "rb") as f:
+        data = np.frombuffer(f.read(), np.uint8, offset=IDX_OFFSETS[kind])
+
+    return data.reshape(-1, 28, 28) if kind == "images" else data
+
+
+def cache_array(path: pathlib.Path, kind: str) -> pathlib.Path:
+    """
+    :param path: Gzipped IDX file
+    :param kind: Either images or labels
+    :return: Path to an uncompressed .npy copy of the file, written on first use so that it can be memory-mapped
+    """
+    npy_path = path.with_name(path.name.split(".")[0] + ".npy")
+    if not npy_path.exists():
+        with open(npy_path.with_suffix(".part"), "wb") as f:
+            np.save(f, read_idx(path, kind))
+        npy_path.with_suffix(".part").replace(npy_path)
+
+    return npy_path
+
+
+def load_test_images(num_images: int = None, data_dir: pathlib.Path = EXAMPLE_DATA_DIR) -> np.ndarray:
+    """
+    Fashion MNIST test images, loaded without TensorFlow so that the client starts quickly. Reads the same files as
+    tf.keras.datasets.fashion_mnist.load_data. Images are memory-mapped, so are only read from disk as they are used
+    :param num_images: Number of images returned from the start of the test set, all if None
+    :param data_dir: Directory files are cached in
+    :return: uint8 images of shape (num_images, 28, 28)
+    """
+    path = cache_array(download("t10k-images-idx3-ubyte.gz", data_dir), "images")
+    return np.load(path, mmap_mode="r")[:num_images]
@@ -0,0 +1,217 @@
+import asyncio
+import json
+import pathlib
+import time
+import numpy as np
+from typing import Dict, Iterator, List, Tuple
+
+# Keys of a replayed request passed on to the model server, other keys of a traffic file line are ignored
+REQUEST_OPTIONS = ("threshold", "top_k", "compact")
+
+# Request sent at an offset (seconds) from the start of a run, with the index of its test image and any options
+ScheduledRequest = Tuple[float, int, Dict]
+
+
+def arrival_schedule(num_requests: int, rate: float, arrivals: str = "constant",
+                     seed: int = None) -> Iterator[ScheduledRequest]:
+    """
+    Open loop schedule: requests are sent at these times whether or not earlier requests have been answered
+    :param num_requests: Number of requests
+    :param rate: Mean requests per second, 0 = all at once
+    :param arrivals: constant spacing, or poisson (exponential gaps between requests, as from many independent users)
+    :param seed: Random seed of poisson arrivals
+    :return: Generator of scheduled requests, sending test images in order
+    """
+    if arrivals not in ("constant", "poisson"):
+        raise ValueError(f"Unknown arrivals {arrivals}, must be constant or poisson")
+
+    if not rate:
+        gaps = np.zeros(num_requests)
+    elif arrivals == "constant":
+        gaps = np.full(num_requests, 1 / rate)
+    else:
+        gaps = np.random.default_rng(seed).exponential(1 / rate, num_requests)
+
+    # First request is sent straight away
+    offsets = np.concatenate([[0.], np.cumsum(gaps[:-1])])
+    for i, offset in enumerate(offsets[:num_requests]):
+        yield float(offset), i, {}
+
+
+def replay_schedule(path: pathlib.Path, time_scale: float = 1.) -> Iterator[ScheduledRequest]:
+    """
+    Schedule read from a JSONL traffic file, one request per line. A line's time is its offset (seconds) from the start
+    of the run, lines without one are sent straight after the previous line. A line's image is the index of its test
+    image, the line number by default. Lines written by record_schedule can be replayed directly
+    :param path: JSONL traffic file
+    :param time_scale: Multiplier of recorded times, e.g. 0.5 replays at twice the recorded rate
+    :return: Generator of scheduled requests
+    """
+    offset = 0.
+    with open(path) as f:
+        for i, line in enumerate(line for line in f if line.strip()):
+            request = json.loads(line)
+            offset = float(request.get('time', offset / time_scale)) * time_scale
+            options = {key: request[key] for key in REQUEST_OPTIONS if key in request}
+            yield offset, int(request.get('image', i)), options
+
+
+def record_schedule(path: pathlib.Path, schedule: List[ScheduledRequest]) -> None:
+    """
+    Write requests as a JSONL traffic file, which replay_schedule reads back
+    :param path: File written
+    :param schedule: Requests sent
+    """
+    with open(path, "w") as f:
+        for offset, image, options in schedule:
+            f.write(json.dumps({'time': round(offset, 6), 'image': image, **options}) + "\n")
+
+
+class InFlight:
+    """
+    Requests sent and not yet answered. Sending waits once max_in_flight requests are outstanding, and resumes as
+    responses are received or requests time out, so that the client cannot send faster than the model server responds
+    """
+
+    def __init__(self, max_in_flight: int = 0, timeout: float = None):
+        """
+        :param max_in_flight: Maximum number of requests awaiting a response, 0 = no limit
+        :param timeout: Time (seconds) after which expire frees the slot of a request without response, None = never
+        """
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        # Request ids to the time their slot expires, in order sent and so in order of expiry
+        self.deadlines: Dict[str, float] = {}
+        self._slots = asyncio.Semaphore(max_in_flight) if max_in_flight else None
+
+    async def add(self, request_id: str) -> None:
+        """
+        Wait for a free slot, then record request as awaiting a response
+        :param request_id: Id the request is sent under
+        """
+        if self._slots is not None:
+            await self._slots.acquire()
+        self.deadlines[request_id] = float("inf") if self.timeout is None else time.perf_counter() + self.timeout
+
+    def complete(self, request_id: str) -> bool:
+        """
+        Free the slot of an answered request
+        :param request_id: Id of the response
+        :return: Whether the response answered a request still in flight, False for duplicates, other clients' and
+        expired requests
+        """
+        if self.deadlines.pop(request_id, None) is None:
+            return False
+
+        if self._slots is not None:
+            self._slots.release()
+        return True
+
+    def expire(self, now: float = None) -> List[str]:
+        """
+        Free the slots of requests past their deadline, which the LatencyTracker summary counts as timed out
+        :param now: Current time, time.perf_counter() by default
+        :return: Ids of the expired requests
+        """
+        now = time.perf_counter() if now is None else now
+        expired = []
+        for request_id, deadline in self.deadlines.items():
+            if deadline > now:
+                break
+            expired.append(request_id)
+
+        for request_id in expired:
+            self.complete(request_id)
+        return expired
+
+    def __len__(self):
+        return len(self.deadlines)
+
+
+class LatencyTracker:
+    """
+    Send and receive times of requests, matched to responses by request id
+    """
+
+    def __init__(self):
+        # Request id to [scheduled time, send time, receive time], receive time None until answered
+        self.requests: Dict[str, List] = {}
+        self.failed = set()
+        self.answered = 0
+        self.duplicates = 0
+        self.unknown = 0
+
+    def sent(self, request_id: str, send_time: float, scheduled_time: float = None) -> None:
+        """
+        :param request_id: Id the request is sent under
+        :param send_time: Time the request was sent
+        :param scheduled_time: Time the request was due to be sent, send_time by default
+        """
+        self.requests[request_id] = [send_time if scheduled_time is None else scheduled_time, send_time, None]
+
+    def send_failed(self, request_id: str) -> None:
+        self.failed.add(request_id)
+
+    def received(self, request_id: str, receive_time: float) -> bool:
+        """
+        :param request_id: Id of response
+        :param receive_time: Time the response was received
+        :return: Whether the response answered a request for the first time, False for duplicates (redelivered
+        responses) and responses to other clients' requests
+        """
+        times = self.requests.get(request_id)
+        if times is None:
+            self.unknown += 1
+            return False
+
+        if times[2] is not None:
+            self.duplicates += 1
+            return False
+
+        times[2] = receive_time
+        self.answered += 1
+        return True
+
+    @property
+    def outstanding(self) -> int:
+        return len(self.requests) - len(self.failed) - self.answered
+
+    def summary(self, timeout: float) -> Dict:
+        """
+        :param timeout: Time (seconds) a response may take before its request counts as timed out
+        :return: Counts, throughput (responses per second) and latency percentiles (milliseconds). Latency is measured
+        from the time each request was due to be sent, so that delays sending (e.g. waiting for the in-flight limit)
+        while the server falls behind are counted rather than hidden (coordinated omission). Service latency is
+        measured from the time each request was actually sent. Send lag is the delay between a request being due and
+        sent, large values mean the client (or its in-flight limit) could not keep up with the schedule
+        """
+        sent = [times for request_id, times in self.requests.items() if request_id not in self.failed]
+        answered = [times for times in sent if times[2] is not None and times[2] - times[1] <= timeout]
+        latencies = {
+            'latency': np.array([(received - scheduled) * 1000 for scheduled, _, received in answered]),
+            'service_latency': np.array([(received - send) * 1000 for _, send, received in answered]),
+        }
+        send_lag = np.array([(send - scheduled) * 1000 for scheduled, send, _ in sent])
+
+        summary = {
+            'requests': len(self.requests),
+            'responses': len(answered),
+            'timeouts': len(sent) - len(answered),
+            'lost': len(self.failed),
+            'duplicates': self.duplicates,
+            'unknown': self.unknown,
+            'throughput': 0.,
+        }
+
+        if answered:
+            elapsed = max(times[2] for times in answered) - min(times[1] for times in sent)
+            summary['throughput'] = len(answered) / elapsed if elapsed > 0 else float(len(answered))
+            for metric, values in latencies.items():
+                for name, value in zip(("p50", "p90", "p99"), np.percentile(values, [50, 90, 99])):
+                    summary[f"{metric}_{name}_ms"] = float(value)
+                summary[f"{metric}_max_ms"] = float(values.max())
+
+        if len(send_lag):
+            summary['send_lag_p99_ms'] = float(np.percentile(send_lag, 99))
+
+        return summary
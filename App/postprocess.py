@@ -0,0 +1,158 @@
+import base64
+import math
+import numbers
+import numpy as np
+from typing import Any, Dict, List, Sequence, Tuple, Union
+
+ArrayLike = Union[float, int, bool, Sequence, np.ndarray]
+
+# String values accepted for the compact request option, from clients not sending JSON booleans
+TRUE_STRINGS = ("true", "1", "yes")
+FALSE_STRINGS = ("false", "0", "no")
+
+
+def select_classes(probs: np.ndarray, threshold: ArrayLike = 0.05,
+                   top_k: ArrayLike = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Select the highest scoring classes of each row of a probability matrix
+    :param probs: Class probabilities of shape (batch, num_classes)
+    :param threshold: Minimum (exclusive) probability of a selected class, scalar or one per row
+    :param top_k: Maximum number of classes selected, scalar or one per row. 0 = no limit
+    :return: Class indices and scores of shape (batch, k) ordered by descending score, and a mask of selected entries
+    """
+    probs = np.asarray(probs)
+    n, num_classes = probs.shape
+
+    threshold = np.broadcast_to(np.asarray(threshold, dtype=probs.dtype), (n,))
+    top_k = np.broadcast_to(np.asarray(top_k, dtype=int), (n,))
+    top_k = np.where((top_k <= 0) | (top_k > num_classes), num_classes, top_k)
+
+    # Partitioning only as far as the largest k requested, then sorting those few columns
+    k = int(top_k.max()) if n else num_classes
+    if k < num_classes:
+        indices = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.broadcast_to(np.arange(num_classes), (n, num_classes))
+
+    scores = np.take_along_axis(probs, indices, axis=1)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    indices = np.take_along_axis(indices, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+
+    keep = (scores > threshold[:, None]) & (np.arange(k) < top_k[:, None])
+    return indices, scores, keep
+
+
+def parse_threshold(value: Any) -> float:
+    """
+    :raises ValueError: If value is not a finite number
+    """
+    if isinstance(value, (bool, np.bool_)) or not isinstance(value, (numbers.Real, str)):
+        raise ValueError(f"Invalid threshold {value!r}")
+
+    threshold = float(value)
+    if not math.isfinite(threshold):
+        raise ValueError(f"Invalid threshold {value!r}")
+    return threshold
+
+
+def parse_top_k(value: Any) -> int:
+    """
+    :raises ValueError: If value is not a non-negative whole number
+    """
+    if isinstance(value, (bool, np.bool_)) or not isinstance(value, (numbers.Real, str)) or \
+            (isinstance(value, numbers.Real) and not float(value).is_integer()):
+        raise ValueError(f"Invalid top_k {value!r}")
+
+    top_k = int(value)
+    if top_k < 0:
+        raise ValueError(f"Invalid top_k {value!r}")
+    return top_k
+
+
+def parse_compact(value: Any) -> bool:
+    """
+    :raises ValueError: If value is not a boolean, 0 or 1, or one of TRUE_STRINGS or FALSE_STRINGS
+    """
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, numbers.Integral) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.lower() in TRUE_STRINGS + FALSE_STRINGS:
+        return value.lower() in TRUE_STRINGS
+    raise ValueError(f"Invalid compact {value!r}")
+
+
+def request_options(request: Dict, threshold: float = 0.05, top_k: int = 0,
+                    compact: bool = False) -> Tuple[float, int, bool]:
+    """
+    Postprocessing options a request sets with the threshold, top_k and compact keys. Each is validated on its own, so
+    that a request with a bad value (e.g. a threshold of "x", or a compact of "false") is answered with the default
+    rather than failing or misreading the batch it is in
+    :param request: Client request
+    :param threshold: Default minimum probability of a returned class, used if missing or invalid
+    :param top_k: Default maximum number of classes returned, used if missing or invalid
+    :param compact: Default for returning the compact form, used if missing or invalid
+    :return: threshold, top_k and compact of the request
+    """
+    def option(key: str, parse, default):
+        value = request.get(key)
+        try:
+            return default if value is None else parse(value)
+        except ValueError:
+            return default
+
+    return (option('threshold', parse_threshold, threshold), option('top_k', parse_top_k, top_k),
+            option('compact', parse_compact, compact))
+
+
+def encode_scores(scores: np.ndarray) -> str:
+    """
+    :param scores: Probabilities
+    :return: Base64 string of little endian float16 scores
+    """
+    return base64.b64encode(np.asarray(scores, dtype="<f2").tobytes()).decode("ascii")
+
+
+def decode_scores(encoded: str) -> np.ndarray:
+    """
+    :param encoded: Output of encode_scores
+    :return: float16 scores
+    """
+    return np.frombuffer(base64.b64decode(encoded), dtype="<f2")
+
+
+def postprocess(probs: np.ndarray, class_names: Sequence[str], threshold: ArrayLike = 0.05, top_k: ArrayLike = 0,
+                compact: ArrayLike = False, decimals: int = 2) -> List[Dict]:
+    """
+    Turn a probability matrix into one result per row. Results are either a class name to rounded probability dict,
+    or in compact form a list of class indices and their float16 scores encoded by encode_scores
+    :param probs: Class probabilities of shape (batch, num_classes)
+    :param class_names: Class names ordered by model output index
+    :param threshold: Minimum (exclusive) probability of a returned class, scalar or one per row
+    :param top_k: Maximum number of classes returned, scalar or one per row. 0 = no limit
+    :param compact: Whether to return the compact form, scalar or one per row
+    :param decimals: Number of decimals probabilities are rounded to in the dict form
+    :return: List of results, one per row
+    """
+    indices, scores, keep = select_classes(probs, threshold, top_k)
+    compact = np.broadcast_to(np.asarray(compact, dtype=bool), (len(indices),))
+
+    # Names, rounding and conversion to python types are done for the whole batch at once
+    names = np.asarray(class_names)[indices].tolist()
+    # Rounding in double precision, float32 values would not round trip to short decimals
+    rounded = np.round(scores.astype(np.float64), decimals).tolist()
+    index_lists = indices.tolist()
+    keep_lists = keep.tolist()
+
+    results = []
+    for i, row_keep in enumerate(keep_lists):
+        if compact[i]:
+            results.append({
+                'classes': [c for c, k in zip(index_lists[i], row_keep) if k],
+                'scores': encode_scores(scores[i][keep[i]]),
+            })
+        else:
+            results.append({name: p for name, p, k in zip(names[i], rounded[i], row_keep) if k})
+
+    return results
@@ -0,0 +1,78 @@
+import threading
+from typing import Callable, Dict
+from ImageClassifier.registry import ModelRegistry
+
+
+class ModelReloader:
+    """
+    Watches the model registry, loading and warming up newer models in a background thread. The new model is swapped
+    in by replacing the runtime attribute once it is ready, so batches in progress finish on the old model and the next
+    batch uses the new one.
+    """
+
+    def __init__(self, registry: ModelRegistry, load: Callable[[Dict], object], runtime, current: str,
+                 dataset: str = None, interval: float = 10.):
+        """
+        :param registry: Registry of saved models to watch
+        :param load: Function loading and warming up the runtime of a registry entry
+        :param runtime: Runtime currently serving
+        :param current: Name of the model currently serving
+        :param dataset: Only follow models trained on this dataset, all models if None
+        :param interval: Time (seconds) between registry checks
+        """
+        self.registry = registry
+        self.load = load
+        self.runtime = runtime
+        self.current = current
+        self.dataset = dataset
+        self.interval = interval
+
+        self._modified = registry.modified()
+        self._failed = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check(self) -> bool:
+        """
+        Load the newest registered model if it is not the one currently serving
+        :return: True if a new model was swapped in
+        """
+        entry = self.registry.latest(self.dataset)
+        if entry is None or entry['name'] in (self.current, *self._failed):
+            return False
+
+        print(f"Loading model {entry['name']}")
+        try:
+            runtime = self.load(entry)
+        except Exception as e:
+            # Keep serving the current model, and avoid retrying the broken one on every check
+            print(f"Failed to load model {entry['name']}: {e!r}")
+            self._failed.add(entry['name'])
+            return False
+
+        self.runtime = runtime
+        self.current = entry['name']
+        print(f"Now serving model {entry['name']}")
+        return True
+
+    def run(self) -> None:
+
+        while not self._stop.wait(self.interval):
+            modified = self.registry.modified()
+            if modified != self._modified:
+                self._modified = modified
+                self.check()
+
+    def start(self) -> threading.Thread:
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="ModelReloader", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self) -> None:
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
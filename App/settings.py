@@ -1,4 +1,40 @@
+import os
+import pathlib
+
 REQUEST_TOPIC = "client_request"
 RETURN_TOPIC = "model_prediction"
 CLIENT_SUB = "client"
 MODEL_SUB = "model_server"
+
+# Predictor batching
+MAX_BATCH_SIZE = 32
+MAX_WAIT_MS = 5
+MAX_QUEUE_SIZE = 1024
+
+# Predictor worker pool, 0 workers = predict in process
+NUM_WORKERS = 0
+REPORT_INTERVAL = 60
+
+# Predictor cache, 0 bytes = disabled
+CACHE_MAX_BYTES = 64 * 2 ** 20
+CACHE_TTL = 300
+
+# Time (seconds) between model registry checks, 0 = never reload
+RELOAD_INTERVAL = 10
+
+# Default postprocessing, requests may override. Top k of 0 = no limit
+PREDICTION_THRESHOLD = 0.05
+TOP_K = 0
+
+# Client: maximum number of requests awaiting a response (0 = no limit, open loop), requests sent and their rate (per
+# second), time (seconds) after which a request without response counts as timed out, and file results are written to
+MAX_IN_FLIGHT = 0
+NUM_REQUESTS = 50
+REQUEST_RATE = 1
+RESPONSE_TIMEOUT = 10
+CLIENT_RESULTS = "client_results.json"
+
+# Fashion MNIST test images sent by the client, downloaded to the same cache as keras.datasets so either can reuse it
+EXAMPLE_DATA_URL = "https://storage.googleapis.com/tensorflow/tf-keras-datasets/"
+EXAMPLE_DATA_DIR = pathlib.Path(os.environ.get("KERAS_HOME", pathlib.Path.home().joinpath(".keras")),
+                                "datasets", "fashion-mnist")
@@ -0,0 +1,485 @@
+import asyncio
+import gzip
+import os
+import tempfile
+import threading
+import time
+import unittest
+import numpy as np
+from pathlib import Path
+from App.batcher import DynamicBatcher, AsyncDynamicBatcher
+from App.examples import load_test_images
+from App.loadgen import InFlight, LatencyTracker, arrival_schedule, replay_schedule, record_schedule
+from App.cache import PredictionCache, SqliteCacheBackend
+from App.reloader import ModelReloader
+from App.postprocess import postprocess, decode_scores, request_options
+from UnifiedAPI.adapter import FlowControl
+from ImageClassifier.registry import ModelRegistry
+from datetime import datetime, timedelta
+
+
+class BatcherTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.batches = []
+        self.done = threading.Event()
+
+    def handler(self, batch):
+        self.batches.append(batch)
+        if sum(len(b) for b in self.batches) >= self.expected:
+            self.done.set()
+
+    def test_flush_on_size(self):
+        self.expected = 10
+        batcher = DynamicBatcher(self.handler, max_batch_size=4, max_wait_ms=1000)
+        for i in range(10):
+            batcher.submit(i)
+
+        with batcher:
+            self.assertTrue(self.done.wait(5))
+
+        self.assertEqual([len(b) for b in self.batches], [4, 4, 2])
+        self.assertEqual([i for b in self.batches for i in b], list(range(10)))
+
+    def test_flush_on_wait(self):
+        self.expected = 1
+        with DynamicBatcher(self.handler, max_batch_size=32, max_wait_ms=10) as batcher:
+            start = time.monotonic()
+            batcher.submit("a")
+            self.assertTrue(self.done.wait(5))
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(self.batches, [["a"]])
+
+    def test_handler_error_does_not_stop_batcher(self):
+        self.expected = 1
+
+        def handler(batch):
+            if batch == ["bad"]:
+                raise RuntimeError
+            self.handler(batch)
+
+        with DynamicBatcher(handler, max_batch_size=1, max_wait_ms=0) as batcher:
+            batcher.submit("bad")
+            batcher.submit("good")
+            self.assertTrue(self.done.wait(5))
+
+        self.assertEqual(self.batches, [["good"]])
+
+    def test_invalid_batch_size(self):
+        with self.assertRaises(ValueError):
+            DynamicBatcher(print, max_batch_size=0)
+
+
+class AsyncBatcherTest(unittest.TestCase):
+
+    def test_threadsafe_submit_with_backpressure(self):
+        batches = []
+
+        async def handler(batch):
+            batches.append(batch)
+
+        async def run():
+            batcher = AsyncDynamicBatcher(handler, max_batch_size=4, max_wait_ms=5, max_queue_size=2)
+            worker = asyncio.create_task(batcher.run())
+            # Producer thread blocks on the full queue until the worker drains it
+            await asyncio.to_thread(lambda: [batcher.submit_threadsafe(i) for i in range(10)])
+            while sum(len(b) for b in batches) < 10:
+                await asyncio.sleep(0.01)
+            worker.cancel()
+
+        asyncio.run(asyncio.wait_for(run(), 5))
+
+        self.assertTrue(all(len(b) <= 4 for b in batches))
+        self.assertEqual([i for b in batches for i in b], list(range(10)))
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.images = np.arange(4 * 28 * 28, dtype=np.uint8).reshape((4, 28, 28))
+        self.calls = []
+
+    def infer(self, images):
+        self.calls.append(len(images))
+        return images.reshape((len(images), -1))[:, :10].astype(np.float32)
+
+    def test_predict_only_infers_misses(self):
+        cache = PredictionCache(model_id="a")
+        expected = self.infer(self.images)
+        self.calls.clear()
+
+        np.testing.assert_array_equal(cache.predict(self.images[:2], self.infer), expected[:2])
+        np.testing.assert_array_equal(cache.predict(self.images, self.infer), expected)
+        self.assertEqual(self.calls, [2, 2])
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def test_model_change_clears(self):
+        cache = PredictionCache(model_id="a")
+        key = cache.key(self.images[0])
+        cache.put(key, np.ones(10))
+        cache.set_model("b")
+        self.assertNotEqual(cache.key(self.images[0]), key)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_eviction_and_expiry(self):
+        cache = PredictionCache(max_bytes=2 * (16 + 40), ttl=0.05)
+        keys = [cache.key(image) for image in self.images[:3]]
+        for key in keys:
+            cache.put(key, np.ones(10, dtype=np.float32))
+
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get(keys[0]))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get(keys[2]))
+        self.assertEqual(cache.expirations, 1)
+
+    def test_shared_backend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp, "cache.db")
+            first = PredictionCache(model_id="a", backend=SqliteCacheBackend(path))
+            second = PredictionCache(model_id="a", backend=SqliteCacheBackend(path))
+
+            first.predict(self.images, self.infer)
+            second.predict(self.images, self.infer)
+
+            self.assertEqual(self.calls, [4])
+            self.assertEqual(second.hits, 4)
+            first.backend.close()
+            second.backend.close()
+
+
+class ReloaderTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.registry = ModelRegistry(Path(self.tmp.name, "registry.json"))
+        self.now = datetime.now()
+        self.registry.register("mnist_old", "mnist", ["a", "b"], [28, 28, 1], self.now - timedelta(days=1))
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_latest(self):
+        self.registry.register("other_new", "other", ["a"], [28, 28, 1], self.now)
+        self.assertEqual(self.registry.latest("mnist")['name'], "mnist_old")
+        self.assertEqual(self.registry.latest()['name'], "other_new")
+
+    def test_swaps_in_newer_model(self):
+        reloader = ModelReloader(self.registry, lambda entry: entry['name'], "mnist_old", "mnist_old", "mnist")
+        self.assertFalse(reloader.check())
+
+        self.registry.register("mnist_new", "mnist", ["a", "b"], [28, 28, 1], self.now)
+        self.assertTrue(reloader.check())
+        self.assertEqual(reloader.runtime, "mnist_new")
+
+    def test_failed_load_keeps_current(self):
+
+        def load(entry):
+            raise OSError
+
+        reloader = ModelReloader(self.registry, load, "runtime", "mnist_old", "mnist")
+        self.registry.register("mnist_new", "mnist", ["a", "b"], [28, 28, 1], self.now)
+        self.assertFalse(reloader.check())
+        self.assertEqual((reloader.runtime, reloader.current), ("runtime", "mnist_old"))
+
+
+class PostprocessTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.names = ["a", "b", "c", "d"]
+        self.probs = np.array([[0.1, 0.6, 0.01, 0.29],
+                               [0.7, 0.02, 0.2, 0.08]], dtype=np.float32)
+
+    def test_matches_threshold_dict(self):
+        expected = [{name: round(float(p), 2) for name, p in zip(self.names, row) if p > 0.05} for row in self.probs]
+        self.assertEqual(postprocess(self.probs, self.names), expected)
+
+    def test_per_row_top_k_and_threshold(self):
+        results = postprocess(self.probs, self.names, threshold=[0.05, 0.1], top_k=[2, 0])
+        self.assertEqual(results, [{'b': 0.6, 'd': 0.29}, {'a': 0.7, 'c': 0.2}])
+        self.assertEqual(list(results[0]), ['b', 'd'])
+
+    def test_compact(self):
+        results = postprocess(self.probs, self.names, top_k=1, compact=[True, False])
+        self.assertEqual(results[0]['classes'], [1])
+        np.testing.assert_allclose(decode_scores(results[0]['scores']), [0.6], atol=1e-3)
+        self.assertEqual(results[1], {'a': 0.7})
+
+    def test_request_options(self):
+        self.assertEqual(request_options({}, 0.05, 0, False), (0.05, 0, False))
+        self.assertEqual(request_options({'threshold': "0.2", 'top_k': 2., 'compact': "true"}), (0.2, 2, True))
+        # Each bad value falls back to its default on its own
+        self.assertEqual(request_options({'threshold': "x", 'top_k': 1, 'compact': "false"}, 0.05, 0, True),
+                         (0.05, 1, False))
+        self.assertEqual(request_options({'threshold': float("nan"), 'top_k': -1, 'compact': "maybe"}, 0.1, 3, True),
+                         (0.1, 3, True))
+        self.assertEqual(request_options({'threshold': True, 'top_k': 1.5, 'compact': [1]}), (0.05, 0, False))
+
+    def test_mixed_good_and_bad_requests(self):
+        # Imported here, as the predictor loads TensorFlow
+        from predictor import return_predictions
+
+        class Broker:
+            def send_messages(self, topic, messages):
+                self.replies = messages
+
+        broker = Broker()
+        requests = [({'id': "good", 'top_k': 1}, broker), ({'id': "bad", 'threshold': "x", 'compact': "false"}, broker)]
+        return_predictions(requests, self.probs, self.names, threshold=0.05, top_k=0, compact=False)
+
+        # Every request answered, the bad one with the defaults
+        self.assertEqual(broker.replies, [{'id': "good", 'predictions': {'b': 0.6}},
+                                          {'id': "bad", 'predictions': {'a': 0.7, 'c': 0.2, 'd': 0.08}}])
+
+
+class ExamplesTest(unittest.TestCase):
+
+    def test_load_cached_images(self):
+        images = np.arange(3 * 28 * 28, dtype=np.uint32).astype(np.uint8).reshape(3, 28, 28)
+        with tempfile.TemporaryDirectory() as tmp:
+            # IDX header: magic number then the three dimensions, all big endian
+            header = np.array([0x803, 3, 28, 28], dtype=">u4").tobytes()
+            with gzip.open(Path(tmp, "t10k-images-idx3-ubyte.gz"), "wb") as f:
+                f.write(header + images.tobytes())
+
+            np.testing.assert_array_equal(load_test_images(data_dir=Path(tmp)), images)
+            np.testing.assert_array_equal(load_test_images(2, data_dir=Path(tmp)), images[:2])
+
+
+class LoadgenTest(unittest.TestCase):
+
+    def test_arrival_schedules(self):
+        constant = list(arrival_schedule(4, rate=2))
+        self.assertEqual([offset for offset, _, _ in constant], [0., 0.5, 1., 1.5])
+        self.assertEqual([image for _, image, _ in constant], [0, 1, 2, 3])
+
+        offsets = np.array([offset for offset, _, _ in arrival_schedule(2000, rate=100, arrivals="poisson", seed=0)])
+        self.assertTrue(np.all(np.diff(offsets) >= 0))
+        self.assertAlmostEqual(len(offsets) / offsets[-1], 100, delta=10)
+
+    def test_record_and_replay(self):
+        schedule = [(0., 3, {}), (0.25, 1, {'top_k': 2})]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp, "traffic.jsonl")
+            record_schedule(path, schedule)
+            self.assertEqual(list(replay_schedule(path)), schedule)
+            self.assertEqual([offset for offset, _, _ in replay_schedule(path, time_scale=2)], [0., 0.5])
+
+            # Lines without a time follow the previous line, unknown keys are not sent
+            path.write_text('{"time": 1, "title": "x"}\n{"image": 7}\n')
+            self.assertEqual(list(replay_schedule(path)), [(1., 0, {}), (1., 7, {})])
+
+    def test_latency_summary(self):
+        tracker = LatencyTracker()
+        for i in range(4):
+            tracker.sent(str(i), send_time=i, scheduled_time=i)
+
+        self.assertTrue(tracker.received("0", 0.1))
+        self.assertTrue(tracker.received("1", 1.3))
+        self.assertFalse(tracker.received("1", 1.4))
+        self.assertFalse(tracker.received("other", 1.5))
+        # Answered after the timeout
+        tracker.received("2", 4)
+        tracker.send_failed("3")
+        self.assertEqual(tracker.outstanding, 0)
+
+        summary = tracker.summary(timeout=1)
+        self.assertEqual((summary['responses'], summary['timeouts'], summary['lost'], summary['duplicates'],
+                          summary['unknown']), (2, 1, 1, 1, 1))
+        self.assertAlmostEqual(summary['latency_max_ms'], 300)
+        self.assertAlmostEqual(summary['throughput'], 2 / 1.3)
+
+    def test_latency_from_scheduled_time(self):
+        # Sent late, e.g. held back by the in-flight limit, the wait counts towards latency
+        tracker = LatencyTracker()
+        tracker.sent("0", send_time=2, scheduled_time=0)
+        tracker.received("0", 2.5)
+
+        summary = tracker.summary(timeout=1)
+        self.assertAlmostEqual(summary['latency_p50_ms'], 2500)
+        self.assertAlmostEqual(summary['service_latency_p50_ms'], 500)
+        self.assertAlmostEqual(summary['send_lag_p99_ms'], 2000)
+
+    def test_in_flight_requests_expire(self):
+
+        async def send():
+            in_flight = InFlight(max_in_flight=2, timeout=5)
+            await in_flight.add("a")
+            await in_flight.add("b")
+            third = asyncio.ensure_future(in_flight.add("c"))
+            await asyncio.sleep(0.01)
+            self.assertFalse(third.done())
+
+            # Requests never answered free their slots once timed out, late responses are ignored
+            now = time.perf_counter()
+            self.assertEqual(in_flight.expire(now), [])
+            self.assertEqual(in_flight.expire(now + 10), ["a", "b"])
+            await asyncio.wait_for(third, 1)
+            self.assertFalse(in_flight.complete("a"))
+            self.assertTrue(in_flight.complete("c"))
+            self.assertEqual(len(in_flight), 0)
+
+        asyncio.run(send())
+
+
+class StopConsuming(Exception):
+    pass
+
+
+class FakeBroker:
+    """
+    Yields the given batches once, recording each batch acknowledged when the generator resumes
+    """
+
+    name = "fake"
+
+    def __init__(self, batches, events):
+        self.batches = batches
+        self.events = events
+
+    def consume_batches(self, sub_name, max_messages, flow_control: FlowControl):
+        if not self.batches:
+            raise StopConsuming
+
+        while self.batches:
+            batch = self.batches.pop(0)
+            flow_control.acquire(len(batch))
+            yield batch
+            self.events.append(("ack", [message['id'] for message in batch]))
+
+
+class ServeTest(unittest.TestCase):
+
+    def test_batches_acknowledged_once_answered(self):
+        # Imported here, as the predictor loads TensorFlow
+        from predictor import serve
+
+        events = []
+        broker = FakeBroker([[{'id': "a"}, {'id': "b"}], [{'id': "bad"}], [{'id': "c"}]], events)
+
+        def predict(requests):
+            ids = [message['id'] for message, _ in requests]
+            events.append(("predict", ids))
+            if "bad" in ids:
+                raise ValueError("bad request")
+
+        with self.assertRaises(StopConsuming):
+            asyncio.run(asyncio.wait_for(serve([broker], predict, max_batch_size=2, max_wait_ms=1), 10))
+
+        # Each batch is acknowledged after its prediction, the failed batch never. Consumption restarts after it, the
+        # remaining batch being consumed by the new generator
+        self.assertEqual(events, [("predict", ["a", "b"]), ("ack", ["a", "b"]), ("predict", ["bad"]),
+                                  ("predict", ["c"]), ("ack", ["c"])])
+
+
+class StubRuntime:
+    """
+    Stands in for a model in worker processes, predicting each class as the first pixel of the image. Raises for a
+    first pixel of FAIL, and exits the process for EXIT
+    """
+
+    FAIL = 255
+    EXIT = 254
+
+    def __init__(self, num_classes: int):
+        self.num_classes = num_classes
+
+    @classmethod
+    def load(cls, model_path, warmup_batch_sizes=(1,), num_classes: int = 3):
+        return cls(num_classes)
+
+    def infer(self, batch: np.ndarray) -> np.ndarray:
+        if batch[0, 0, 0] == self.FAIL:
+            raise ValueError("bad batch")
+        if batch[0, 0, 0] == self.EXIT:
+            os._exit(1)
+        return np.repeat(batch[:, :1, 0].astype(np.float32), self.num_classes, axis=1)
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    runtime_kwargs = {'runtime': StubRuntime, 'num_classes': 3}
+
+    def test_work(self):
+        import queue
+        from App.workers import SharedRingBuffer, _work
+
+        ring = SharedRingBuffer(2, 4, (2, 2), 3)
+        ring.images[1, :2] = [[[5, 0], [0, 0]], [[7, 0], [0, 0]]]
+        jobs, results = queue.Queue(), queue.Queue()
+        jobs.put((1, 2))
+        jobs.put(None)
+
+        _work(0, "model", self.runtime_kwargs, ring.spec(), jobs, results)
+
+        self.assertEqual(results.get()[:3], (0, None, 0))
+        self.assertEqual(results.get()[:3], (0, 1, 2))
+        np.testing.assert_array_equal(ring.probs[1, :2], [[5] * 3, [7] * 3])
+        ring.close(unlink=True)
+
+    def test_round_trip_through_workers(self):
+        from multiprocessing.shared_memory import SharedMemory
+        from App.workers import WorkerPool
+
+        handled = {}
+
+        def handler(items, probs):
+            handled[items[0]] = probs[:, 0].tolist()
+
+        pool = WorkerPool("model", num_workers=2, num_classes=3, image_shape=(2, 2), handler=handler, max_batch_size=4,
+                          slots_per_worker=2, report_interval=None, runtime_kwargs=self.runtime_kwargs)
+        names = [ring.shm.name for ring in pool._rings]
+
+        # Ten batches through four slots, so that every slot is reused
+        futures = []
+        with pool:
+            for i in range(10):
+                n = i % 4 + 1
+                images = np.zeros((n, 2, 2), dtype=np.uint8)
+                images[:, 0, 0] = np.arange(n) + 10 * i
+                futures.append(pool.submit([i], images))
+
+            for future in futures:
+                self.assertIsNone(future.result(timeout=30))
+
+        self.assertEqual(handled, {i: list(range(10 * i, 10 * i + i % 4 + 1)) for i in range(10)})
+        self.assertEqual(sum(stats['images'] for stats in pool.throughput()), 23)
+
+        # Workers exited cleanly and shared memory was released
+        self.assertEqual([p.exitcode for p in pool._processes], [0, 0])
+        for name in names:
+            with self.assertRaises(FileNotFoundError):
+                SharedMemory(name=name)
+
+    def test_worker_failures(self):
+        from App.workers import WorkerPool
+
+        def batch(first_pixel):
+            images = np.zeros((1, 2, 2), dtype=np.uint8)
+            images[0, 0, 0] = first_pixel
+            return images
+
+        pool = WorkerPool("model", num_workers=2, num_classes=3, image_shape=(2, 2), handler=lambda items, probs: None,
+                          max_batch_size=4, slots_per_worker=2, report_interval=None,
+                          runtime_kwargs=self.runtime_kwargs)
+        with pool:
+            # Inference errors fail their batch only, the worker carries on
+            with self.assertRaisesRegex(RuntimeError, "bad batch"):
+                pool.submit(["fail"], batch(StubRuntime.FAIL)).result(timeout=30)
+            self.assertIsNone(pool.submit(["ok"], batch(1)).result(timeout=30))
+
+            # A worker exiting fails its batch, and its slots are no longer used
+            with self.assertRaisesRegex(RuntimeError, "exited"):
+                pool.submit(["exit"], batch(StubRuntime.EXIT)).result(timeout=30)
+            for i in range(6):
+                self.assertIsNone(pool.submit([i], batch(i)).result(timeout=30))
+
+            with self.assertRaisesRegex(RuntimeError, "exited"):
+                pool.submit(["exit"], batch(StubRuntime.EXIT)).result(timeout=30)
+            with self.assertRaisesRegex(RuntimeError, "Every predictor worker"):
+                pool.submit([0], batch(0))
+
+
+if __name__ == "__main__":
+    unittest.main()
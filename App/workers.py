@@ -0,0 +1,310 @@
+import multiprocessing as mp
+import queue
+import threading
+import time
+import numpy as np
+from concurrent.futures import Future
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Dict, List, Sequence, Tuple
+
+
+class SharedRingBuffer:
+    """
+    Fixed number of slots in shared memory, each holding one batch of images and the predictions made for it. Used to
+    hand batches between processes without pickling numpy arrays.
+    """
+
+    def __init__(self, slots: int, max_batch_size: int, image_shape: Sequence[int], num_classes: int,
+                 name: str = None):
+        """
+        :param slots: Number of batches held at once
+        :param max_batch_size: Maximum number of images per slot
+        :param image_shape: Shape of a single uint8 image
+        :param num_classes: Number of float32 probabilities per image
+        :param name: Name of existing shared memory block to attach to, a new block is created if None
+        """
+        self.slots = slots
+        self.max_batch_size = max_batch_size
+        self.image_shape = tuple(image_shape)
+        self.num_classes = num_classes
+
+        image_bytes = slots * max_batch_size * int(np.prod(self.image_shape))
+        prob_bytes = slots * max_batch_size * num_classes * np.dtype(np.float32).itemsize
+
+        if name is None:
+            self.shm = SharedMemory(create=True, size=image_bytes + prob_bytes)
+        else:
+            self.shm = SharedMemory(name=name)
+
+        self.images = np.ndarray((slots, max_batch_size, *self.image_shape), dtype=np.uint8, buffer=self.shm.buf)
+        self.probs = np.ndarray((slots, max_batch_size, num_classes), dtype=np.float32, buffer=self.shm.buf,
+                                offset=image_bytes)
+
+    def spec(self) -> Dict:
+        """
+        :return: Keyword arguments used to attach to this buffer from another process
+        """
+        return {'slots': self.slots, 'max_batch_size': self.max_batch_size, 'image_shape': self.image_shape,
+                'num_classes': self.num_classes, 'name': self.shm.name}
+
+    def close(self, unlink: bool = False) -> None:
+
+        # Views must be released before the underlying memory can be closed
+        del self.images, self.probs
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def _work(worker_id: int, model_path, runtime_kwargs: Dict, spec: Dict, jobs: mp.Queue, results: mp.Queue) -> None:
+    """
+    Worker process loop: load model once, then run every batch written to its ring buffer slots through it
+    :param worker_id: Index of this worker within the pool
+    :param model_path: Path to saved model directory
+    :param runtime_kwargs: Passed to ImageClassifier.runtime.load_runtime
+    :param spec: SharedRingBuffer.spec of this worker's buffer
+    :param jobs: Queue of (slot, batch size) to process, None to stop
+    :param results: Queue of (worker id, slot, batch size, inference seconds, error) returned to the pool, error being
+    None unless inference of the batch raised
+    :return: None
+    """
+    # Imported here so that TensorFlow is only loaded in worker processes
+    from ImageClassifier.runtime import load_runtime
+
+    ring = SharedRingBuffer(**spec)
+    runtime = load_runtime(model_path, warmup_batch_sizes=(1, ring.max_batch_size), **runtime_kwargs)
+    # Slot of None signals the worker is ready
+    results.put((worker_id, None, 0, 0., None))
+
+    while (job := jobs.get()) is not None:
+        slot, n = job
+        start = time.perf_counter()
+        try:
+            ring.probs[slot, :n] = runtime.infer(ring.images[slot, :n])
+            results.put((worker_id, slot, n, time.perf_counter() - start, None))
+        except Exception as e:
+            # Sent as a new exception, as the original may not be picklable
+            results.put((worker_id, slot, n, time.perf_counter() - start,
+                         RuntimeError(f"Inference failed in worker {worker_id}: {e!r}")))
+
+    ring.close()
+
+
+class WorkerPool:
+    """
+    Pool of processes each holding its own copy of the model. Batches are written to a free slot of a worker's shared
+    memory ring buffer, and predictions are read back from the same slot by a single result thread, which passes them
+    to handler before releasing the slot. Batches of a worker that exits are failed and its slots are no longer used.
+    """
+
+    def __init__(self, model_path, num_workers: int, num_classes: int, image_shape: Sequence[int],
+                 handler: Callable[[List, np.ndarray], None], max_batch_size: int = 32, slots_per_worker: int = 2,
+                 report_interval: float = 60., runtime_kwargs: Dict = None):
+        """
+        :param model_path: Path to saved model directory, loaded once by each worker
+        :param num_workers: Number of worker processes
+        :param num_classes: Number of classes predicted by the model
+        :param image_shape: Shape of a single uint8 image
+        :param handler: Called with the items submitted with a batch and their predicted probabilities
+        :param max_batch_size: Maximum number of images per batch
+        :param slots_per_worker: Number of batches that can be queued for each worker
+        :param report_interval: Time (seconds) between throughput reports, None = report only on stop
+        :param runtime_kwargs: Passed to ImageClassifier.runtime.load_runtime by each worker
+        """
+        if num_workers < 1:
+            raise ValueError(f"num_workers must be at least 1, got {num_workers}")
+
+        self.model_path = model_path
+        self.num_workers = num_workers
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.report_interval = report_interval
+        self.runtime_kwargs = runtime_kwargs or {}
+
+        self._ctx = mp.get_context("spawn")
+        self._rings = [SharedRingBuffer(slots_per_worker, max_batch_size, image_shape, num_classes)
+                       for _ in range(num_workers)]
+        self._jobs = [self._ctx.Queue() for _ in range(num_workers)]
+        self._results = self._ctx.Queue()
+        self._processes = []
+        self._collector = None
+
+        # Any free slot of any worker can take the next batch, so idle workers are used first
+        self._free = queue.Queue()
+        for slot in range(slots_per_worker):
+            for worker in range(num_workers):
+                self._free.put((worker, slot))
+
+        # Items of each slot's batch, with the future completed once handler has returned
+        self._pending: Dict[Tuple[int, int], Tuple[List, Future]] = {}
+        self._dead = set()
+        self._images = [0] * num_workers
+        self._busy = [0.] * num_workers
+        self._start_time = None
+
+    def start(self) -> None:
+        """
+        Start worker processes, blocking until each has loaded and warmed up its model
+        :return: None
+        """
+        for worker in range(self.num_workers):
+            process = self._ctx.Process(
+                target=_work,
+                args=(worker, self.model_path, self.runtime_kwargs, self._rings[worker].spec(), self._jobs[worker],
+                      self._results),
+                name=f"PredictorWorker-{worker}",
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+
+        ready = 0
+        while ready < self.num_workers:
+            try:
+                worker, slot, *_ = self._results.get(timeout=1)
+                ready += slot is None
+            except queue.Empty:
+                if not all(p.is_alive() for p in self._processes):
+                    self.stop()
+                    raise RuntimeError("Predictor worker exited during start up")
+
+        print(f"Started {self.num_workers} predictor workers")
+        self._start_time = time.monotonic()
+        self._collector = threading.Thread(target=self._collect, name="WorkerPoolResults", daemon=True)
+        self._collector.start()
+
+    def submit(self, items: List, images: np.ndarray) -> Future:
+        """
+        Copy a batch into the next free ring buffer slot and queue it for its worker, blocking until a slot is free
+        :param items: Requests the batch was made from, passed back to handler with the predictions
+        :param images: uint8 array of shape (batch, *image_shape)
+        :return: Future completed once handler has returned for the batch, with the exception of inference or handler
+        if either raised, or a RuntimeError if the worker exited
+        :raises RuntimeError: If every worker has exited
+        """
+        n = len(images)
+        if n > self.max_batch_size:
+            raise ValueError(f"Batch of {n} exceeds max_batch_size {self.max_batch_size}")
+
+        while True:
+            try:
+                worker, slot = self._free.get(timeout=1)
+            except queue.Empty:
+                if len(self._dead) == self.num_workers:
+                    raise RuntimeError("Every predictor worker has exited")
+                continue
+
+            # Slots of exited workers are dropped
+            if worker not in self._dead:
+                break
+
+        self._rings[worker].images[slot, :n] = images
+        handled = Future()
+        self._pending[worker, slot] = items, handled
+        self._jobs[worker].put((slot, n))
+
+        # Worker may have exited, and its batches been failed, since its slot was taken
+        if worker in self._dead and self._pending.pop((worker, slot), None) is not None:
+            handled.set_exception(RuntimeError(f"Predictor worker {worker} exited"))
+        return handled
+
+    def _collect(self) -> None:
+
+        last_report = time.monotonic()
+        while True:
+            try:
+                result = self._results.get(timeout=1)
+            except queue.Empty:
+                self._fail_exited()
+                continue
+
+            if result is None:
+                break
+
+            worker, slot, n, seconds, error = result
+            pending = self._pending.pop((worker, slot), None)
+            if pending is None:
+                continue
+
+            items, handled = pending
+            try:
+                if error is not None:
+                    raise error
+                self.handler(items, self._rings[worker].probs[slot, :n])
+                handled.set_result(None)
+            except Exception as e:
+                print(f"Handling batch of {n} from worker {worker} failed: {e!r}")
+                handled.set_exception(e)
+            finally:
+                self._free.put((worker, slot))
+
+            self._images[worker] += n
+            self._busy[worker] += seconds
+
+            if self.report_interval is not None and time.monotonic() - last_report > self.report_interval:
+                self.report()
+                last_report = time.monotonic()
+
+    def _fail_exited(self) -> None:
+        """
+        Fail the pending batches of workers that have exited (e.g. killed for running out of memory), so that callers
+        waiting on them are not left waiting forever
+        """
+        for worker, process in enumerate(self._processes):
+            if worker in self._dead or process.is_alive():
+                continue
+
+            self._dead.add(worker)
+            error = RuntimeError(f"Predictor worker {worker} exited with code {process.exitcode}")
+            print(error)
+            for key in [key for key in list(self._pending) if key[0] == worker]:
+                pending = self._pending.pop(key, None)
+                if pending is not None:
+                    pending[1].set_exception(error)
+
+    def throughput(self) -> List[Dict]:
+        """
+        :return: Per worker images processed, images per second since start and images per second of inference time
+        """
+        elapsed = time.monotonic() - self._start_time if self._start_time else 0.
+        return [
+            {
+                'worker': worker,
+                'images': self._images[worker],
+                'images_per_sec': self._images[worker] / elapsed if elapsed else 0.,
+                'busy_images_per_sec': self._images[worker] / self._busy[worker] if self._busy[worker] else 0.,
+            }
+            for worker in range(self.num_workers)
+        ]
+
+    def report(self) -> None:
+
+        for stats in self.throughput():
+            print(f"Worker {stats['worker']}: {stats['images']} images, {stats['images_per_sec']:.1f} img/s, "
+                  f"{stats['busy_images_per_sec']:.1f} img/s while busy")
+
+    def stop(self) -> None:
+        """
+        Stop workers once queued batches are processed, report throughput and release shared memory
+        :return: None
+        """
+        for jobs in self._jobs:
+            jobs.put(None)
+
+        for process in self._processes:
+            process.join()
+
+        if self._collector is not None:
+            self._results.put(None)
+            self._collector.join()
+            self.report()
+
+        for ring in self._rings:
+            ring.close(unlink=True)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
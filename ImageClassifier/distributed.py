@@ -0,0 +1,113 @@
+import json
+import os
+import socket
+import subprocess
+import time
+import tensorflow as tf
+from typing import Dict, List, Tuple
+
+# Environment variable TensorFlow reads the cluster spec and the task of this process from
+TF_CONFIG = "TF_CONFIG"
+
+
+def load_cluster(path) -> Dict[str, List[str]]:
+    """
+    :param path: JSON cluster spec, e.g. {"worker": ["host1:12345", "host2:12345"]}
+    :return: Cluster spec
+    """
+    with open(path) as f:
+        cluster = json.load(f)
+
+    if not cluster.get('worker'):
+        raise ValueError(f"Cluster spec {path} has no workers")
+
+    return cluster
+
+
+def tf_config(cluster: Dict[str, List[str]], task_index: int) -> str:
+    """
+    :param cluster: Cluster spec
+    :param task_index: Index of this process among the cluster's workers, worker 0 is the chief
+    :return: TF_CONFIG value
+    """
+    if not 0 <= task_index < len(cluster['worker']):
+        raise ValueError(f"Task index {task_index} out of range for {len(cluster['worker'])} workers")
+
+    return json.dumps({'cluster': cluster, 'task': {'type': "worker", 'index': task_index}})
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def local_cluster(num_workers: int) -> Dict[str, List[str]]:
+    """
+    :param num_workers: Number of local processes standing in for hosts
+    :return: Cluster spec of workers on free localhost ports
+    """
+    return {'worker': [f"localhost:{free_port()}" for _ in range(num_workers)]}
+
+
+def launch_local_workers(command: List[str], num_workers: int) -> int:
+    """
+    Run command once per worker of a local cluster, each process given its TF_CONFIG. If a worker fails the others are
+    stopped, as they would otherwise wait for it forever
+    :param command: Command run by each worker
+    :param num_workers: Number of worker processes
+    :return: Exit code, 0 if every worker succeeded
+    """
+    cluster = local_cluster(num_workers)
+    workers = [subprocess.Popen(command, env={**os.environ, TF_CONFIG: tf_config(cluster, i)})
+               for i in range(num_workers)]
+
+    try:
+        while any(worker.poll() is None for worker in workers):
+            if any(worker.returncode for worker in workers):
+                break
+            time.sleep(0.5)
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+                worker.wait()
+
+    return max(abs(worker.returncode) for worker in workers)
+
+
+def get_strategy() -> tf.distribute.Strategy:
+    """
+    Multi-worker data parallel strategy if TF_CONFIG describes a cluster, otherwise the default (single process)
+    strategy. Must be called before any other TensorFlow operation is run
+    """
+    if json.loads(os.environ.get(TF_CONFIG, "{}")).get('cluster'):
+        return tf.distribute.MultiWorkerMirroredStrategy()
+
+    return tf.distribute.get_strategy()
+
+
+def worker_info(strategy: tf.distribute.Strategy) -> Tuple[int, int, bool]:
+    """
+    :param strategy: Strategy models are trained with
+    :return: Number of workers, index of this worker, and whether it is the chief (the worker saving the model)
+    """
+    resolver = getattr(strategy, "cluster_resolver", None)
+    if resolver is None or not resolver.cluster_spec().as_dict():
+        return 1, 0, True
+
+    return resolver.cluster_spec().num_tasks("worker"), resolver.task_id, resolver.task_id == 0
+
+
+def shard_options(num_files: int = 0, num_workers: int = 1) -> tf.data.Options:
+    """
+    :param num_files: Number of files a dataset is read from, 0 if not read from files it can be sharded by
+    :param num_workers: Number of workers the dataset is sharded over
+    :return: Options sharding the dataset by file when each worker can be given at least one, otherwise by element
+    """
+    options = tf.data.Options()
+    if num_files >= num_workers:
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.FILE
+    else:
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+    return options
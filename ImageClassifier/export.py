@@ -0,0 +1,128 @@
+import json
+import pathlib
+import time
+import numpy as np
+import tensorflow as tf
+from typing import Dict, Iterable
+from ImageClassifier.settings import IMG_HEIGHT, IMG_WIDTH, TFLITE_DIR
+from ImageClassifier.runtime import ServingRuntime, TFLiteRuntime
+
+# Post-training quantization modes: weights only (dynamic range), or weights and activations (full integer)
+QUANTIZATION_MODES = ["dynamic", "int8"]
+
+
+def representative_dataset(ds: tf.data.Dataset, num_samples: int = 200):
+    """
+    Calibration images used to choose activation ranges for full integer quantization
+    :param ds: Batched dataset of (image, label)
+    :param num_samples: Maximum number of images yielded
+    :return: Generator of single image float32 batches, as expected by the TFLite converter
+    """
+    def gen():
+        for image, _ in ds.unbatch().take(num_samples):
+            yield [tf.cast(tf.expand_dims(image, 0), tf.float32)]
+
+    return gen
+
+
+def export_tflite(model: tf.keras.Model, model_path: pathlib.Path, quantization: str,
+                  calibration_ds: tf.data.Dataset = None) -> pathlib.Path:
+    """
+    Convert a trained model to a post-training quantized TFLite model, saved alongside the SavedModel
+    :param model: Trained model
+    :param model_path: Saved model directory, export is written to its TFLITE_DIR sub-directory
+    :param quantization: One of QUANTIZATION_MODES
+    :param calibration_ds: Batched dataset of (image, label) used to calibrate int8 quantization
+    :return: Path to exported .tflite file
+    """
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization {quantization}, must be one of {QUANTIZATION_MODES}")
+
+    # Wrapping with an explicit input so that the batch dimension of the export is dynamic
+    inputs = tf.keras.Input(shape=[IMG_HEIGHT, IMG_WIDTH, 1])
+    wrapped = tf.keras.Model(inputs, model(inputs, training=False))
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(wrapped)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if quantization == "int8":
+        if calibration_ds is None:
+            raise ValueError("int8 quantization requires a calibration dataset")
+
+        converter.representative_dataset = representative_dataset(calibration_ds)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        # Raw uint8 pixels can be passed straight in, outputs stay float probabilities
+        converter.inference_input_type = tf.uint8
+
+    export_dir = pathlib.Path(model_path, TFLITE_DIR)
+    export_dir.mkdir(parents=True, exist_ok=True)
+    tflite_path = export_dir.joinpath(f"{quantization}.tflite")
+    tflite_path.write_bytes(converter.convert())
+
+    return tflite_path
+
+
+def evaluate_runtime(runtime, test_ds: tf.data.Dataset) -> Dict:
+    """
+    Measure accuracy and batch latency of a runtime on a test set
+    :param runtime: Object with an infer method taking uint8 (batch, IMG_HEIGHT, IMG_WIDTH) images
+    :param test_ds: Batched dataset of (image, label)
+    :return: Accuracy, number of images, and p50/p99 batch latency in milliseconds
+    """
+    correct = 0
+    total = 0
+    latencies = []
+
+    for images, labels in test_ds:
+        images = np.squeeze(images.numpy(), -1).astype(np.uint8)
+
+        start = time.perf_counter()
+        probs = runtime.infer(images)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        correct += int(np.sum(np.argmax(probs, -1) == labels.numpy()))
+        total += len(images)
+
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return {'accuracy': correct / total, 'images': total, 'p50_ms': float(p50), 'p99_ms': float(p99)}
+
+
+def compare_runtimes(runtimes: Dict[str, object], test_ds: tf.data.Dataset, report_path: pathlib.Path = None) -> Dict:
+    """
+    Evaluate several runtimes of the same model on the test set, printing and optionally saving the results
+    :param runtimes: Runtimes to compare, by name
+    :param test_ds: Batched dataset of (image, label)
+    :param report_path: Path to write JSON report to, not saved if None
+    :return: Results of each runtime, by name
+    """
+    report = {name: evaluate_runtime(runtime, test_ds) for name, runtime in runtimes.items()}
+
+    for name, result in report.items():
+        print(f"{name:<8} accuracy: {round(result['accuracy'] * 100, 2)}%  "
+              f"p50: {result['p50_ms']:.3f} ms  p99: {result['p99_ms']:.3f} ms")
+
+    if report_path is not None:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return report
+
+
+def export_all(model: tf.keras.Model, model_path: pathlib.Path, quantizations: Iterable[str],
+               calibration_ds: tf.data.Dataset, test_ds: tf.data.Dataset) -> Dict:
+    """
+    Export each quantization mode, then compare accuracy and latency of the exports against the Keras model
+    :param model: Trained model
+    :param model_path: Saved model directory
+    :param quantizations: Quantization modes to export
+    :param calibration_ds: Batched dataset of (image, label) used to calibrate int8 quantization
+    :param test_ds: Batched dataset of (image, label) used for comparison
+    :return: Comparison report
+    """
+    runtimes = {'keras': ServingRuntime(model)}
+    for quantization in quantizations:
+        tflite_path = export_tflite(model, model_path, quantization, calibration_ds)
+        print(f"Exported {quantization} TFLite model to {tflite_path}")
+        runtimes[quantization] = TFLiteRuntime(tflite_path)
+
+    return compare_runtimes(runtimes, test_ds, pathlib.Path(model_path, TFLITE_DIR, "report.json"))
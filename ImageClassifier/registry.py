@@ -0,0 +1,89 @@
+import fcntl
+import json
+import os
+import pathlib
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+
+class ModelRegistry:
+    """
+    Index of saved models stored as a JSON file, recording the dataset, timestamp, class names and input shape of each
+    model so that the newest model of a dataset can be found without scanning the model directory.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        """
+        :param path: Path to registry index file, created on first registration
+        """
+        self.path = pathlib.Path(path)
+        # Held while registering, so that concurrent trainers do not overwrite each other's entries
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+
+    def load(self) -> List[Dict]:
+        """
+        :return: Registered model entries, oldest first. Empty if the index does not exist yet
+        """
+        try:
+            with open(self.path) as f:
+                return json.load(f)['models']
+        except FileNotFoundError:
+            return []
+
+    def register(self, name: str, dataset: str, class_names: Sequence[str], input_shape: Sequence[int],
+                 timestamp: datetime = None) -> Dict:
+        """
+        Add a saved model to the index, replacing any existing entry of the same name. Safe to call from several
+        processes at once, each holding an exclusive lock on lock_path from reading the index to replacing it
+        :param name: Name of saved model directory
+        :param dataset: Name of dataset the model was trained on
+        :param class_names: Class names, ordered by model output index
+        :param input_shape: Shape of a single model input
+        :param timestamp: Time the model was saved, defaults to now
+        :return: Registered entry
+        """
+        timestamp = timestamp if timestamp is not None else datetime.now()
+        entry = {
+            'name': name,
+            'dataset': dataset,
+            'timestamp': timestamp.isoformat(timespec="seconds"),
+            'class_names': [str(c) for c in class_names],
+            'input_shape': [int(d) for d in input_shape],
+        }
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            models = [m for m in self.load() if m['name'] != name]
+            models.append(entry)
+            models.sort(key=lambda m: m['timestamp'])
+
+            # Writing to a temporary file then replacing, so readers never see a partially written index
+            tmp_path = self.path.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump({'models': models}, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+        return entry
+
+    def get(self, name: str) -> Optional[Dict]:
+
+        return next((m for m in self.load() if m['name'] == name), None)
+
+    def latest(self, dataset: str = None) -> Optional[Dict]:
+        """
+        :param dataset: Only consider models trained on this dataset, all models if None
+        :return: Most recently saved model entry, None if there are no matching models
+        """
+        models = [m for m in self.load() if dataset is None or m['dataset'] == dataset]
+        return max(models, key=lambda m: m['timestamp']) if models else None
+
+    def modified(self) -> float:
+        """
+        :return: Modification time of the index, 0 if it does not exist yet
+        """
+        try:
+            return self.path.stat().st_mtime
+        except FileNotFoundError:
+            return 0.
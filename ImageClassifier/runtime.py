@@ -0,0 +1,156 @@
+import pathlib
+import numpy as np
+import tensorflow as tf
+from typing import Iterable, Sequence
+from ImageClassifier.settings import IMG_HEIGHT, IMG_WIDTH, TFLITE_DIR
+
+
+class ServingRuntime:
+    """
+    Wraps a trained Keras model in a traced function with a fixed input signature, avoiding the per call set up of
+    model.predict. Shared by the predictor and offline tools through infer.
+    """
+
+    input_signature = [tf.TensorSpec(shape=[None, IMG_HEIGHT, IMG_WIDTH], dtype=tf.uint8)]
+
+    def __init__(self, model: tf.keras.Model, warmup_batch_sizes: Iterable[int] = (1,), model_id: str = None,
+                 class_names: Sequence[str] = None, jit_compile: bool = False):
+        """
+        :param model: Trained model taking (batch, height, width, 1) images and returning class probabilities
+        :param warmup_batch_sizes: Batch sizes run through the model at start up, so that the first real request
+            does not pay for tracing and graph optimisation
+        :param model_id: Identity of the model, used to tell models apart (e.g. for caching). Defaults to model name
+        :param class_names: Class names ordered by model output index, if known
+        :param jit_compile: Compile the traced function with XLA, compiled again for each new batch size
+        """
+        self.model = model
+        self.model_id = model_id if model_id is not None else model.name
+        self.class_names = None if class_names is None else np.asarray(class_names)
+        self._forward = tf.function(self._call_model, input_signature=self.input_signature, jit_compile=jit_compile)
+        self.warmup(warmup_batch_sizes)
+
+    def _call_model(self, images: tf.Tensor) -> tf.Tensor:
+        # Adding channel dimension expected by the convolution layer
+        images = tf.expand_dims(tf.cast(images, tf.float32), -1)
+        return self.model(images, training=False)
+
+    def warmup(self, batch_sizes: Iterable[int] = (1,)) -> None:
+        """
+        Run zero filled batches through the traced function
+        :param batch_sizes: Batch sizes to run
+        :return: None
+        """
+        for size in batch_sizes:
+            self.infer(np.zeros((size, IMG_HEIGHT, IMG_WIDTH), dtype=np.uint8))
+
+    def infer(self, batch: np.ndarray) -> np.ndarray:
+        """
+        Predict class probabilities for a batch of images
+        :param batch: uint8 array of shape (batch, IMG_HEIGHT, IMG_WIDTH)
+        :return: float array of shape (batch, num_classes)
+        """
+        return self._forward(tf.convert_to_tensor(batch, dtype=tf.uint8)).numpy()
+
+    @classmethod
+    def load(cls, model_path: pathlib.Path, **kwargs) -> "ServingRuntime":
+        """
+        Load a saved model and wrap it in a runtime
+        :param model_path: Path to saved model directory
+        :param kwargs: Passed to ServingRuntime
+        :return: Warmed up ServingRuntime
+        """
+        kwargs.setdefault('model_id', str(model_path))
+        return cls(tf.keras.models.load_model(model_path), **kwargs)
+
+
+class TFLiteRuntime:
+    """
+    Runs a (quantized) TFLite export of a trained model through the TFLite interpreter, with the same infer interface
+    as ServingRuntime. Not thread safe, batches must be passed one at a time.
+    """
+
+    def __init__(self, model_path: pathlib.Path, num_threads: int = None, warmup_batch_sizes: Iterable[int] = (1,),
+                 model_id: str = None, class_names: Sequence[str] = None):
+        """
+        :param model_path: Path to .tflite file
+        :param num_threads: Number of threads used by the interpreter, None = interpreter default
+        :param warmup_batch_sizes: Batch sizes run through the model at start up
+        :param model_id: Identity of the model, defaults to model path
+        :param class_names: Class names ordered by model output index, if known
+        """
+        self.model_id = model_id if model_id is not None else str(model_path)
+        self.class_names = None if class_names is None else np.asarray(class_names)
+        self.interpreter = tf.lite.Interpreter(model_path=str(model_path), num_threads=num_threads)
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch_size = None
+        self.warmup(warmup_batch_sizes)
+
+    def warmup(self, batch_sizes: Iterable[int] = (1,)) -> None:
+
+        for size in batch_sizes:
+            self.infer(np.zeros((size, IMG_HEIGHT, IMG_WIDTH), dtype=np.uint8))
+
+    def infer(self, batch: np.ndarray) -> np.ndarray:
+        """
+        Predict class probabilities for a batch of images
+        :param batch: uint8 array of shape (batch, IMG_HEIGHT, IMG_WIDTH)
+        :return: float array of shape (batch, num_classes)
+        """
+        n = len(batch)
+        if n != self._batch_size:
+            # Tensors are reallocated only when the batch size changes
+            self.interpreter.resize_tensor_input(self._input['index'], [n, IMG_HEIGHT, IMG_WIDTH, 1])
+            self.interpreter.allocate_tensors()
+            self._batch_size = n
+
+        images = np.expand_dims(batch, -1)
+        scale, zero_point = self._input['quantization']
+        if scale:
+            images = np.round(images / scale + zero_point)
+
+        self.interpreter.set_tensor(self._input['index'], images.astype(self._input['dtype']))
+        self.interpreter.invoke()
+        probs = self.interpreter.get_tensor(self._output['index'])
+
+        scale, zero_point = self._output['quantization']
+        if scale:
+            probs = (probs.astype(np.float32) - zero_point) * scale
+
+        return probs
+
+    @classmethod
+    def load(cls, model_path: pathlib.Path, quantization: str = "dynamic", **kwargs) -> "TFLiteRuntime":
+        """
+        Load the TFLite export of a saved model
+        :param model_path: Path to saved model directory
+        :param quantization: Quantization mode of the export, see ImageClassifier.export
+        :param kwargs: Passed to TFLiteRuntime
+        :return: Warmed up TFLiteRuntime
+        """
+        tflite_path = pathlib.Path(model_path, TFLITE_DIR, f"{quantization}.tflite")
+        if not tflite_path.is_file():
+            raise FileNotFoundError(f"No {quantization} TFLite export found for {model_path}, train with --tflite")
+
+        kwargs.setdefault('model_id', str(tflite_path))
+        return cls(tflite_path, **kwargs)
+
+
+RUNTIMES = {'keras': ServingRuntime, 'tflite': TFLiteRuntime}
+
+
+def load_runtime(model_path: pathlib.Path, runtime: str = "keras", **kwargs):
+    """
+    Load a saved model into the chosen serving runtime
+    :param model_path: Path to saved model directory
+    :param runtime: Name of runtime within RUNTIMES, or a class with the same load method (e.g. a stub in tests)
+    :param kwargs: Passed to the load method of the runtime
+    :return: Warmed up runtime
+    """
+    if isinstance(runtime, type):
+        return runtime.load(model_path, **kwargs)
+
+    if runtime not in RUNTIMES:
+        raise ValueError(f"Unknown runtime {runtime}, must be one of {list(RUNTIMES)}")
+
+    return RUNTIMES[runtime].load(model_path, **kwargs)
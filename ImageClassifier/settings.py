@@ -1,23 +1,80 @@
 import os
 import pathlib
+from typing import List
 
 # Paths
 parent_path = pathlib.Path(os.path.dirname(__file__))
 DATASET_DIR = parent_path.joinpath("datasets")
 MODEL_DIR = parent_path.joinpath("saved_models")
+REGISTRY_PATH = parent_path.joinpath("model_registry.json")
+# Datasets ingested into pre-decoded shards, and on-disk caches of datasets too large to cache in memory
+SHARD_DIR = parent_path.joinpath("shards")
+CACHE_DIR = parent_path.joinpath("cache")
+# TFLite exports are stored in this sub-directory of each saved model
+TFLITE_DIR = "tflite"
+# Precision, XLA use and per epoch throughput of training, stored in each saved model directory
+TRAINING_REPORT = "training.json"
+# Checkpoints of each dataset's latest training run are stored in this sub-directory of MODEL_DIR
+CHECKPOINT_DIR = "checkpoints"
 
 # Model
 BATCH_SIZE = 32
 IMG_HEIGHT = 28
 IMG_WIDTH = 28
 
-MODELS = [f.name for f in MODEL_DIR.iterdir() if f.is_dir()]
-DATASETS = [f.name for f in DATASET_DIR.iterdir() if f.is_dir()]
+# Training, early stopping and learning rate reduction on plateau all monitor MONITOR
+EPOCHS = 50
+MONITOR = "val_loss"
+EARLY_STOPPING_PATIENCE = 5
+REDUCE_LR_PATIENCE = 2
+REDUCE_LR_FACTOR = 0.2
+MIN_LR = 1e-6
+
+# Dataset ingest
+SHARD_SIZE = 4096  # Images per shard
+SPLITS = {'train': 0.8, 'val': 0.1, 'test': 0.1}
+# Decoded splits larger than this (bytes) are cached on disk rather than in memory
+CACHE_MEMORY_LIMIT = 1024 ** 3
 
 # Used to download from tf datasets
 EXAMPLE_TF_DATASET = "fashion_mnist"
-TF_MODELS = [m for m in MODELS if EXAMPLE_TF_DATASET in m]
-# Selecting most recent as default
-# TODO: Remove/rename MNIST to generic name once predictor works for other datasets, have function that selects most
-#  recent
-DEFAULT_MNIST_MODEL = TF_MODELS[-1] if TF_MODELS else f"Train a model {EXAMPLE_TF_DATASET} first!"
+
+
+def list_dirs(path: pathlib.Path) -> List[str]:
+    """
+    :param path: Directory to list
+    :return: Names of sub-directories, empty if path does not exist
+    """
+    return [f.name for f in path.iterdir() if f.is_dir()] if path.is_dir() else []
+
+
+def default_mnist_model() -> str:
+    # Selecting most recent as default, preferring the registry over directory contents
+    # TODO: Remove/rename MNIST to generic name once predictor works for other datasets
+    from ImageClassifier.registry import ModelRegistry
+
+    latest_registered = ModelRegistry(REGISTRY_PATH).latest(EXAMPLE_TF_DATASET)
+    if latest_registered is not None:
+        return latest_registered['name']
+
+    tf_models = __getattr__("TF_MODELS")
+    return tf_models[-1] if tf_models else f"Train a model {EXAMPLE_TF_DATASET} first!"
+
+
+# Settings found by scanning directories, only computed (once) when imported, so that importing the constants above
+# does not touch the filesystem
+_LAZY_SETTINGS = {
+    'MODELS': lambda: [m for m in list_dirs(MODEL_DIR) if m != CHECKPOINT_DIR],
+    'DATASETS': lambda: list_dirs(DATASET_DIR),
+    # Model names end in a timestamp, so sorting puts the most recent last
+    'TF_MODELS': lambda: sorted(m for m in __getattr__("MODELS") if EXAMPLE_TF_DATASET in m),
+    'DEFAULT_MNIST_MODEL': default_mnist_model,
+}
+
+
+def __getattr__(name: str):
+    if name in _LAZY_SETTINGS:
+        value = globals()[name] = _LAZY_SETTINGS[name]()
+        return value
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,262 @@
+import argparse
+import hashlib
+import json
+import pathlib
+import shutil
+import numpy as np
+import tensorflow as tf
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from ImageClassifier.settings import DATASET_DIR, SHARD_DIR, CACHE_DIR, IMG_HEIGHT, IMG_WIDTH, SHARD_SIZE, SPLITS, \
+    CACHE_MEMORY_LIMIT
+
+# Changing the record format or split assignment must change this, so that existing shards are re-ingested
+FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+SPLIT_SEED = 0
+PARSE_BATCH_SIZE = 256
+
+
+def list_images(dataset_path: pathlib.Path) -> Tuple[List[pathlib.Path], np.ndarray, np.ndarray]:
+    """
+    :param dataset_path: Dataset in the format dataset_name/class_names/class_images
+    :return: Image files sorted by path, the label of each and the class names labels index
+    """
+    class_names = np.array(sorted(item.name for item in dataset_path.iterdir() if item.is_dir()))
+    files, labels = [], []
+    for label, class_name in enumerate(class_names):
+        class_files = sorted(f for f in dataset_path.joinpath(class_name).iterdir() if f.is_file())
+        files.extend(class_files)
+        labels.extend([label] * len(class_files))
+
+    return files, np.array(labels, dtype=np.int64), class_names
+
+
+def fingerprint(dataset_path: pathlib.Path, files: List[pathlib.Path], image_shape: Tuple[int, int, int]) -> str:
+    """
+    Hash of the dataset's file names, sizes and modification times, and of the ingest settings, so that unchanged
+    datasets are not decoded again
+    :param dataset_path: Dataset directory
+    :param files: Image files of the dataset
+    :param image_shape: Shape images are resized to
+    :return: Hex digest
+    """
+    digest = hashlib.sha256(json.dumps([FORMAT_VERSION, image_shape, SPLITS, SPLIT_SEED]).encode("utf-8"))
+    for file in files:
+        stat = file.stat()
+        digest.update(f"{file.relative_to(dataset_path).as_posix()}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def load_image(file_path, channels: int = 1) -> tf.Tensor:
+    """
+    :param file_path: Image file, any format decode_image supports
+    :param channels: Number of colour channels decoded
+    :return: Float32 image resized to (IMG_HEIGHT, IMG_WIDTH, channels)
+    """
+    img = tf.io.read_file(file_path)
+    img = tf.io.decode_image(img, channels=channels, expand_animations=False)
+    return tf.image.resize(img, [IMG_HEIGHT, IMG_WIDTH])
+
+
+def split_indices(num_images: int) -> Dict[str, np.ndarray]:
+    """
+    Shuffle images once with a fixed seed, then partition them into SPLITS, the train split taking any remainder
+    :param num_images: Number of images in the dataset
+    :return: Image indices of each split
+    """
+    order = np.random.default_rng(SPLIT_SEED).permutation(num_images)
+    sizes = {split: int(fraction * num_images) for split, fraction in SPLITS.items() if split != "train"}
+    sizes['train'] = num_images - sum(sizes.values())
+
+    indices, start = {}, 0
+    for split in SPLITS:
+        indices[split] = order[start:start + sizes[split]]
+        start += sizes[split]
+    return indices
+
+
+def serialize_example(image: np.ndarray, label: int) -> bytes:
+    return tf.train.Example(features=tf.train.Features(feature={
+        'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+        'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
+    })).SerializeToString()
+
+
+def write_split(files: List[str], labels: np.ndarray, split_dir: pathlib.Path, split: str,
+                shard_size: int = SHARD_SIZE) -> List[str]:
+    """
+    Decode and resize images in parallel, writing them as uint8 records to shards of at most shard_size images
+    :return: Shard file names
+    """
+    num_shards = -(-len(files) // shard_size)
+    names = [f"{split}-{i:05d}-of-{num_shards:05d}.tfrecord" for i in range(num_shards)]
+
+    ds = tf.data.Dataset.from_tensor_slices((tf.constant(files, dtype=tf.string), labels))
+    ds = ds.map(lambda path, label: (tf.cast(tf.clip_by_value(tf.round(load_image(path)), 0, 255), tf.uint8), label),
+                num_parallel_calls=tf.data.AUTOTUNE)
+
+    # Each batch is written as one shard
+    for name, (images, shard_labels) in zip(names, ds.batch(shard_size).as_numpy_iterator()):
+        with tf.io.TFRecordWriter(str(split_dir.joinpath(name))) as writer:
+            for image, label in zip(images, shard_labels):
+                writer.write(serialize_example(image, int(label)))
+
+    return names
+
+
+def load_manifest(shard_dir: pathlib.Path) -> Optional[Dict]:
+    """
+    :param shard_dir: Directory of an ingested dataset
+    :return: Manifest of the ingested dataset, None if it has not been (completely) ingested
+    """
+    try:
+        with open(shard_dir.joinpath(MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def ingest(dataset_path: pathlib.Path, shard_dir: pathlib.Path = None, shard_size: int = SHARD_SIZE,
+           force: bool = False) -> Dict:
+    """
+    Convert a class-per-directory dataset into shards of pre-decoded, pre-resized images and labels, one set of
+    shards per split. Skipped if the dataset is unchanged since it was last ingested
+    :param dataset_path: Dataset in the format dataset_name/class_names/class_images
+    :param shard_dir: Directory shards are written to, SHARD_DIR/dataset_name by default
+    :param shard_size: Maximum number of images per shard
+    :param force: Ingest even if the dataset is unchanged
+    :return: Manifest of the ingested dataset
+    """
+    dataset_path = pathlib.Path(dataset_path)
+    shard_dir = pathlib.Path(shard_dir or SHARD_DIR.joinpath(dataset_path.name))
+    image_shape = (IMG_HEIGHT, IMG_WIDTH, 1)
+
+    files, labels, class_names = list_images(dataset_path)
+    if not files:
+        raise ValueError(f"No images found in {dataset_path}, expected dataset_name/class_names/class_images")
+
+    dataset_fingerprint = fingerprint(dataset_path, files, image_shape)
+    manifest = load_manifest(shard_dir)
+    if not force and manifest is not None and manifest['fingerprint'] == dataset_fingerprint:
+        print(f"{dataset_path.name} unchanged since ingested to {shard_dir}")
+        return manifest
+
+    print(f"Ingesting {len(files)} images from {dataset_path} to {shard_dir}")
+    # Written beside the existing shards and swapped in once complete, so an interrupted ingest leaves them intact
+    part_dir = shard_dir.with_name(f"{shard_dir.name}.part")
+    shutil.rmtree(part_dir, ignore_errors=True)
+    part_dir.mkdir(parents=True)
+
+    splits = {}
+    for split, indices in split_indices(len(files)).items():
+        split_files = [str(files[i]) for i in indices]
+        names = write_split(split_files, labels[indices], part_dir, split, shard_size)
+        splits[split] = {'files': names, 'num_images': len(indices)}
+
+    manifest = {
+        'source': str(dataset_path),
+        'fingerprint': dataset_fingerprint,
+        'created': datetime.now().isoformat(timespec="seconds"),
+        'class_names': class_names.tolist(),
+        'image_shape': list(image_shape),
+        'splits': splits,
+    }
+    with open(part_dir.joinpath(MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    part_dir.rename(shard_dir)
+    # Caches of the previous version are stale
+    for cache in CACHE_DIR.glob(f"{shard_dir.name}-*"):
+        shutil.rmtree(cache, ignore_errors=True)
+
+    return manifest
+
+
+def read_split(shard_dir: pathlib.Path, manifest: Dict, split: str, shuffle: bool = False) -> tf.data.Dataset:
+    """
+    Read a split's shards in parallel, interleaving records from several shards at once
+    :param shard_dir: Directory of an ingested dataset
+    :param manifest: Manifest of the ingested dataset
+    :param split: One of SPLITS
+    :param shuffle: Shuffle shard order every iteration, records are then read in a non-deterministic order
+    :return: Dataset of (float32 image, int64 label), as read from the image files by trainer.preprocess
+    """
+    files = [str(shard_dir.joinpath(name)) for name in manifest['splits'][split]['files']]
+    image_shape = manifest['image_shape']
+    features = {
+        'image': tf.io.FixedLenFeature([], tf.string),
+        'label': tf.io.FixedLenFeature([], tf.int64),
+    }
+
+    def parse(records):
+        examples = tf.io.parse_example(records, features)
+        images = tf.reshape(tf.io.decode_raw(examples['image'], tf.uint8), [-1, *image_shape])
+        return tf.cast(images, tf.float32), examples['label']
+
+    ds = tf.data.Dataset.from_tensor_slices(tf.constant(files, dtype=tf.string))
+    if shuffle:
+        # Seeded so that every worker of a distributed run shuffles shards alike before sharding them by file
+        ds = ds.shuffle(max(len(files), 1), seed=SPLIT_SEED, reshuffle_each_iteration=True)
+
+    ds = ds.interleave(tf.data.TFRecordDataset, cycle_length=max(1, min(len(files), 8)),
+                       num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+    # Records parsed in batches, far cheaper per record than parsing them one at a time
+    ds = ds.batch(PARSE_BATCH_SIZE).map(parse, num_parallel_calls=tf.data.AUTOTUNE).unbatch()
+    return ds.apply(tf.data.experimental.assert_cardinality(manifest['splits'][split]['num_images']))
+
+
+def cache_path(shard_dir: pathlib.Path, manifest: Dict, split: str, worker_index: int = None) -> str:
+    """
+    :param shard_dir: Directory of an ingested dataset
+    :param manifest: Manifest of the ingested dataset
+    :param split: One of SPLITS
+    :param worker_index: Task index of this worker when distributed, None if not. Each worker caches only its own shard
+    of the split, so needs a file of its own (workers launched locally share the cache directory)
+    :return: Cache filename for Dataset.cache, "" (memory) unless the decoded split is larger than CACHE_MEMORY_LIMIT
+    """
+    decoded_bytes = manifest['splits'][split]['num_images'] * int(np.prod(manifest['image_shape'])) * 4
+    if decoded_bytes <= CACHE_MEMORY_LIMIT:
+        return ""
+
+    cache_dir = CACHE_DIR.joinpath(f"{shard_dir.name}-{manifest['fingerprint'][:12]}")
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return str(cache_dir.joinpath(split if worker_index is None else f"{split}-worker{worker_index}"))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Ingest a dataset into shards of pre-decoded images, read by trainer.py"
+    )
+
+    parser.add_argument("dataset",
+                        help=f"Dataset within dataset directory ({DATASET_DIR})",
+                        )
+
+    parser.add_argument("--shard-size",
+                        default=SHARD_SIZE,
+                        type=int,
+                        help="Maximum number of images per shard",
+                        )
+
+    parser.add_argument("--force",
+                        action="store_true",
+                        help="Ingest even if the dataset is unchanged since last ingested",
+                        )
+
+    args = parser.parse_args()
+
+    dataset_path = pathlib.Path(DATASET_DIR, args.dataset)
+    if not dataset_path.is_dir():
+        raise NotADirectoryError(f"Dataset {args.dataset} not found in {DATASET_DIR}")
+
+    manifest = ingest(dataset_path, shard_size=args.shard_size, force=args.force)
+    for split, info in manifest['splits'].items():
+        print(f"{split:<6} {info['num_images']:>8} images in {len(info['files'])} shards")
+
+
+if __name__ == "__main__":
+
+    main()
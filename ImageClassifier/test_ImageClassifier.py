@@ -0,0 +1,366 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import numpy as np
+import tensorflow as tf
+from pathlib import Path
+from unittest import mock
+from ImageClassifier import distributed, export, shards
+from ImageClassifier import training
+from ImageClassifier.registry import ModelRegistry
+from ImageClassifier.training import ThroughputCallback, bfloat16_supported, checkpoint_callbacks, precision_policy
+from ImageClassifier.runtime import ServingRuntime, TFLiteRuntime
+from ImageClassifier.settings import IMG_HEIGHT, IMG_WIDTH, TFLITE_DIR
+
+
+class ShardsTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dataset = Path(self.tmp.name, "dataset")
+        self.shard_dir = Path(self.tmp.name, "shards", "dataset")
+
+        # Images already at the model size, so ingest stores their exact pixels
+        rng = np.random.default_rng(0)
+        self.images = {}
+        for i in range(25):
+            class_dir = self.dataset.joinpath(f"class{i % 3}")
+            class_dir.mkdir(parents=True, exist_ok=True)
+            image = rng.integers(0, 256, size=(IMG_HEIGHT, IMG_WIDTH, 1), dtype=np.uint8)
+            tf.io.write_file(str(class_dir.joinpath(f"{i}.png")), tf.io.encode_png(image))
+            self.images[image.tobytes()] = i % 3
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_ingest_and_read(self):
+
+        manifest = shards.ingest(self.dataset, self.shard_dir, shard_size=8)
+        self.assertEqual(manifest['class_names'], ["class0", "class1", "class2"])
+        self.assertEqual({split: info['num_images'] for split, info in manifest['splits'].items()},
+                         {'train': 21, 'val': 2, 'test': 2})
+        self.assertEqual(len(manifest['splits']['train']['files']), 3)
+
+        read = []
+        for split in manifest['splits']:
+            ds = shards.read_split(self.shard_dir, manifest, split, shuffle=split == "train")
+            self.assertEqual(len(ds), manifest['splits'][split]['num_images'])
+            read.extend((image.astype(np.uint8).tobytes(), label) for image, label in ds.as_numpy_iterator())
+
+        # Every image read back exactly once, with its label
+        self.assertEqual(dict(read), self.images)
+        self.assertEqual(len(read), len(self.images))
+
+    def test_unchanged_dataset_not_decoded(self):
+
+        first = shards.ingest(self.dataset, self.shard_dir)
+        with mock.patch.object(shards, "write_split") as write_split:
+            self.assertEqual(shards.ingest(self.dataset, self.shard_dir), first)
+            write_split.assert_not_called()
+
+        # Modified file changes the fingerprint
+        changed = self.dataset.joinpath("class0", "0.png")
+        os.utime(changed, ns=(0, 0))
+        second = shards.ingest(self.dataset, self.shard_dir)
+        self.assertNotEqual(second['fingerprint'], first['fingerprint'])
+        self.assertFalse(self.shard_dir.with_name("dataset.part").exists())
+
+    def test_large_splits_cached_on_disk(self):
+
+        manifest = shards.ingest(self.dataset, self.shard_dir)
+        self.assertEqual(shards.cache_path(self.shard_dir, manifest, "train"), "")
+
+        with mock.patch.object(shards, "CACHE_MEMORY_LIMIT", 0), \
+                mock.patch.object(shards, "CACHE_DIR", Path(self.tmp.name, "cache")):
+            path = shards.cache_path(self.shard_dir, manifest, "train")
+            worker_paths = [shards.cache_path(self.shard_dir, manifest, "train", index) for index in (0, 1)]
+        self.assertTrue(path.startswith(str(Path(self.tmp.name, "cache", "dataset-"))))
+
+        # Workers cache their own shard of the split, each to its own file
+        self.assertEqual(len({path, *worker_paths}), 3)
+        self.assertEqual([Path(p).name for p in worker_paths], ["train-worker0", "train-worker1"])
+
+
+class TrainingTest(unittest.TestCase):
+
+    def test_bfloat16_supported(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cpuinfo = Path(tmp, "cpuinfo")
+            cpuinfo.write_text("processor\t: 0\nflags\t\t: fpu sse2 avx2 avx512f\n")
+            self.assertFalse(bfloat16_supported(cpuinfo))
+            cpuinfo.write_text("processor\t: 0\nflags\t\t: fpu sse2 avx2 avx512f avx512_bf16\n")
+            self.assertTrue(bfloat16_supported(cpuinfo))
+            self.assertFalse(bfloat16_supported(Path(tmp, "missing")))
+
+        self.assertEqual(precision_policy(False), "float32")
+        with mock.patch("ImageClassifier.training.bfloat16_supported", return_value=False), \
+                mock.patch("tensorflow.config.list_physical_devices", return_value=[]):
+            self.assertEqual(precision_policy(True), "float32")
+
+    def test_throughput_in_epoch_logs(self):
+
+        callback = ThroughputCallback(num_images=64)
+        logs = {}
+        with mock.patch("ImageClassifier.training.time.perf_counter", side_effect=[10., 10.5, 12.]):
+            callback.on_epoch_begin(0)
+            callback.on_train_batch_end(0)
+            callback.on_train_batch_end(1)
+            callback.on_epoch_end(0, logs)
+
+        self.assertEqual(logs['images_per_sec'], 32.)
+        self.assertEqual(callback.epochs, [{'epoch': 1, 'seconds': 2., 'images_per_sec': 32.}])
+
+    def test_checkpoint_dir_cleared_unless_resuming(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint_dir = Path(tmp, "checkpoints")
+            checkpoint_dir.mkdir()
+            stale = checkpoint_dir.joinpath(training.CALLBACK_STATE)
+            stale.write_text("{}")
+
+            # Nothing to resume from without the latest checkpoint
+            checkpoint_callbacks(checkpoint_dir, resume=True)
+            self.assertFalse(stale.exists())
+
+            checkpoint_dir.joinpath(training.LATEST_CHECKPOINT).mkdir()
+            stale.write_text("{}")
+            checkpoint_callbacks(checkpoint_dir, resume=True)
+            self.assertTrue(stale.exists())
+
+            # Only the chief clears the directory shared by every worker
+            checkpoint_callbacks(checkpoint_dir, chief=False)
+            self.assertTrue(stale.exists())
+
+            callbacks, best_path = checkpoint_callbacks(checkpoint_dir, patience=0)
+            self.assertFalse(stale.exists())
+            self.assertEqual(best_path.parent, checkpoint_dir)
+            self.assertFalse(any(isinstance(callback, tf.keras.callbacks.EarlyStopping) for callback in callbacks))
+
+    def test_resume_restores_callback_progress(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint_dir = Path(tmp, "checkpoints")
+            callbacks, _ = checkpoint_callbacks(checkpoint_dir)
+            early_stopping = next(c for c in callbacks if isinstance(c, tf.keras.callbacks.EarlyStopping))
+            early_stopping.wait, early_stopping.best = 3, 0.25
+            reduce_lr, best = callbacks[:2]
+            reduce_lr.wait, reduce_lr.best, best.best = 2, 0.5, 0.75
+            callbacks[-1].on_epoch_end(0)
+            checkpoint_dir.joinpath(training.LATEST_CHECKPOINT).mkdir()
+
+            # Progress reset when training begins, then restored by the state callback coming last
+            callbacks, _ = checkpoint_callbacks(checkpoint_dir, resume=True)
+            early_stopping = next(c for c in callbacks if isinstance(c, tf.keras.callbacks.EarlyStopping))
+            early_stopping.wait, early_stopping.best = 0, float("inf")
+            callbacks[-1].on_train_begin()
+
+            self.assertEqual(early_stopping.wait, 3)
+            self.assertIsInstance(early_stopping.wait, int)
+            self.assertEqual(early_stopping.best, 0.25)
+
+            # Disabling early stopping on resume ignores its saved progress
+            callbacks, _ = checkpoint_callbacks(checkpoint_dir, patience=0, resume=True)
+            self.assertFalse(any(isinstance(c, tf.keras.callbacks.EarlyStopping) for c in callbacks))
+            reduce_lr, best = callbacks[:2]
+            reduce_lr.wait, reduce_lr.best, best.best = 0, float("inf"), float("inf")
+            callbacks[-1].on_train_begin()
+
+            # Progress of the callbacks still used is restored from the same state file
+            self.assertEqual(reduce_lr.wait, 2)
+            self.assertEqual(reduce_lr.best, 0.5)
+            self.assertEqual(best.best, 0.75)
+
+    def test_best_weights_restored(self):
+
+        class Losses(tf.keras.callbacks.Callback):
+            # Best epoch is the second
+            def on_epoch_end(self, epoch, logs=None):
+                logs[training.MONITOR] = [3., 1., 2.][epoch]
+
+        model = tf.keras.Sequential([tf.keras.layers.Dense(2)])
+        model.build([None, 4])
+        model.compile(optimizer=tf.keras.optimizers.Adam(0.1), loss="sparse_categorical_crossentropy")
+        weights = []
+        record = tf.keras.callbacks.LambdaCallback(on_epoch_end=lambda epoch, logs: weights.append(model.get_weights()))
+        ds = tf.data.Dataset.from_tensor_slices((np.ones((8, 4)), np.zeros(8))).batch(4)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            best = training.BestWeights(Path(tmp, training.BEST_CHECKPOINT))
+            model.fit(ds, epochs=3, callbacks=[Losses(), record, best], verbose=0)
+
+            # Set in memory, without reading the checkpoint (only saved by the chief when distributed)
+            for restored, expected in zip(model.get_weights(), weights[1]):
+                np.testing.assert_array_equal(restored, expected)
+            self.assertTrue(Path(tmp, training.BEST_CHECKPOINT).exists())
+
+    def test_resume_restores_reduced_learning_rate(self):
+
+        class Plateau(tf.keras.callbacks.Callback):
+            # Monitored loss never improves, so the learning rate is reduced after REDUCE_LR_PATIENCE epochs
+            def on_epoch_end(self, epoch, logs=None):
+                logs[training.MONITOR] = 1.
+
+        class Interrupt(tf.keras.callbacks.Callback):
+            def on_epoch_end(self, epoch, logs=None):
+                if epoch == training.REDUCE_LR_PATIENCE:
+                    raise KeyboardInterrupt
+
+        learning_rates = []
+
+        def fit(epochs, resume, interrupt=False):
+            model = tf.keras.Sequential([tf.keras.layers.Dense(2)])
+            record = tf.keras.callbacks.LambdaCallback(
+                on_epoch_begin=lambda epoch, logs: learning_rates.append(float(model.optimizer.learning_rate)))
+            model.build([None, 4])
+            model.compile(optimizer=tf.keras.optimizers.Adam(0.1), loss="sparse_categorical_crossentropy")
+            callbacks, _ = checkpoint_callbacks(checkpoint_dir, patience=0, resume=resume)
+            ds = tf.data.Dataset.from_tensor_slices((np.zeros((8, 4)), np.zeros(8))).batch(4)
+            callbacks = [record, Plateau(), *callbacks, *([Interrupt()] if interrupt else [])]
+            model.fit(ds, epochs=epochs, callbacks=callbacks, verbose=0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint_dir = Path(tmp, "checkpoints")
+            with self.assertRaises(KeyboardInterrupt):
+                fit(10, resume=False, interrupt=True)
+
+            # Interrupted at the end of the epoch the learning rate was reduced in, which the resumed epoch trains with
+            learning_rates.clear()
+            fit(training.REDUCE_LR_PATIENCE + 2, resume=True)
+            self.assertEqual(len(learning_rates), 1)
+            self.assertAlmostEqual(learning_rates[0], 0.1 * training.REDUCE_LR_FACTOR, places=6)
+
+
+class RegistryTest(unittest.TestCase):
+
+    def test_concurrent_registration(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp, "registry.json")
+
+            # Each registration opens the lock file itself, so threads contend for it as separate processes would
+            def register(worker):
+                for i in range(20):
+                    ModelRegistry(path).register(f"model_{worker}_{i}", "mnist", ["a", "b"], [28, 28, 1])
+
+            threads = [threading.Thread(target=register, args=(worker,)) for worker in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(len(ModelRegistry(path).load()), 8 * 20)
+
+
+class DistributedTest(unittest.TestCase):
+
+    def test_cluster_config(self):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp, "cluster.json")
+            path.write_text(json.dumps({'worker': ["host1:12345", "host2:12345"]}))
+            cluster = distributed.load_cluster(path)
+
+            path.write_text(json.dumps({'worker': []}))
+            with self.assertRaises(ValueError):
+                distributed.load_cluster(path)
+
+        config = json.loads(distributed.tf_config(cluster, 1))
+        self.assertEqual(config['task'], {'type': "worker", 'index': 1})
+        with self.assertRaises(ValueError):
+            distributed.tf_config(cluster, 2)
+
+        self.assertEqual(len(set(distributed.local_cluster(3)['worker'])), 3)
+
+    def test_single_process(self):
+
+        with mock.patch.dict(os.environ, {distributed.TF_CONFIG: "{}"}):
+            strategy = distributed.get_strategy()
+        self.assertEqual(distributed.worker_info(strategy), (1, 0, True))
+
+        policy = tf.data.experimental.AutoShardPolicy
+        self.assertEqual(distributed.shard_options(4, 2).experimental_distribute.auto_shard_policy, policy.FILE)
+        self.assertEqual(distributed.shard_options(1, 2).experimental_distribute.auto_shard_policy, policy.DATA)
+
+    def test_launch_local_workers(self):
+
+        # Each worker exits with its task index, so only a one worker cluster succeeds
+        command = [sys.executable, "-c", "import json, os, sys; "
+                                         "sys.exit(json.loads(os.environ['TF_CONFIG'])['task']['index'])"]
+        self.assertEqual(distributed.launch_local_workers(command, 1), 0)
+        self.assertNotEqual(distributed.launch_local_workers(command, 2), 0)
+
+
+class RuntimeTest(unittest.TestCase):
+
+    def test_serving_runtime(self):
+        # Imported here, as the trainer is a script outside the package
+        from trainer import create_model
+
+        model = create_model(10)
+        runtime = ServingRuntime(model, warmup_batch_sizes=(1, 5))
+        self.assertEqual(runtime.model_id, model.name)
+        self.assertEqual(ServingRuntime(model, model_id="model-1").model_id, "model-1")
+
+        images = np.random.default_rng(0).integers(0, 256, (5, IMG_HEIGHT, IMG_WIDTH), dtype=np.uint8)
+        for n in (1, 5):
+            expected = model(np.expand_dims(images[:n], -1).astype(np.float32), training=False).numpy()
+            probs = runtime.infer(images[:n])
+            self.assertEqual(probs.shape, (n, 10))
+            np.testing.assert_allclose(probs, expected, rtol=1e-5, atol=1e-6)
+
+        # Identity does not change as the runtime is used
+        self.assertEqual(runtime.model_id, model.name)
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        # Imported here, as the trainer is a script outside the package
+        from trainer import create_model
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.model = create_model(10)
+        images = np.random.default_rng(0).integers(0, 256, (8, IMG_HEIGHT, IMG_WIDTH, 1), dtype=np.uint8)
+        self.images = images[..., 0]
+        self.ds = tf.data.Dataset.from_tensor_slices((images, np.arange(8) % 10)).batch(4)
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def test_export_and_compare(self):
+
+        expected = self.model(np.expand_dims(self.images, -1).astype(np.float32), training=False).numpy()
+        runtimes = {}
+        for quantization in export.QUANTIZATION_MODES:
+            path = export.export_tflite(self.model, self.tmp.name, quantization, self.ds)
+            self.assertEqual(path, Path(self.tmp.name, TFLITE_DIR, f"{quantization}.tflite"))
+
+            # Batch dimension of the export is dynamic, so batch sizes can change between calls
+            runtime = TFLiteRuntime(path, warmup_batch_sizes=(1, 3))
+            for n in (1, 8):
+                probs = runtime.infer(self.images[:n])
+                self.assertEqual(probs.shape, (n, 10))
+                self.assertEqual(probs.dtype, np.float32)
+                np.testing.assert_allclose(probs, expected[:n], atol=0.05)
+            runtimes[quantization] = runtime
+
+        with self.assertRaises(ValueError):
+            export.export_tflite(self.model, self.tmp.name, "int8")
+
+        report_path = Path(self.tmp.name, "report.json")
+        report = export.compare_runtimes({'keras': ServingRuntime(self.model), **runtimes}, self.ds, report_path)
+        self.assertEqual(list(report), ["keras", *export.QUANTIZATION_MODES])
+        for result in report.values():
+            self.assertEqual(result['images'], 8)
+            self.assertTrue(0 <= result['accuracy'] <= 1)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+        self.assertEqual(json.loads(report_path.read_text()), report)
+
+
+if __name__ == "__main__":
+
+    unittest.main()
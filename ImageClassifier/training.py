@@ -0,0 +1,204 @@
+import json
+import numbers
+import os
+import pathlib
+import shutil
+import time
+import tensorflow as tf
+from typing import Dict, List, Tuple
+from ImageClassifier.settings import MONITOR, EARLY_STOPPING_PATIENCE, REDUCE_LR_PATIENCE, REDUCE_LR_FACTOR, MIN_LR
+
+# Files and directories within a run's checkpoint directory
+LATEST_CHECKPOINT = "latest"
+BEST_CHECKPOINT = "best.weights.h5"
+CALLBACK_STATE = "callbacks.json"
+
+# CPU flags of instructions computing in bfloat16, without which bfloat16 is emulated and slower than float32
+BFLOAT16_CPU_FLAGS = ("avx512_bf16", "amx_bf16")
+
+
+def bfloat16_supported(cpuinfo: pathlib.Path = pathlib.Path("/proc/cpuinfo")) -> bool:
+    """
+    :param cpuinfo: Linux CPU information file
+    :return: Whether the CPU has bfloat16 instructions, False if unknown (e.g. not Linux)
+    """
+    try:
+        flags = next(line for line in cpuinfo.read_text().splitlines() if line.startswith("flags")).split()
+    except (OSError, StopIteration):
+        return False
+
+    return any(flag in flags for flag in BFLOAT16_CPU_FLAGS)
+
+
+def precision_policy(mixed_precision: bool = False) -> str:
+    """
+    :param mixed_precision: Compute in 16 bit floats, keeping variables in float32
+    :return: Keras dtype policy name: mixed_float16 on GPUs, mixed_bfloat16 on CPUs with bfloat16 instructions,
+    otherwise float32
+    """
+    if not mixed_precision:
+        return "float32"
+
+    if tf.config.list_physical_devices("GPU"):
+        return "mixed_float16"
+
+    if bfloat16_supported():
+        return "mixed_bfloat16"
+
+    print("Mixed precision requested, but the CPU has no bfloat16 instructions, training in float32")
+    return "float32"
+
+
+class ThroughputCallback(tf.keras.callbacks.Callback):
+    """
+    Training images per second of each epoch, from the start of the epoch to its last training batch (excluding
+    validation). Added to the epoch logs as images_per_sec, so it is also recorded in the History. The first epoch
+    includes tracing and, with XLA, compilation
+    """
+
+    def __init__(self, num_images: int, verbose: bool = True):
+        """
+        :param num_images: Number of training images per epoch, over all workers when distributed
+        :param verbose: Print the throughput of each epoch
+        """
+        super().__init__()
+        self.num_images = num_images
+        self.verbose = verbose
+        self.epochs: List[Dict] = []
+        self._start = self._end = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start = self._end = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._end = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = self._end - self._start
+        images_per_sec = self.num_images / seconds if seconds > 0 else 0.
+        self.epochs.append({'epoch': epoch + 1, 'seconds': seconds, 'images_per_sec': images_per_sec})
+        if self.verbose:
+            print(f"Epoch {epoch + 1}: {images_per_sec:.0f} images/sec ({seconds:.1f} s)")
+        if logs is not None:
+            logs['images_per_sec'] = images_per_sec
+
+
+class CallbackState(tf.keras.callbacks.Callback):
+    """
+    Progress of callbacks that BackupAndRestore does not checkpoint (patience counters, cooldown and best values
+    seen), saved after every epoch and restored when training resumes, so that early stopping, learning rate
+    reduction and best checkpoint selection carry on where they stopped. Must come after the callbacks it restores,
+    which reset their progress when training begins
+    """
+
+    ATTRIBUTES = ("wait", "best", "cooldown_counter", "best_epoch")
+
+    def __init__(self, path: pathlib.Path, callbacks: Dict[str, tf.keras.callbacks.Callback], save: bool = True):
+        """
+        :param path: JSON file progress is saved to
+        :param callbacks: Callbacks whose progress is saved, by name
+        :param save: Save progress, False for workers other than the chief
+        """
+        super().__init__()
+        self.path = pathlib.Path(path)
+        self.callbacks = callbacks
+        self.save = save
+
+    def on_train_begin(self, logs=None):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+
+        for name, attributes in state.items():
+            # Skipping callbacks not used by the resumed run, e.g. early stopping disabled
+            callback = self.callbacks.get(name)
+            for attribute, value in attributes.items() if callback is not None else ():
+                # Restored with the type the callback reset it to, e.g. counters stay integers, if it has one yet
+                current = getattr(callback, attribute, None)
+                setattr(callback, attribute, type(current)(value) if isinstance(current, numbers.Number) else value)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if not self.save:
+            return
+
+        state = {name: {attribute: float(getattr(callback, attribute)) for attribute in self.ATTRIBUTES
+                        if isinstance(getattr(callback, attribute, None), numbers.Number)}
+                 for name, callback in self.callbacks.items()}
+
+        part = self.path.with_name(f"{self.path.name}.part")
+        with open(part, "w") as f:
+            json.dump(state, f)
+        os.replace(part, self.path)
+
+
+class BestWeights(tf.keras.callbacks.ModelCheckpoint):
+    """
+    Saves the weights of the best epoch by MONITOR, and sets the model to them once training ends. Every worker keeps
+    a copy in memory, as only the chief's checkpoint is kept when distributed (on its host's filesystem), so that every
+    worker evaluates the same model. When the best epoch came before training was resumed its weights are loaded from
+    the checkpoint, which must then be on a filesystem shared by the workers, as BackupAndRestore requires
+    """
+
+    def __init__(self, path: pathlib.Path):
+        """
+        :param path: File the best weights are saved to
+        """
+        super().__init__(str(path), monitor=MONITOR, save_best_only=True, save_weights_only=True)
+        self.best_weights = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        best = self.best
+        super().on_epoch_end(epoch, logs)
+        if self.best != best:
+            self.best_weights = self.model.get_weights()
+
+    def on_train_end(self, logs=None):
+        super().on_train_end(logs)
+        if self.best_weights is not None:
+            self.model.set_weights(self.best_weights)
+        elif os.path.exists(self.filepath):
+            self.model.load_weights(self.filepath)
+
+
+def checkpoint_callbacks(checkpoint_dir: pathlib.Path, patience: int = EARLY_STOPPING_PATIENCE, resume: bool = False,
+                         chief: bool = True) -> Tuple[List[tf.keras.callbacks.Callback], pathlib.Path]:
+    """
+    Callbacks checkpointing the model and optimizer after every epoch (restored by a resumed run), setting the model to
+    the weights of the best epoch once training ends, reducing the learning rate when MONITOR plateaus and stopping
+    once it no longer improves
+    :param checkpoint_dir: Directory of this run's checkpoints, shared by every worker and cleared by the chief unless
+    resuming
+    :param patience: Epochs without improvement before stopping, 0 = never stop early
+    :param resume: Continue from the last completed epoch of the run checkpointed in checkpoint_dir, if any
+    :param chief: Whether this is the chief worker, the only one clearing checkpoint_dir and saving callback progress
+    :return: Callbacks, and the path the weights of the best epoch are saved to
+    """
+    checkpoint_dir = pathlib.Path(checkpoint_dir)
+    if resume and not checkpoint_dir.joinpath(LATEST_CHECKPOINT).exists():
+        print(f"No checkpoint to resume from in {checkpoint_dir}, starting from the first epoch")
+        resume = False
+    if not resume and chief:
+        # Best weights and callback progress of a previous run would otherwise carry over. Other workers must not
+        # clear it, as a worker starting late would delete what the chief has written since
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+
+    best_path = checkpoint_dir.joinpath(BEST_CHECKPOINT)
+    tracked = {
+        'reduce_lr': tf.keras.callbacks.ReduceLROnPlateau(monitor=MONITOR, factor=REDUCE_LR_FACTOR,
+                                                          patience=REDUCE_LR_PATIENCE, min_lr=MIN_LR, verbose=1),
+        'best': BestWeights(best_path),
+    }
+    if patience:
+        tracked['early_stopping'] = tf.keras.callbacks.EarlyStopping(monitor=MONITOR, patience=patience, verbose=1)
+
+    callbacks = [
+        *tracked.values(),
+        # Restores the model, optimizer (including the reduced learning rate) and epoch of a resumed run. After the
+        # tracked callbacks, so that each backup includes the learning rate reduced at the end of its epoch
+        tf.keras.callbacks.BackupAndRestore(str(checkpoint_dir.joinpath(LATEST_CHECKPOINT))),
+        CallbackState(checkpoint_dir.joinpath(CALLBACK_STATE), tracked, save=chief),
+    ]
+    return callbacks, best_path
@@ -1,27 +1,208 @@
+import importlib
 import json
-import os
+import threading
+import time
 import uuid
-from UnifiedAPI.settings import PROJECT, TEST_TOPIC, TEST_SUB
-from typing import Dict
+from UnifiedAPI.log import logger
+from UnifiedAPI.metrics import REGISTRY
+from UnifiedAPI.settings import PROJECT, TEST_TOPIC, TEST_SUB, BROKERS, MAX_OUTSTANDING_MESSAGES, \
+    MAX_OUTSTANDING_BYTES
+from UnifiedAPI.serializers import Serializer
+from typing import Callable, Dict, Iterable, List, Tuple
 from abc import ABC, abstractmethod
-from concurrent.futures import TimeoutError
-from google.api_core.exceptions import AlreadyExists, NotFound
-from google.cloud.pubsub_v1 import PublisherClient, SubscriberClient, publisher
-from kafka import KafkaProducer, KafkaConsumer, KafkaAdminClient
-from kafka.errors import TopicAlreadyExistsError
-from kafka.admin import NewTopic
-# TODO: Implement wait_for_future which accepts a future object and returns when it is completed. Avoids using things
-#  like time.sleep(5)
+
+# Module and class of each broker, imported only when the broker is used so that unused client libraries are not loaded
+BROKER_CLASSES = {
+    'pubsub': ("UnifiedAPI.pubsub_broker", "PubsubBroker"),
+    'kafka': ("UnifiedAPI.kafka_broker", "KafkaBroker"),
+    'local': ("UnifiedAPI.local", "LocalBroker"),
+}
+
+# Broker independent series, updated by static methods shared by every broker
+DECODE_SECONDS = REGISTRY.histogram("broker_decode_seconds", "Time to decode a consumed message")
+ENCODE_SECONDS = REGISTRY.histogram("broker_encode_seconds", "Time to encode a message before sending")
+
+
+class DeliveryReport:
+    """
+    Futures of messages sent together without blocking, used to wait for and count their delivery
+    """
+
+    def __init__(self, futures: List, wait_for_future: Callable):
+        """
+        :param futures: Broker specific futures of sent messages
+        :param wait_for_future: Function blocking until a future is complete, raising its exception if it failed
+        """
+        self.futures = futures
+        self.wait_for_future = wait_for_future
+        self.errors = []
+
+    def __len__(self):
+        return len(self.futures)
+
+    def wait(self, timeout: float = None) -> int:
+        """
+        Block until every message is delivered or has failed
+        :param timeout: Maximum time (seconds) to wait for each message, None = no limit
+        :return: Number of messages that failed delivery, with their exceptions stored in errors
+        """
+        self.errors = []
+        for future in self.futures:
+            try:
+                self.wait_for_future(future, timeout)
+            except Exception as e:
+                self.errors.append(e)
+
+        return len(self.errors)
+
+
+class FlowControl:
+    """
+    Limits the number and size of messages consumed but not yet handled. Consumers stop pulling once either limit is
+    reached, and resume as handled messages are released, so that a slow handler is not buried under a burst of
+    messages. Shared between the consuming thread, which acquires messages, and the handler, which releases them
+    """
+
+    def __init__(self, max_messages: int = MAX_OUTSTANDING_MESSAGES, max_bytes: int = MAX_OUTSTANDING_BYTES):
+        """
+        :param max_messages: Maximum number of outstanding messages, 0 = no limit
+        :param max_bytes: Maximum total size (bytes) of outstanding messages, 0 = no limit
+        """
+        if max_messages < 0 or max_bytes < 0:
+            raise ValueError(f"Limits must not be negative, got {max_messages} messages and {max_bytes} bytes")
+
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.messages = 0
+        self.bytes = 0
+        self._condition = threading.Condition()
+
+    @property
+    def full(self) -> bool:
+        return bool((self.max_messages and self.messages >= self.max_messages) or
+                    (self.max_bytes and self.bytes >= self.max_bytes))
+
+    def limit(self, max_messages: int) -> int:
+        """
+        :param max_messages: Number of messages a consumer would otherwise pull
+        :return: Number of messages that can be pulled without exceeding max_messages outstanding, at least 1
+        """
+        if not self.max_messages:
+            return max_messages
+
+        return max(1, min(max_messages, self.max_messages - self.messages))
+
+    def acquire(self, messages: int, nbytes: int = 0) -> None:
+        """
+        Record messages pulled by a consumer
+        :param messages: Number of messages
+        :param nbytes: Total size (bytes) of the messages as received
+        """
+        with self._condition:
+            self.messages += messages
+            self.bytes += nbytes
+
+    def release(self, messages: int = 1) -> None:
+        """
+        Record messages handled, waking consumers waiting for capacity
+        :param messages: Number of messages
+        """
+        with self._condition:
+            # Sizes of individual messages are not kept, each message releases the mean size of those outstanding
+            if self.messages:
+                self.bytes -= self.bytes * min(messages, self.messages) // self.messages
+            self.messages = max(0, self.messages - messages)
+            self._condition.notify_all()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Block while either limit is reached
+        :param timeout: Maximum time (seconds) to wait, None = no limit
+        :return: Whether messages can be pulled, False if still full after timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self.full, timeout)
+
+    def __repr__(self):
+        return (f"FlowControl(messages={self.messages}/{self.max_messages or 'unlimited'}, "
+                f"bytes={self.bytes}/{self.max_bytes or 'unlimited'})")
 
 
 class MessageBroker(ABC):
 
+    # Short name used to select broker from the command line
+    name = None
     subclasses = []
+    serializer = Serializer()
 
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
         cls.subclasses.append(cls)
 
+    def __init__(self, serializer: Serializer = None):
+        """
+        :param serializer: Serializer used to encode sent messages, JSON by default
+        """
+        if serializer is not None:
+            self.serializer = serializer
+
+        # Clients by name, each with the function that closes it
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+
+        self.sent_total = REGISTRY.counter("broker_messages_sent_total", "Messages delivered to the broker",
+                                           broker=self.name)
+        self.failed_total = REGISTRY.counter("broker_send_failures_total", "Messages that failed delivery",
+                                             broker=self.name)
+        self.consumed_total = REGISTRY.counter("broker_messages_consumed_total", "Messages consumed in batches",
+                                               broker=self.name)
+        self.publish_seconds = REGISTRY.histogram("broker_publish_seconds",
+                                                  "Time from sending a message to its delivery", broker=self.name)
+
+    def consumer_lag(self, sub_name: str, **labels):
+        """
+        :param sub_name: Subscriber
+        :param labels: Further labels, e.g. partition
+        :return: Gauge of messages waiting to be consumed by the subscriber
+        """
+        return REGISTRY.gauge("broker_consumer_lag", "Messages waiting to be consumed", broker=self.name,
+                              subscription=sub_name, **labels)
+
+    def get_client(self, name: str, factory: Callable, close: Callable = None):
+        """
+        Client created on first use and reused by every later call, including calls from other threads
+        :param name: Name the client is stored under
+        :param factory: Function without arguments creating the client
+        :param close: Function closing the client, calls its close method by default
+        :return: Client
+        """
+        try:
+            return self._clients[name][0]
+        except KeyError:
+            pass
+
+        with self._clients_lock:
+            if name not in self._clients:
+                self._clients[name] = (factory(), close or (lambda client: client.close()))
+
+            return self._clients[name][0]
+
+    def close(self) -> None:
+        """
+        Close every client created by this broker. Clients are recreated if the broker is used again
+        """
+        with self._clients_lock:
+            clients, self._clients = self._clients, {}
+
+        for client, close in clients.values():
+            close(client)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
     @property
     @abstractmethod
     def subscriber(self):
@@ -49,13 +230,46 @@ class MessageBroker(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def send_message(self, topic, message):
+    def send_message(self, topic, message, block=True):
         raise NotImplementedError
 
+    def send_messages(self, topic: str, messages: Iterable[Dict]) -> DeliveryReport:
+        """
+        Send messages without blocking, letting the producer client batch them
+        :param topic: Topic to send messages to
+        :param messages: Messages to be sent
+        :return: Report used to wait for delivery of the messages
+        """
+        return DeliveryReport([self.send_message(topic, message, block=False) for message in messages],
+                              self.wait_for_future)
+
     @abstractmethod
-    def consume(self, sub_name, callback=print, timeout=10):
+    def flush(self, timeout=None):
         raise NotImplementedError
 
+    @staticmethod
+    @abstractmethod
+    def wait_for_future(future, timeout=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def consume(self, sub_name, callback=print, timeout=10, flow_control=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def consume_batches(self, sub_name, max_messages=100, max_wait=1., timeout=None, flow_control=None):
+        raise NotImplementedError
+
+    def wait_for_capacity(self, sub_name: str, flow_control: FlowControl, max_wait: float = 1.) -> None:
+        """
+        Block until flow_control allows messages to be pulled from a subscriber
+        :param sub_name: Subscriber waiting
+        :param flow_control: Flow control of the subscriber's consumer
+        :param max_wait: Time (seconds) between checks of the subscriber while waiting
+        """
+        while not flow_control.wait(max_wait):
+            pass
+
     @staticmethod
     @abstractmethod
     def broker_callback(message, nested_callback=print) -> None:
@@ -74,216 +288,74 @@ class MessageBroker(ABC):
         return json.dumps(data).encode("utf-8")
 
     @staticmethod
-    def decode_data(data):
-        return json.loads(data.decode("utf-8"))
-
-    @staticmethod
-    def send_success(message_id, topic):
-        print(f"Message id: {message_id} delivered to topic: {topic}")
-
-
-class PubsubBroker(MessageBroker):
-
-    def __init__(self, project):
-        self.project = project
-
-    @property
-    def subscriber(self):
-        return SubscriberClient()
-
-    @property
-    def producer(self):
-        return PublisherClient()
-
-    def create_topic(self, topic, **kwargs) -> publisher.futures.Future:
-
-        topic_path = self.get_topic_path(topic)
-        response = {}
-
-        try:
-            response = self.producer.create_topic(name=topic_path, **kwargs)
-            print(f"Created topic {topic} in {self.project}")
-
-        except AlreadyExists:
-            print(f"{topic} already exists in {self.project}")
-
-        return response
-
-    def delete_topic(self, topic):
-
-        topic_path = self.get_topic_path(topic)
-        try:
-            self.producer.delete_topic(topic=topic_path)
-            print(f"Topic: {topic} deleted from project: {self.project}")
-        except NotFound:
-            print(f"Topic: {topic} does not exist in project: {self.project}")
-
-    def create_subscriber(self, name, topic, **kwargs) -> None:
-
-        sub_path = self.get_subscriber_path(name)
-        topic_path = self.get_topic_path(topic)
-
-        # subs = self.subscriber.list_subscriptions(project=f"projects/{self.project}")
-        # TODO: Not a great way to do this, but can't assign sub to new topic without deleting (possibly detaching)
-        #  first. Above expression makes it difficult to get names, otherwise would use that
-        for _ in range(2):
-            try:
-                self.subscriber.create_subscription(
-                    name=sub_path, topic=topic_path, **kwargs
-                )
-                print(f"Subscription created {name} in {self.project}")
-                break
-            except AlreadyExists:
-                print(f"Subscription {name} already exists in {self.project}")
-                self.delete_subscriber(name)
-
-    def delete_subscriber(self, name) -> None:
-
-        subscription_path = self.get_subscriber_path(name)
-        self.subscriber.delete_subscription(subscription=subscription_path)
-
-        print(f"Subscription deleted: {subscription_path}.")
-
-    def send_message(self, topic: str, message: Dict):
-        topic_path = self.get_topic_path(topic)
-        message = self.add_id(message)
-        encoded_message = self.encode_data(message)
-
-        future = self.producer.publish(topic_path, encoded_message)
-
-        if isinstance(future.exception(), NotFound):
-            raise NotFound(f"Topic: {topic} not found in project: {self.project}")
-
-        self.send_success(message['id'], topic)
-        return future
-
-    def consume(self, sub_name, callback=print, timeout: int = None):
-
-        sub_path = self.get_subscriber_path(sub_name)
-        future = self.subscriber.subscribe(sub_path, lambda message: self.broker_callback(message, callback))
-        print(f"Beginning consumption of subscriber: {sub_name}")
-
-        # When `timeout` is not set, result() will block indefinitely,
-        # unless an exception is encountered first.
-        try:
-            future.result(timeout=timeout)
-        except (TimeoutError, KeyboardInterrupt):
-            future.cancel()  # Trigger the shutdown.
-            future.result()  # Block until the shutdown is complete.
-
-    def get_topic_path(self, topic):
-
-        topic_name = 'projects/{project_id}/topics/{topic}'.format(
-            project_id=self.project,
-            topic=topic,
-        )
-
-        return topic_name
-
-    def get_subscriber_path(self, subscription_id):
-
-        subscription_name = 'projects/{project_id}/subscriptions/{sub}'.format(
-            project_id=self.project,
-            sub=subscription_id,
-        )
-
-        return subscription_name
-
-    @staticmethod
-    def broker_callback(message, nested_callback=print) -> None:
-        decoded_data = MessageBroker.decode_data(message.data)
-        nested_callback(decoded_data)
-        message.ack()
-
-    def __del__(self):
-        try:
-            self.subscriber.close()
-        except (TypeError, ImportError):
-            pass
-
-
-class KafkaBroker(MessageBroker):
-
-    subscriptions = dict()
-
-    def __init__(self, project=None, host=os.environ["KAFKA_HOST"]):
-        self.project = project
-        self.host = host
-
-    @property
-    def subscriber(self):
-        return KafkaConsumer(bootstrap_servers=[self.host])
-
-    @property
-    def producer(self):
-        return KafkaProducer(bootstrap_servers=[self.host])
-
-    @producer.setter
-    def producer(self, **kwargs):
-        self.producer = KafkaProducer(bootstrap_servers=[self.host], **kwargs)
-
-    def create_topic(self, topic_name: str, num_partitions: int = 1, replication_factor: int = 1):
-
-        new_topic = NewTopic(topic_name, num_partitions, replication_factor)
-        admin = KafkaAdminClient(bootstrap_servers=[self.host])
-        try:
-            test = admin.create_topics([new_topic])
-            print(test)
-        except TopicAlreadyExistsError:
-            print(f"Topic: {topic_name} already exists")
-
-    def delete_topic(self, topic: str):
-        # TODO: This is breaking the connection, docs say AdminClient is early stages/unstable
-        # admin = KafkaAdminClient(bootstrap_servers=[self.host])
-        # admin.delete_topics([topic])
-        pass
-
-    def create_subscriber(self, name, topic, group="mygroup", **kwargs):
-
-        consumer = KafkaConsumer(
-            topic,
-            bootstrap_servers=[self.host],
-            group_id=group,
-            client_id=name,
-            enable_auto_commit=True,
-            **kwargs,
-        )
-
-        self.subscriptions[name] = consumer
-
-    def delete_subscriber(self, name):
-
-        if self.subscriptions and name in self.subscriptions.keys():
-            self.subscriptions.pop(name)
-        else:
-            print(f"Subscriber {name} does not exist")
-
-    def consume(self, sub_name, callback=print, timeout: int = None):
-
-        # Using same definition as pubsub timeout: None = block indefinitely, which is the default setting here
-        if sub_name in self.subscriptions.keys() and timeout is not None:
-            self.subscriptions[sub_name].config['consumer_timeout_ms'] = timeout * 1000
-
-        print(f"Beginning consumption of subscriber: {sub_name}")
-        for message in self.subscriptions[sub_name]:
-            self.broker_callback(message, callback)
-
-    def send_message(self, topic, message):
-        message = self.add_id(message)
-        encoded_message = self.encode_data(message)
-        future = self.producer.send(topic, value=encoded_message).add_callback(self.send_success(message['id'], topic))
-        return future
-
-    @staticmethod
-    def broker_callback(message, nested_callback=print) -> None:
-        decoded_data = MessageBroker.decode_data(message.value)
-        nested_callback(decoded_data)
+    def decode_data(data, metadata: Dict[str, str] = None):
+        """
+        Decode a message using the codec and compression recorded in its metadata
+        :param data: Encoded message
+        :param metadata: Message attributes (Pub/Sub) or headers (Kafka), messages without metadata are JSON
+        :return: Decoded message
+        """
+        start = time.perf_counter()
+        message = Serializer.decode(data, metadata)
+        DECODE_SECONDS.observe(time.perf_counter() - start)
+        return message
 
-    def __del__(self):
-        try:
-            self.producer.close()
-        except (TypeError, ImportError):
-            pass
+    def encode_message(self, message: Dict) -> Tuple[bytes, Dict[str, str]]:
+        """
+        Encode message with this broker's serializer
+        :param message: Message to be sent
+        :return: Encoded message, and metadata to be sent as message attributes or headers
+        """
+        start = time.perf_counter()
+        encoded = self.serializer.encode(message)
+        ENCODE_SECONDS.observe(time.perf_counter() - start)
+        return encoded
+
+    def send_success(self, message_id, topic, sent: float = None) -> None:
+        """
+        :param message_id: Id of delivered message
+        :param topic: Topic message was sent to
+        :param sent: time.perf_counter() when the message was sent, to observe publish latency
+        """
+        self.sent_total.inc()
+        if sent is not None:
+            self.publish_seconds.observe(time.perf_counter() - sent)
+        logger.debug("Message id: %s delivered to topic: %s", message_id, topic)
+
+    def send_failure(self, message_id, topic, exception) -> None:
+        self.failed_total.inc()
+        logger.warning("Message id: %s failed delivery to topic: %s: %r", message_id, topic, exception)
+
+
+def get_broker_class(name: str):
+    """
+    :param name: Short name of broker, within BROKER_CLASSES
+    :return: MessageBroker concrete class, importing its module (and client library) on first use
+    """
+    if name not in BROKER_CLASSES:
+        raise ValueError(f"Unknown broker {name}, must be one of {list(BROKER_CLASSES)}")
+
+    module, class_name = BROKER_CLASSES[name]
+    return getattr(importlib.import_module(module), class_name)
+
+
+def create_broker(name: str, *args, **kwargs) -> MessageBroker:
+    """
+    :param name: Short name of broker, within BROKER_CLASSES
+    :param args: Positional arguments of the broker
+    :param kwargs: Keyword arguments of the broker
+    :return: MessageBroker concrete class instance
+    """
+    return get_broker_class(name)(*args, **kwargs)
+
+
+def __getattr__(name: str):
+    # Brokers remain available as attributes of this module, imported when first accessed
+    for broker_name, (_, class_name) in BROKER_CLASSES.items():
+        if name == class_name:
+            return get_broker_class(broker_name)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def example(broker):
@@ -292,6 +364,7 @@ def example(broker):
     broker.create_subscriber(TEST_SUB, TEST_TOPIC)
     for i in range(10):
         broker.send_message(TEST_TOPIC, {'data': f"{i}"})
+    broker.flush()
 
     broker.consume(TEST_SUB, timeout=10)
     broker.delete_subscriber(TEST_SUB)
@@ -299,9 +372,10 @@ def example(broker):
 
 
 def main():
-    for broker in MessageBroker.subclasses:
-        print(f"Running example case on {broker.__name__} broker")
-        example(broker(project=PROJECT))
+    for name in BROKERS:
+        print(f"Running example case on {name} broker")
+        with create_broker(name, project=PROJECT) as b:
+            example(b)
         print(f"Finished example")
 
 
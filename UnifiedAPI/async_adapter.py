@@ -0,0 +1,405 @@
+import asyncio
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Tuple
+from UnifiedAPI.adapter import MessageBroker, create_broker
+from UnifiedAPI.settings import LOCAL_POLL_INTERVAL
+
+
+class AsyncMessageBroker(ABC):
+    """
+    Asyncio counterpart of a MessageBroker. Sends and consumes from a single event loop without blocking it. Topics and
+    subscribers are managed through the synchronous broker, before starting the event loop
+    """
+
+    # Short name used to select broker from the command line, also naming the synchronous broker wrapped
+    name = None
+    subclasses = []
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.subclasses.append(cls)
+
+    def __init__(self, *args, **kwargs):
+        """
+        :param args: Positional arguments of the synchronous broker
+        :param kwargs: Keyword arguments of the synchronous broker
+        """
+        self.broker: MessageBroker = create_broker(self.name, *args, **kwargs)
+
+    def create_topic(self, topic, **kwargs):
+        return self.broker.create_topic(topic, **kwargs)
+
+    def delete_topic(self, topic):
+        return self.broker.delete_topic(topic)
+
+    def create_subscriber(self, name, topic, **kwargs):
+        return self.broker.create_subscriber(name, topic, **kwargs)
+
+    def delete_subscriber(self, name):
+        return self.broker.delete_subscriber(name)
+
+    @abstractmethod
+    def wrap_future(self, future) -> asyncio.Future:
+        raise NotImplementedError
+
+    async def send(self, topic: str, message: Dict):
+        """
+        Send a message, suspending (not blocking the event loop) until it is delivered
+        :param topic: Topic to send message to
+        :param message: Message to be sent, an id is added if missing
+        :return: Broker specific delivery result
+        """
+        return await self.wrap_future(self.broker.send_message(topic, message, block=False))
+
+    async def send_many(self, topic: str, messages: Iterable[Dict]) -> List:
+        """
+        Send messages together, letting the producer client batch them, and wait for all to be delivered
+        :param topic: Topic to send messages to
+        :param messages: Messages to be sent
+        :return: Delivery result of each message, or the exception raised if its delivery failed
+        """
+        futures = [self.wrap_future(self.broker.send_message(topic, message, block=False)) for message in messages]
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    async def flush(self, timeout: float = None) -> None:
+        """
+        Wait until every message sent has been delivered or has failed
+        :param timeout: Maximum time (seconds) to wait, None = no limit
+        """
+        await asyncio.to_thread(self.broker.flush, timeout)
+
+    @abstractmethod
+    def consume_batches(self, sub_name, max_messages=100, max_wait=1., timeout=None):
+        raise NotImplementedError
+
+    async def consume(self, sub_name: str, max_messages: int = 100, max_wait: float = 1.,
+                      timeout: float = None) -> AsyncIterator[Dict]:
+        """
+        Consume messages one at a time, acknowledged in batches once every message of a batch has been handled
+        :param sub_name: Subscriber to consume
+        :param max_messages: Maximum number of messages pulled at once
+        :param max_wait: Maximum time (seconds) to wait for messages, available messages are returned straight away
+        :param timeout: Stop after this many seconds without messages, None = consume indefinitely
+        :return: Asynchronous generator of decoded messages
+        """
+        async for messages in self.consume_batches(sub_name, max_messages, max_wait, timeout):
+            for message in messages:
+                yield message
+
+    async def close(self) -> None:
+        self.broker.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+class AsyncPubsubBroker(AsyncMessageBroker):
+
+    name = "pubsub"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Created on first use, as the asynchronous client is bound to the running event loop
+        self.subscriber = None
+
+    def wrap_future(self, future) -> asyncio.Future:
+        # Pub/Sub futures are concurrent.futures futures, completed by the publisher's own thread
+        return asyncio.wrap_future(future)
+
+    async def consume_batches(self, sub_name: str, max_messages: int = 100, max_wait: float = 1.,
+                              timeout: float = None) -> AsyncIterator[List[Dict]]:
+        """
+        Pull batches of messages with the asynchronous subscriber client, acknowledging each batch only once the loop
+        body handling it has finished
+        :param sub_name: Subscriber to pull from
+        :param max_messages: Maximum number of messages in a batch
+        :param max_wait: Maximum time (seconds) to wait for messages, available messages are returned straight away
+        :param timeout: Stop after this many seconds without messages, None = pull indefinitely
+        :return: Asynchronous generator of decoded message batches
+        """
+        from google.api_core.exceptions import DeadlineExceeded
+        from google.pubsub_v1 import SubscriberAsyncClient
+
+        if self.subscriber is None:
+            self.subscriber = SubscriberAsyncClient()
+
+        sub_path = self.broker.get_subscriber_path(sub_name)
+        loop = asyncio.get_running_loop()
+        print(f"Beginning asynchronous consumption of subscriber: {sub_name}")
+
+        last_message = loop.time()
+        while timeout is None or loop.time() - last_message < timeout:
+            try:
+                response = await self.subscriber.pull(
+                    request={'subscription': sub_path, 'max_messages': max_messages}, timeout=max_wait
+                )
+            except DeadlineExceeded:
+                continue
+
+            received = response.received_messages
+            if not received:
+                continue
+
+            yield [self.broker.decode_data(r.message.data, dict(r.message.attributes)) for r in received]
+
+            await self.subscriber.acknowledge(
+                request={'subscription': sub_path, 'ack_ids': [r.ack_id for r in received]}
+            )
+            last_message = loop.time()
+
+    async def close(self) -> None:
+        if self.subscriber is not None:
+            await self.subscriber.transport.close()
+            self.subscriber = None
+
+        await super().close()
+
+
+class KafkaPoller:
+    """
+    Single thread making every call to the consumers of an AsyncKafkaBroker, as KafkaConsumer has no asynchronous
+    interface and must not be used from several threads at once. Consumers waiting for a batch are polled in turn
+    without blocking, and polled records are handed to the event loop that asked for them, so any number of
+    subscriptions share the one thread
+    """
+
+    def __init__(self, rewind: Callable, poll_interval: float = 0.01):
+        """
+        :param rewind: Called with a consumer and records it polled to seek back to them, see KafkaBroker.rewind
+        :param poll_interval: Time (seconds) between rounds of polls in which no consumer had messages
+        """
+        self.rewind = rewind
+        self.poll_interval = poll_interval
+        # Subscriber name to (consumer, max records, deadline, event loop, future) of a batch waited for
+        self._requests: Dict[str, Tuple] = {}
+        self._calls = queue.Queue()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="KafkaPoller", daemon=True)
+        self._thread.start()
+
+    def poll(self, sub_name: str, consumer, max_records: int, max_wait: float) -> asyncio.Future:
+        """
+        :param sub_name: Subscriber polled, with at most one poll outstanding
+        :param consumer: KafkaConsumer of the subscriber
+        :param max_records: Maximum number of records returned
+        :param max_wait: Time (seconds) after which no records are returned, if none have arrived
+        :return: Future of the records polled by topic partition, completed in the calling event loop
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            self._requests[sub_name] = consumer, max_records, time.monotonic() + max_wait, loop, future
+        self._wake.set()
+        return future
+
+    def call(self, func: Callable) -> None:
+        """
+        Run func in the poller thread before any further polls, e.g. to commit or seek a consumer
+        :param func: Function called without arguments, exceptions are printed
+        """
+        self._calls.put(func)
+        self._wake.set()
+
+    def _run(self) -> None:
+
+        while not self._stopped:
+            self._wake.clear()
+            self._run_calls()
+
+            with self._lock:
+                requests = list(self._requests.items())
+
+            polled = False
+            for sub_name, (consumer, max_records, deadline, loop, future) in requests:
+                try:
+                    records = consumer.poll(timeout_ms=0, max_records=max_records)
+                except Exception as e:
+                    self._complete(sub_name, loop, future, consumer, error=e)
+                    continue
+
+                if records or time.monotonic() > deadline:
+                    self._complete(sub_name, loop, future, consumer, records)
+                    polled = polled or bool(records)
+
+            if not polled:
+                self._wake.wait(self.poll_interval)
+
+        # Commits queued before stopping still run
+        self._run_calls()
+
+    def _run_calls(self) -> None:
+
+        while not self._calls.empty():
+            func = self._calls.get()
+            try:
+                func()
+            except Exception as e:
+                print(f"Kafka poller call failed: {e!r}")
+
+    def _complete(self, sub_name: str, loop, future: asyncio.Future, consumer, records: Dict = None,
+                  error: Exception = None) -> None:
+
+        with self._lock:
+            if self._requests.get(sub_name, (None,) * 5)[4] is future:
+                del self._requests[sub_name]
+
+        def complete():
+            if future.done():
+                if records:
+                    # Waiter was cancelled, its records are polled again rather than lost
+                    self.call(lambda: self.rewind(consumer, records))
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(records)
+
+        try:
+            loop.call_soon_threadsafe(complete)
+        except RuntimeError:
+            # Event loop closed
+            pass
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._wake.set()
+        self._thread.join()
+
+
+class AsyncKafkaBroker(AsyncMessageBroker):
+
+    name = "kafka"
+
+    def __init__(self, *args, poll_interval: float = 0.01, **kwargs):
+        """
+        :param args: Positional arguments of KafkaBroker
+        :param poll_interval: Time (seconds) between polls of subscribers with no messages
+        :param kwargs: Keyword arguments of KafkaBroker
+        """
+        super().__init__(*args, **kwargs)
+        self.poll_interval = poll_interval
+        # Started on first consumption, shared by every subscription
+        self.poller = None
+
+    def wrap_future(self, future) -> asyncio.Future:
+        # Kafka futures are completed by the producer's IO thread, results are handed back to the event loop
+        loop = asyncio.get_running_loop()
+        wrapped = loop.create_future()
+
+        def complete(setter, value):
+            if not wrapped.done():
+                setter(value)
+
+        future.add_callback(lambda value: loop.call_soon_threadsafe(complete, wrapped.set_result, value))
+        future.add_errback(lambda exception: loop.call_soon_threadsafe(complete, wrapped.set_exception, exception))
+        return wrapped
+
+    async def consume_batches(self, sub_name: str, max_messages: int = 100, max_wait: float = 1.,
+                              timeout: float = None) -> AsyncIterator[List[Dict]]:
+        """
+        Poll batches of messages through the broker's KafkaPoller, so that polls (which also fetch, send heartbeats and
+        rebalance) never block the event loop, without a thread per subscription. Offsets of each batch are committed
+        only once the loop body handling it has finished. If the loop body raises or leaves the generator, the
+        consumer is rewound to the start of the batch, as by KafkaBroker.consume_batches
+        :param sub_name: Subscriber to poll
+        :param max_messages: Maximum number of messages in a batch
+        :param max_wait: Maximum time (seconds) to wait for messages, available messages are returned straight away
+        :param timeout: Stop after this many seconds without messages, None = poll indefinitely
+        :return: Asynchronous generator of decoded message batches
+        """
+        consumer = self.broker.subscriptions[sub_name]
+        if self.poller is None:
+            self.poller = KafkaPoller(self.broker.rewind, self.poll_interval)
+
+        loop = asyncio.get_running_loop()
+        print(f"Beginning asynchronous consumption of subscriber: {sub_name}")
+
+        last_message = loop.time()
+        while timeout is None or loop.time() - last_message < timeout:
+            records = await self.poller.poll(sub_name, consumer, max_messages, max_wait)
+            if not records:
+                continue
+
+            try:
+                yield [self.broker.decode_record(message) for partition in records.values() for message in partition]
+            except BaseException:
+                self.poller.call(lambda: self.broker.rewind(consumer, records))
+                raise
+
+            self.poller.call(consumer.commit_async)
+            last_message = loop.time()
+
+    async def close(self) -> None:
+        # Stopped before the consumers are closed, after running any commits still queued
+        if self.poller is not None:
+            await asyncio.to_thread(self.poller.stop)
+            self.poller = None
+
+        await super().close()
+
+
+class AsyncLocalBroker(AsyncMessageBroker):
+
+    name = "local"
+
+    def __init__(self, *args, poll_interval: float = LOCAL_POLL_INTERVAL, **kwargs):
+        """
+        :param args: Positional arguments of LocalBroker
+        :param poll_interval: Time (seconds) between pulls of a subscription with no messages
+        :param kwargs: Keyword arguments of LocalBroker
+        """
+        super().__init__(*args, **kwargs)
+        self.poll_interval = poll_interval
+
+    def wrap_future(self, future) -> asyncio.Future:
+        # Local messages are delivered when sent, so the future is already complete
+        return asyncio.wrap_future(future)
+
+    async def consume_batches(self, sub_name: str, max_messages: int = 100, max_wait: float = 1.,
+                              timeout: float = None) -> AsyncIterator[List[Dict]]:
+        """
+        Pull batches of messages without blocking
+        :param sub_name: Subscriber to pull from
+        :param max_messages: Maximum number of messages in a batch
+        :param max_wait: Unused, pulls return straight away and are repeated every poll_interval while no messages
+        are available
+        :param timeout: Stop after this many seconds without messages, None = pull indefinitely
+        :return: Asynchronous generator of decoded message batches
+        """
+        bus = self.broker.bus
+        loop = asyncio.get_running_loop()
+        print(f"Beginning asynchronous consumption of subscriber: {sub_name}")
+
+        last_message = loop.time()
+        while timeout is None or loop.time() - last_message < timeout:
+            messages = bus.pull(sub_name, max_messages, 0)
+            if not messages:
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            if bus.shared:
+                messages = [self.broker.decode_data(data, metadata) for data, metadata in messages]
+
+            yield messages
+            last_message = loop.time()
+
+
+def create_async_broker(name: str, *args, **kwargs) -> AsyncMessageBroker:
+    """
+    :param name: Short name of broker
+    :param args: Positional arguments of the synchronous broker
+    :param kwargs: Keyword arguments of the synchronous broker
+    :return: AsyncMessageBroker concrete class instance
+    """
+    for broker in AsyncMessageBroker.subclasses:
+        if broker.name == name:
+            return broker(*args, **kwargs)
+
+    raise ValueError(f"Unknown broker {name}, must be one of {[b.name for b in AsyncMessageBroker.subclasses]}")
@@ -0,0 +1,95 @@
+import json
+import struct
+import numpy as np
+from typing import Dict
+
+# Message attribute (Pub/Sub) or header (Kafka) holding the content type, messages without it are JSON
+CONTENT_TYPE_KEY = "content-type"
+JSON_CONTENT_TYPE = "application/json"
+IMAGE_CONTENT_TYPE = "application/vnd.unifiedapi.image"
+
+MAGIC = b"IM"
+VERSION = 1
+
+# magic, version, dtype code, number of dimensions, id length, metadata length
+HEADER = struct.Struct("<2sBBBHI")
+
+DTYPE_CODES = {
+    np.dtype(np.uint8): 1,
+    np.dtype(np.int8): 2,
+    np.dtype(np.uint16): 3,
+    np.dtype(np.int16): 4,
+    np.dtype(np.int32): 5,
+    np.dtype(np.float16): 6,
+    np.dtype(np.float32): 7,
+    np.dtype(np.float64): 8,
+}
+CODE_DTYPES = {code: dtype for dtype, code in DTYPE_CODES.items()}
+
+
+def is_image_message(message: Dict, key: str = "image") -> bool:
+    """
+    :param message: Message to be sent
+    :param key: Key of image within message
+    :return: Whether message holds a numpy image that can be sent in binary form
+    """
+    return isinstance(message.get(key), np.ndarray)
+
+
+def encode_image_message(message: Dict, key: str = "image") -> bytes:
+    """
+    Encode a message holding a numpy image as a small header followed by the raw pixel buffer:
+
+        header (HEADER) | shape (uint32 per dimension) | id (utf-8) | metadata (JSON) | pixels (little endian, C order)
+
+    Metadata holds any message fields other than id and the image
+    :param message: Message with an id and a numpy image
+    :param key: Key of image within message
+    :return: Encoded message
+    """
+    image = np.asarray(message[key])
+    dtype = image.dtype.newbyteorder("<") if image.dtype.byteorder == ">" else image.dtype
+    if dtype not in DTYPE_CODES:
+        raise TypeError(f"Unsupported image dtype {image.dtype}")
+
+    message_id = str(message.get('id', "")).encode("utf-8")
+    metadata = {k: v for k, v in message.items() if k not in ('id', key)}
+    metadata = json.dumps(metadata).encode("utf-8") if metadata else b""
+
+    header = HEADER.pack(MAGIC, VERSION, DTYPE_CODES[dtype], image.ndim, len(message_id), len(metadata))
+    shape = struct.pack(f"<{image.ndim}I", *image.shape)
+    pixels = np.ascontiguousarray(image, dtype=dtype.newbyteorder("<")).tobytes()
+
+    return b"".join((header, shape, message_id, metadata, pixels))
+
+
+def decode_image_message(data: bytes, key: str = "image") -> Dict:
+    """
+    Decode a message encoded by encode_image_message. The image is a read only view of data, no pixels are copied
+    :param data: Encoded message
+    :param key: Key to store image under in decoded message
+    :return: Decoded message
+    """
+    magic, version, dtype_code, ndim, id_length, metadata_length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Data is not an image message")
+    if version != VERSION:
+        raise ValueError(f"Unsupported image message version {version}, expected {VERSION}")
+
+    offset = HEADER.size
+    shape = struct.unpack_from(f"<{ndim}I", data, offset)
+    offset += 4 * ndim
+
+    message = {}
+    if id_length:
+        message['id'] = bytes(data[offset:offset + id_length]).decode("utf-8")
+    offset += id_length
+
+    if metadata_length:
+        message.update(json.loads(bytes(data[offset:offset + metadata_length]).decode("utf-8")))
+    offset += metadata_length
+
+    dtype = CODE_DTYPES[dtype_code].newbyteorder("<")
+    message[key] = np.frombuffer(data, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+    return message
@@ -0,0 +1,197 @@
+import multiprocessing as mp
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, List
+from kafka import KafkaConsumer, ConsumerRebalanceListener
+from UnifiedAPI.serializers import Serializer
+
+
+class RebalanceReporter(ConsumerRebalanceListener):
+    """
+    Prints the partitions a worker gains and loses as workers join or leave its group
+    """
+
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id
+
+    def on_partitions_revoked(self, revoked):
+        if revoked:
+            print(f"Worker {self.worker_id} released partitions {sorted(tp.partition for tp in revoked)}")
+
+    def on_partitions_assigned(self, assigned):
+        print(f"Worker {self.worker_id} assigned partitions {sorted(tp.partition for tp in assigned)}")
+
+
+def report_partitions(worker_id: int, consumer: KafkaConsumer, counts: Counter, elapsed: float) -> None:
+    """
+    Print messages handled, throughput and lag of each partition assigned to a worker
+    :param worker_id: Index of worker within its group
+    :param consumer: Worker's consumer
+    :param counts: Messages handled by partition since the last report
+    :param elapsed: Time (seconds) since the last report
+    """
+    assigned = sorted(consumer.assignment(), key=lambda tp: tp.partition)
+    end_offsets = consumer.end_offsets(assigned) if assigned else {}
+
+    for tp in assigned:
+        lag = end_offsets[tp] - consumer.position(tp)
+        print(f"Worker {worker_id} partition {tp.partition}: {counts[tp]} messages, "
+              f"{counts[tp] / elapsed:.1f} msg/s, lag {lag}")
+
+
+def consume_partitions(worker_id: int, host: str, topic: str, group: str, callback: Callable[[Dict], None],
+                       stop, max_messages: int = 100, max_wait: float = 1., timeout: float = None,
+                       report_interval: float = None, consumer_kwargs: Dict = None) -> None:
+    """
+    Worker loop of a KafkaWorkerGroup: join the group, then pass every message of the partitions assigned to this
+    worker to callback. Offsets are committed once each polled batch has been handled
+    :param worker_id: Index of worker within its group
+    :param host: Kafka bootstrap server
+    :param topic: Topic consumed by the group
+    :param group: Consumer group id, shared by every worker
+    :param callback: Called with each decoded message
+    :param stop: Threading or multiprocessing event, set to stop this worker
+    :param max_messages: Maximum number of messages polled at once
+    :param max_wait: Maximum time (seconds) to wait for messages in each poll
+    :param timeout: Stop after this many seconds without messages, None = consume until stopped
+    :param report_interval: Time (seconds) between partition reports, None = report only on stop
+    :param consumer_kwargs: Passed to KafkaConsumer
+    :return: None
+    """
+    consumer = KafkaConsumer(bootstrap_servers=[host], group_id=group, client_id=f"{group}-{worker_id}",
+                             enable_auto_commit=False, **(consumer_kwargs or {}))
+    consumer.subscribe([topic], listener=RebalanceReporter(worker_id))
+
+    counts = Counter()
+    last_report = last_message = time.monotonic()
+
+    try:
+        while not stop.is_set() and (timeout is None or time.monotonic() - last_message < timeout):
+            records = consumer.poll(timeout_ms=max_wait * 1000, max_records=max_messages)
+
+            for tp, messages in records.items():
+                for message in messages:
+                    metadata = {key: value.decode("utf-8") for key, value in message.headers or []}
+                    callback(Serializer.decode(message.value, metadata))
+                counts[tp] += len(messages)
+
+            if records:
+                consumer.commit()
+                last_message = time.monotonic()
+
+            if report_interval is not None and time.monotonic() - last_report > report_interval:
+                report_partitions(worker_id, consumer, counts, time.monotonic() - last_report)
+                counts.clear()
+                last_report = time.monotonic()
+
+        report_partitions(worker_id, consumer, counts, time.monotonic() - last_report)
+    finally:
+        # Leaving the group straight away, so its partitions are rebalanced to the remaining workers
+        consumer.close()
+
+
+class KafkaWorkerGroup:
+    """
+    Consumers of one topic in the same group, as threads or processes, each owning a share of the topic's partitions
+    and calling the callback in parallel. Kafka rebalances partitions whenever a worker joins or leaves, so the group
+    can be resized while running. A topic needs at least as many partitions as workers for every worker to be used
+    """
+
+    def __init__(self, host: str, topic: str, group: str, callback: Callable[[Dict], None], num_workers: int,
+                 processes: bool = False, max_messages: int = 100, timeout: float = None,
+                 report_interval: float = 60., consumer_kwargs: Dict = None):
+        """
+        :param host: Kafka bootstrap server
+        :param topic: Topic to consume
+        :param group: Consumer group id
+        :param callback: Called with each decoded message. Must be picklable (e.g. a module level function) for
+        processes
+        :param num_workers: Number of workers started
+        :param processes: Run workers as processes, using more than one core for the callback, otherwise threads
+        :param max_messages: Maximum number of messages polled at once by each worker
+        :param timeout: Workers stop after this many seconds without messages, None = consume until stopped
+        :param report_interval: Time (seconds) between partition reports, None = report only on stop
+        :param consumer_kwargs: Passed to each KafkaConsumer
+        """
+        if num_workers < 1:
+            raise ValueError(f"num_workers must be at least 1, got {num_workers}")
+
+        self.host = host
+        self.topic = topic
+        self.group = group
+        self.callback = callback
+        self.num_workers = num_workers
+        self.processes = processes
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.report_interval = report_interval
+        self.consumer_kwargs = consumer_kwargs or {}
+
+        self._ctx = mp.get_context("spawn")
+        self._workers: List = []
+        self._stops: List = []
+        self._next_id = 0
+
+    def add_worker(self) -> None:
+        """
+        Start one more worker, taking a share of the partitions from the others
+        """
+        stop = self._ctx.Event() if self.processes else threading.Event()
+        args = (self._next_id, self.host, self.topic, self.group, self.callback, stop)
+        kwargs = {'max_messages': self.max_messages, 'timeout': self.timeout,
+                  'report_interval': self.report_interval, 'consumer_kwargs': self.consumer_kwargs}
+
+        if self.processes:
+            worker = self._ctx.Process(target=consume_partitions, args=args, kwargs=kwargs, daemon=True)
+        else:
+            worker = threading.Thread(target=consume_partitions, args=args, kwargs=kwargs, daemon=True)
+
+        worker.start()
+        self._workers.append(worker)
+        self._stops.append(stop)
+        self._next_id += 1
+
+    def remove_worker(self, timeout: float = None) -> None:
+        """
+        Stop the most recently started worker, handing its partitions back to the others
+        :param timeout: Maximum time (seconds) to wait for the worker to finish its current batch
+        """
+        if not self._workers:
+            raise ValueError("No workers running")
+
+        self._stops.pop().set()
+        self._workers.pop().join(timeout)
+
+    def start(self) -> "KafkaWorkerGroup":
+        for _ in range(self.num_workers):
+            self.add_worker()
+
+        print(f"Started {self.num_workers} {'process' if self.processes else 'thread'} consumers of topic: "
+              f"{self.topic} in group: {self.group}")
+        return self
+
+    def join(self) -> None:
+        """
+        Block until every worker has stopped, i.e. after timeout without messages
+        """
+        for worker in list(self._workers):
+            worker.join()
+
+    def stop(self, timeout: float = None) -> None:
+        """
+        Stop all workers once their current batches have been handled
+        :param timeout: Maximum time (seconds) to wait for each worker
+        """
+        while self._workers:
+            self.remove_worker(timeout)
+
+    @property
+    def size(self) -> int:
+        return len(self._workers)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,303 @@
+import os
+import time
+from typing import Callable, Dict, Iterator, List
+from kafka import KafkaProducer, KafkaConsumer, KafkaAdminClient
+from kafka.errors import TopicAlreadyExistsError
+from kafka.admin import NewTopic, NewPartitions
+from kafka.producer.future import FutureRecordMetadata
+from UnifiedAPI.adapter import FlowControl, MessageBroker
+from UnifiedAPI.consumer_group import KafkaWorkerGroup
+from UnifiedAPI.serializers import Serializer
+from UnifiedAPI.settings import LINGER_MS, BATCH_BYTES, PARTITIONS_PER_WORKER
+
+
+class KafkaBroker(MessageBroker):
+
+    name = "kafka"
+
+    def __init__(self, project=None, host=os.environ["KAFKA_HOST"], serializer: Serializer = None,
+                 linger_ms: float = LINGER_MS, batch_bytes: int = BATCH_BYTES):
+        """
+        :param project: Unused, kept for a common constructor with other brokers
+        :param host: Kafka bootstrap server
+        :param serializer: Serializer used to encode sent messages, JSON by default
+        :param linger_ms: Maximum time (milliseconds) a message waits for others to be sent in the same batch
+        :param batch_bytes: Maximum size (bytes) of a batch sent to one partition
+        """
+        super().__init__(serializer)
+        self.project = project
+        self.host = host
+        self.producer_config = {'linger_ms': linger_ms, 'batch_size': batch_bytes}
+        # Consumers by subscriber name, owned by this broker instance, and the arguments each was created with
+        self.subscriptions = dict()
+        self.subscription_configs = dict()
+
+    @property
+    def subscriber(self) -> KafkaConsumer:
+        return self.get_client("subscriber", lambda: KafkaConsumer(bootstrap_servers=[self.host]))
+
+    @property
+    def producer(self) -> KafkaProducer:
+        # KafkaProducer is thread safe, one instance is shared by all threads sending messages
+        return self.get_client("producer", lambda: KafkaProducer(bootstrap_servers=[self.host],
+                                                                 **self.producer_config))
+
+    @property
+    def admin(self) -> KafkaAdminClient:
+        return self.get_client("admin", lambda: KafkaAdminClient(bootstrap_servers=[self.host]))
+
+    def create_topic(self, topic_name: str, num_partitions: int = None, replication_factor: int = 1,
+                     workers: int = None, partitions_per_worker: int = PARTITIONS_PER_WORKER):
+        """
+        Create a topic. When num_partitions or workers is given, partitions are also added to an existing topic with
+        fewer than requested. Partitions cannot be removed, and adding them changes which partition each key maps to
+        :param topic_name: Topic to create
+        :param num_partitions: Number of partitions, sized for workers if None
+        :param replication_factor: Number of copies of each partition
+        :param workers: Number of consumers planned to read the topic in parallel, each needing its own partition. If
+        neither this nor num_partitions is given, a new topic has one partition and an existing topic is left as is
+        :param partitions_per_worker: Partitions per planned worker, spare partitions allow adding workers later
+        """
+        resize = num_partitions is not None or workers is not None
+        if num_partitions is None:
+            num_partitions = workers * partitions_per_worker if workers is not None else 1
+
+        new_topic = NewTopic(topic_name, num_partitions, replication_factor)
+        try:
+            test = self.admin.create_topics([new_topic])
+            print(test)
+        except TopicAlreadyExistsError:
+            print(f"Topic: {topic_name} already exists")
+            if not resize:
+                return
+
+            partitions = self.subscriber.partitions_for_topic(topic_name) or set()
+            if len(partitions) < num_partitions:
+                self.admin.create_partitions({topic_name: NewPartitions(num_partitions)})
+                print(f"Topic: {topic_name} increased from {len(partitions)} to {num_partitions} partitions")
+
+    def delete_topic(self, topic: str):
+        # TODO: This is breaking the connection, docs say AdminClient is early stages/unstable
+        # admin = KafkaAdminClient(bootstrap_servers=[self.host])
+        # admin.delete_topics([topic])
+        pass
+
+    def create_subscriber(self, name, topic, group="mygroup", enable_auto_commit=False, **kwargs):
+        """
+        :param name: Name of subscriber
+        :param topic: Topic consumed
+        :param group: Consumer group sharing the topic's partitions
+        :param enable_auto_commit: Commit positions in the background. Off by default, as consume_batches commits each
+        batch once handled, and an automatic commit could mark a failed batch as consumed
+        :param kwargs: Passed to KafkaConsumer
+        """
+
+        consumer = KafkaConsumer(
+            topic,
+            bootstrap_servers=[self.host],
+            group_id=group,
+            client_id=name,
+            enable_auto_commit=enable_auto_commit,
+            **kwargs,
+        )
+
+        self.subscriptions[name] = consumer
+        self.subscription_configs[name] = {'topic': topic, 'group': group, 'consumer_kwargs': kwargs}
+
+    def delete_subscriber(self, name):
+
+        if self.subscriptions and name in self.subscriptions.keys():
+            self.subscriptions.pop(name).close()
+            self.subscription_configs.pop(name, None)
+        else:
+            print(f"Subscriber {name} does not exist")
+
+    def consume(self, sub_name, callback=print, timeout: int = None, flow_control: FlowControl = None):
+        """
+        Pass messages to callback one at a time, polling at most flow_control.max_messages (max_poll_records) at once
+        :param sub_name: Subscriber to consume
+        :param callback: Called with each decoded message
+        :param timeout: Stop after this many seconds without messages, None = consume indefinitely
+        :param flow_control: Limits on messages polled but not yet handled, defaults from settings
+        """
+        flow_control = flow_control or FlowControl()
+        max_messages = flow_control.max_messages or self.subscriptions[sub_name].config['max_poll_records']
+
+        for messages in self.consume_batches(sub_name, max_messages, timeout=timeout, flow_control=flow_control):
+            for message in messages:
+                try:
+                    callback(message)
+                finally:
+                    flow_control.release()
+
+    def worker_group(self, sub_name: str, callback: Callable[[Dict], None], num_workers: int,
+                     processes: bool = False, timeout: float = None, report_interval: float = 60.) -> KafkaWorkerGroup:
+        """
+        Group of consumers sharing the partitions of a subscriber's topic, each calling callback in parallel
+        :param sub_name: Subscriber whose topic, group and consumer arguments are used by every worker
+        :param callback: Called with each decoded message, must be picklable for processes
+        :param num_workers: Number of workers, at most the number of partitions of the topic are used
+        :param processes: Run workers as processes, otherwise threads
+        :param timeout: Workers stop after this many seconds without messages, None = consume until stopped
+        :param report_interval: Time (seconds) between per partition throughput and lag reports
+        :return: Worker group, not yet started
+        """
+        config = self.subscription_configs[sub_name]
+        return KafkaWorkerGroup(self.host, config['topic'], config['group'], callback, num_workers,
+                                processes=processes, timeout=timeout, report_interval=report_interval,
+                                consumer_kwargs=config['consumer_kwargs'])
+
+    def consume_parallel(self, sub_name: str, callback: Callable[[Dict], None] = print, num_workers: int = 2,
+                         processes: bool = False, timeout: float = None, report_interval: float = 60.) -> None:
+        """
+        Consume a subscriber with a group of workers, blocking until they stop
+        :param sub_name: Subscriber to consume
+        :param callback: Called with each decoded message, must be picklable for processes
+        :param num_workers: Number of workers, at most the number of partitions of the topic are used
+        :param processes: Run workers as processes, otherwise threads
+        :param timeout: Stop after this many seconds without messages, None = consume indefinitely
+        :param report_interval: Time (seconds) between per partition throughput and lag reports
+        """
+        # The subscriber's own consumer would otherwise hold on to a share of the partitions
+        self.subscriptions[sub_name].unsubscribe()
+
+        group = self.worker_group(sub_name, callback, num_workers, processes, timeout, report_interval)
+        print(f"Beginning parallel consumption of subscriber: {sub_name}")
+        with group:
+            try:
+                group.join()
+            except KeyboardInterrupt:
+                pass
+
+    def consume_batches(self, sub_name: str, max_messages: int = 100, max_wait: float = 1.,
+                        timeout: float = None, flow_control: FlowControl = None) -> Iterator[List[Dict]]:
+        """
+        Poll batches of messages, committing offsets of each batch only once the loop body handling it has finished.
+        If the loop body raises, or leaves the generator (e.g. by break), the consumer is rewound to the start of the
+        batch, so that the batch is polled again by the next consume_batches rather than skipped and committed past
+        :param sub_name: Subscriber to poll
+        :param max_messages: Maximum number of messages in a batch
+        :param max_wait: Maximum time (seconds) to wait for messages, available messages are returned straight away
+        :param timeout: Stop after this many seconds without messages, None = poll indefinitely
+        :param flow_control: Acquires every message polled, which the caller releases once handled. Partitions are
+        paused while it is full. None = no limit
+        :return: Generator of decoded message batches
+        """
+        consumer = self.subscriptions[sub_name]
+        print(f"Beginning batch consumption of subscriber: {sub_name}")
+
+        last_message = time.monotonic()
+        while timeout is None or time.monotonic() - last_message < timeout:
+            if flow_control is not None:
+                if flow_control.full:
+                    self.wait_for_capacity(sub_name, flow_control, max_wait)
+                    last_message = time.monotonic()
+                batch_size = flow_control.limit(max_messages)
+            else:
+                batch_size = max_messages
+
+            records = consumer.poll(timeout_ms=max_wait * 1000, max_records=batch_size)
+            if not records:
+                continue
+
+            if flow_control is not None:
+                flow_control.acquire(sum(len(messages) for messages in records.values()),
+                                     sum(m.serialized_value_size for messages in records.values() for m in messages))
+
+            for tp, messages in records.items():
+                # High watermark known from the fetch, so lag costs no request to the broker
+                highwater = consumer.highwater(tp)
+                if highwater is not None:
+                    self.consumer_lag(sub_name, partition=str(tp.partition)).set(highwater - messages[-1].offset - 1)
+
+            batch = [self.decode_record(message) for partition in records.values() for message in partition]
+            self.consumed_total.inc(len(batch))
+            try:
+                yield batch
+            except BaseException:
+                self.rewind(consumer, records)
+                raise
+
+            consumer.commit()
+            last_message = time.monotonic()
+
+    @staticmethod
+    def rewind(consumer: KafkaConsumer, records: Dict) -> None:
+        """
+        Seek each partition back to the first record polled from it, skipping partitions lost to a rebalance, whose
+        new owner resumes from the last committed offset
+        :param consumer: Consumer the records were polled by
+        :param records: Records by topic partition, as returned by poll
+        """
+        assigned = consumer.assignment()
+        for tp, messages in records.items():
+            if tp in assigned:
+                consumer.seek(tp, messages[0].offset)
+
+    def wait_for_capacity(self, sub_name: str, flow_control: FlowControl, max_wait: float = 1.) -> None:
+        """
+        Pause the subscriber's partitions until flow_control allows messages to be polled. The consumer keeps polling
+        while paused, so that it is not removed from its group for exceeding max_poll_interval_ms
+        :param sub_name: Subscriber waiting
+        :param flow_control: Flow control of the subscriber's consumer
+        :param max_wait: Time (seconds) between polls while paused
+        """
+        consumer = self.subscriptions[sub_name]
+        consumer.pause(*consumer.assignment())
+        try:
+            while not flow_control.wait(max_wait):
+                # Partitions assigned by a rebalance while waiting are not paused, any records they return are
+                # rewound and the partitions paused, so nothing is skipped
+                for tp, messages in consumer.poll(timeout_ms=0).items():
+                    consumer.seek(tp, messages[0].offset)
+                    consumer.pause(tp)
+        finally:
+            consumer.resume(*consumer.paused())
+
+    def send_message(self, topic: str, message: Dict, block: bool = False) -> FutureRecordMetadata:
+        """
+        :param topic: Topic to send message to
+        :param message: Message to be sent, an id is added if missing
+        :param block: Wait for the message to be delivered, otherwise (the default, as Kafka sends have never blocked)
+        return straight away and report delivery from a callback
+        :return: Future of the sent message
+        """
+        message = self.add_id(message)
+        encoded_message, metadata = self.encode_message(message)
+        headers = [(key, value.encode("utf-8")) for key, value in metadata.items()]
+
+        sent = time.perf_counter()
+        future = self.producer.send(topic, value=encoded_message, headers=headers)
+        future.add_callback(lambda _: self.send_success(message['id'], topic, sent))
+        future.add_errback(lambda exception: self.send_failure(message['id'], topic, exception))
+
+        if block:
+            self.wait_for_future(future)
+
+        return future
+
+    def flush(self, timeout: float = None) -> None:
+        """
+        Block until every message sent without blocking has been delivered or has failed
+        :param timeout: Maximum time (seconds) to wait, None = no limit
+        """
+        self.producer.flush(timeout=timeout)
+
+    @staticmethod
+    def wait_for_future(future: FutureRecordMetadata, timeout: float = None):
+        return future.get(timeout=timeout)
+
+    @staticmethod
+    def decode_record(message) -> Dict:
+        metadata = {key: value.decode("utf-8") for key, value in message.headers or []}
+        return MessageBroker.decode_data(message.value, metadata)
+
+    @staticmethod
+    def broker_callback(message, nested_callback=print) -> None:
+        nested_callback(KafkaBroker.decode_record(message))
+
+    def close(self) -> None:
+        super().close()
+        while self.subscriptions:
+            _, consumer = self.subscriptions.popitem()
+            consumer.close()
@@ -0,0 +1,535 @@
+import fcntl
+import json
+import mmap
+import os
+import pathlib
+import queue
+import shutil
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, Iterator, List, Tuple
+from UnifiedAPI.adapter import FlowControl, MessageBroker
+from UnifiedAPI.serializers import Serializer
+from UnifiedAPI.settings import LOCAL_DIR, LOCAL_RING_BYTES, LOCAL_POLL_INTERVAL
+
+
+class SharedRing:
+    """
+    Bounded queue of variable size messages in a memory mapped file, shared by any processes opening the same path.
+    Placed on a RAM backed filesystem (/dev/shm) the file is shared memory. Every access holds an exclusive file lock,
+    so any number of processes may put and get
+    """
+
+    # capacity, head (total bytes written), tail (total bytes read)
+    HEADER = struct.Struct("<QQQ")
+    # data length, metadata length
+    RECORD = struct.Struct("<II")
+
+    def __init__(self, path: pathlib.Path, capacity: int = None):
+        """
+        :param path: Ring file
+        :param capacity: Size (bytes) of a new ring, the existing file at path is opened if None
+        """
+        self.path = pathlib.Path(path)
+
+        if capacity is not None:
+            with open(self.path, "wb") as f:
+                f.truncate(self.HEADER.size + capacity)
+                f.write(self.HEADER.pack(capacity, 0, 0))
+
+        self.file = open(self.path, "r+b")
+        # Identifies the file opened, a ring recreated at the same path is a different file
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.buffer = mmap.mmap(self.file.fileno(), 0)
+        self.capacity = self.HEADER.unpack_from(self.buffer)[0]
+        # File locks do not exclude threads of the same process sharing the file, so those use a thread lock
+        self.thread_lock = threading.Lock()
+
+    def _lock(self):
+        self.thread_lock.acquire()
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+    def _unlock(self):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+    def _write(self, position: int, data: bytes) -> None:
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        offset = self.HEADER.size
+        self.buffer[offset + start:offset + start + first] = data[:first]
+        if first < len(data):
+            self.buffer[offset:offset + len(data) - first] = data[first:]
+
+    def _read(self, position: int, length: int) -> bytes:
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        offset = self.HEADER.size
+        data = self.buffer[offset + start:offset + start + first]
+        if first < length:
+            data += self.buffer[offset:offset + length - first]
+        return data
+
+    def put(self, data: bytes, metadata: bytes = b"") -> bool:
+        """
+        :param data: Encoded message
+        :param metadata: Encoded message metadata
+        :return: Whether the message was written, False if the ring is too full to hold it
+        """
+        record = self.RECORD.pack(len(data), len(metadata))
+        size = len(record) + len(metadata) + len(data)
+        if size > self.capacity:
+            raise ValueError(f"Message of {size} bytes is larger than ring capacity of {self.capacity} bytes")
+
+        self._lock()
+        try:
+            _, head, tail = self.HEADER.unpack_from(self.buffer)
+            if self.capacity - (head - tail) < size:
+                return False
+
+            self._write(head, record + metadata + data)
+            self.HEADER.pack_into(self.buffer, 0, self.capacity, head + size, tail)
+            return True
+        finally:
+            self._unlock()
+
+    def get(self, max_messages: int) -> List[Tuple[bytes, bytes]]:
+        """
+        :param max_messages: Maximum number of messages read
+        :return: Messages available now as (data, metadata), oldest first. Empty if none are available
+        """
+        self._lock()
+        try:
+            _, head, tail = self.HEADER.unpack_from(self.buffer)
+
+            messages = []
+            while tail < head and len(messages) < max_messages:
+                data_length, metadata_length = self.RECORD.unpack(self._read(tail, self.RECORD.size))
+                tail += self.RECORD.size
+                metadata = self._read(tail, metadata_length)
+                tail += metadata_length
+                messages.append((self._read(tail, data_length), metadata))
+                tail += data_length
+
+            self.HEADER.pack_into(self.buffer, 0, self.capacity, head, tail)
+            return messages
+        finally:
+            self._unlock()
+
+    def close(self) -> None:
+        self.buffer.close()
+        self.file.close()
+
+
+class MemoryBus:
+    """
+    Topics and subscriptions of a single process. Messages are handed to subscribers as python objects, without being
+    serialized. Each subscription receives a shallow copy of every message sent to its topic
+    """
+
+    shared = False
+
+    def __init__(self):
+        # Subscription queues by topic, then by subscription name
+        self.topics: Dict[str, Dict[str, queue.Queue]] = {}
+        self.subscriptions: Dict[str, queue.Queue] = {}
+        self.lock = threading.Lock()
+
+    def create_topic(self, topic: str) -> bool:
+        """
+        :return: Whether the topic was created, False if it already exists
+        """
+        with self.lock:
+            if topic in self.topics:
+                return False
+            self.topics[topic] = {}
+            return True
+
+    def delete_topic(self, topic: str) -> bool:
+        """
+        :return: Whether the topic was deleted, False if it does not exist
+        """
+        with self.lock:
+            subscriptions = self.topics.pop(topic, None)
+            for name in subscriptions or {}:
+                self.subscriptions.pop(name, None)
+            return subscriptions is not None
+
+    def create_subscription(self, name: str, topic: str) -> None:
+        with self.lock:
+            if topic not in self.topics:
+                raise KeyError(f"Topic: {topic} does not exist")
+
+            self._remove_subscription(name)
+            self.topics[topic][name] = self.subscriptions[name] = queue.Queue()
+
+    def delete_subscription(self, name: str) -> bool:
+        """
+        :return: Whether the subscription was deleted, False if it does not exist
+        """
+        with self.lock:
+            return self._remove_subscription(name)
+
+    def _remove_subscription(self, name: str) -> bool:
+        if self.subscriptions.pop(name, None) is None:
+            return False
+        for subscriptions in self.topics.values():
+            subscriptions.pop(name, None)
+        return True
+
+    def publish(self, topic: str, message: Dict) -> None:
+        """
+        :param topic: Topic to send message to, messages sent to a topic without subscriptions are dropped
+        :param message: Message handed to every subscription of the topic
+        """
+        subscriptions = self.topics.get(topic)
+        if subscriptions is None:
+            raise KeyError(f"Topic: {topic} does not exist")
+
+        for subscription in list(subscriptions.values()):
+            subscription.put(dict(message))
+
+    def pull(self, name: str, max_messages: int, max_wait: float) -> List[Dict]:
+        """
+        :param name: Subscription to pull from
+        :param max_messages: Maximum number of messages returned
+        :param max_wait: Maximum time (seconds) to wait for a first message
+        :return: Messages, empty if none arrived within max_wait
+        """
+        subscription = self.subscriptions[name]
+        try:
+            messages = [subscription.get(timeout=max_wait)]
+        except queue.Empty:
+            return []
+
+        while len(messages) < max_messages:
+            try:
+                messages.append(subscription.get_nowait())
+            except queue.Empty:
+                break
+
+        return messages
+
+    def close(self) -> None:
+        pass
+
+
+class SharedMemoryBus:
+    """
+    Topics and subscriptions shared by every process on the host using the same root directory. Each topic is a
+    directory, and each subscription a SharedRing file within it, so that topics and subscriptions created by one
+    process are found by the others. Messages are serialized into the rings
+    """
+
+    shared = True
+
+    def __init__(self, root: pathlib.Path, ring_bytes: int, poll_interval: float = 0.001):
+        """
+        :param root: Directory holding topics, on a RAM backed filesystem for rings to be held in memory
+        :param ring_bytes: Capacity (bytes) of each subscription
+        :param poll_interval: Time (seconds) between checks of a full or empty ring
+        """
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.ring_bytes = ring_bytes
+        self.poll_interval = poll_interval
+
+        # Open rings by path, ring paths by subscription name, and the rings of each topic as of the topic
+        # directory's modification time
+        self.rings: Dict[pathlib.Path, SharedRing] = {}
+        self.subscription_paths: Dict[str, pathlib.Path] = {}
+        self.topic_rings: Dict[str, Tuple[int, List[SharedRing]]] = {}
+        self.lock = threading.Lock()
+
+    def topic_path(self, topic: str) -> pathlib.Path:
+        return self.root.joinpath(topic)
+
+    def subscription_path(self, name: str) -> pathlib.Path:
+        path = self.subscription_paths.get(name)
+        if path is None or not path.exists():
+            paths = list(self.root.glob(f"*/{name}.ring"))
+            if not paths:
+                raise KeyError(f"Subscription: {name} does not exist")
+            path = self.subscription_paths[name] = paths[0]
+        return path
+
+    def ring(self, path: pathlib.Path) -> SharedRing:
+        """
+        :return: Ring open at path, reopened if the subscription has been recreated (by any process) since it was opened
+        :raises FileNotFoundError: If the subscription has been deleted
+        """
+        inode = path.stat().st_ino
+        with self.lock:
+            ring = self.rings.get(path)
+            if ring is None or ring.inode != inode:
+                # A replaced ring is not closed here, as another thread may still be using it. It is closed once
+                # no longer referenced
+                ring = self.rings[path] = SharedRing(path)
+            return ring
+
+    def create_topic(self, topic: str) -> bool:
+        try:
+            self.topic_path(topic).mkdir()
+            return True
+        except FileExistsError:
+            return False
+
+    def delete_topic(self, topic: str) -> bool:
+        path = self.topic_path(topic)
+        if not path.is_dir():
+            return False
+
+        self._close_rings(path)
+        shutil.rmtree(path, ignore_errors=True)
+        return True
+
+    def create_subscription(self, name: str, topic: str) -> None:
+        if not self.topic_path(topic).is_dir():
+            raise KeyError(f"Topic: {topic} does not exist")
+
+        self.delete_subscription(name)
+        # Written under a temporary name, so that publishers never open a partially created ring
+        path = self.topic_path(topic).joinpath(f"{name}.ring")
+        SharedRing(path.with_suffix(".tmp"), self.ring_bytes).close()
+        os.replace(path.with_suffix(".tmp"), path)
+
+    def delete_subscription(self, name: str) -> bool:
+        try:
+            path = self.subscription_path(name)
+        except KeyError:
+            return False
+
+        self._close_rings(path)
+        path.unlink(missing_ok=True)
+        return True
+
+    def _close_rings(self, path: pathlib.Path) -> None:
+        with self.lock:
+            for ring_path in [p for p in self.rings if p == path or path in p.parents]:
+                self.rings.pop(ring_path).close()
+            self.topic_rings.clear()
+
+    def _topic_rings(self, topic: str) -> List[SharedRing]:
+        path = self.topic_path(topic)
+        try:
+            modified = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            raise KeyError(f"Topic: {topic} does not exist")
+
+        # Listing the topic directory only when subscriptions have been added or removed
+        cached = self.topic_rings.get(topic)
+        if cached is None or cached[0] != modified:
+            cached = (modified, [self.ring(p) for p in sorted(path.glob("*.ring"))])
+            self.topic_rings[topic] = cached
+
+        return cached[1]
+
+    def publish(self, topic: str, data: bytes, metadata: Dict[str, str], timeout: float = None) -> None:
+        """
+        :param topic: Topic to send message to, messages sent to a topic without subscriptions are dropped
+        :param data: Encoded message
+        :param metadata: Message metadata
+        :param timeout: Maximum time (seconds) to wait for space in a full subscription, None = no limit
+        """
+        encoded_metadata = json.dumps(metadata).encode("utf-8")
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        for ring in self._topic_rings(topic):
+            while not ring.put(data, encoded_metadata):
+                if deadline is not None and time.monotonic() > deadline:
+                    raise queue.Full(f"Subscription {ring.path.stem} of topic: {topic} is full")
+                time.sleep(self.poll_interval)
+                try:
+                    # Following the subscription if it is recreated while full, e.g. by a restarted subscriber
+                    ring = self.ring(ring.path)
+                except FileNotFoundError:
+                    # Subscription deleted, messages sent to it are dropped
+                    break
+
+    def pull(self, name: str, max_messages: int, max_wait: float) -> List[Tuple[bytes, Dict[str, str]]]:
+        """
+        :param name: Subscription to pull from
+        :param max_messages: Maximum number of messages returned
+        :param max_wait: Maximum time (seconds) to wait for a first message
+        :return: Encoded messages and their metadata, empty if none arrived within max_wait
+        """
+        # Path looked up once per pull, rather than for every poll of an empty ring
+        ring = self.ring(self.subscription_path(name))
+        deadline = time.monotonic() + max_wait
+
+        while True:
+            messages = ring.get(max_messages)
+            if messages or time.monotonic() > deadline:
+                return [(data, json.loads(metadata)) for data, metadata in messages]
+            time.sleep(self.poll_interval)
+
+    def close(self) -> None:
+        with self.lock:
+            for ring in self.rings.values():
+                ring.close()
+            self.rings.clear()
+            self.topic_rings.clear()
+
+
+# Bus shared by every in-process broker, so that brokers created separately in one process see the same topics
+DEFAULT_MEMORY_BUS = MemoryBus()
+
+
+class LocalBroker(MessageBroker):
+    """
+    Broker for a client and model server on the same host, without a network hop. In process, messages are passed
+    between brokers as python objects through queues without being serialized. Shared between processes, messages are
+    serialized into ring buffers in shared memory. Messages are removed from a subscription when pulled, so are not
+    redelivered
+    """
+
+    name = "local"
+
+    def __init__(self, project=None, shared: bool = True, serializer: Serializer = None, root=LOCAL_DIR,
+                 ring_bytes: int = LOCAL_RING_BYTES, send_timeout: float = None):
+        """
+        :param project: Namespace of topics and subscriptions shared between processes
+        :param shared: Share topics with other processes on this host, otherwise only with brokers in this process
+        :param serializer: Serializer used to encode messages shared between processes, JSON by default
+        :param root: Directory holding topics shared between processes
+        :param ring_bytes: Capacity (bytes) of each subscription shared between processes
+        :param send_timeout: Maximum time (seconds) to wait for space in a full shared subscription, None = no limit
+        """
+        super().__init__(serializer)
+        self.project = project
+        self.send_timeout = send_timeout
+        if shared:
+            self.bus = SharedMemoryBus(pathlib.Path(root, project or "default"), ring_bytes, LOCAL_POLL_INTERVAL)
+        else:
+            self.bus = DEFAULT_MEMORY_BUS
+
+    @property
+    def subscriber(self):
+        return self.bus
+
+    @property
+    def producer(self):
+        return self.bus
+
+    def create_topic(self, topic: str):
+        if self.bus.create_topic(topic):
+            print(f"Created topic {topic} in {self.project}")
+        else:
+            print(f"{topic} already exists in {self.project}")
+
+    def delete_topic(self, topic: str):
+        if self.bus.delete_topic(topic):
+            print(f"Topic: {topic} deleted from project: {self.project}")
+        else:
+            print(f"Topic: {topic} does not exist in project: {self.project}")
+
+    def create_subscriber(self, name: str, topic: str):
+        self.bus.create_subscription(name, topic)
+        print(f"Subscription created {name} in {self.project}")
+
+    def delete_subscriber(self, name: str):
+        if not self.bus.delete_subscription(name):
+            print(f"Subscriber {name} does not exist")
+
+    def send_message(self, topic: str, message: Dict, block: bool = True) -> Future:
+        """
+        :param topic: Topic to send message to
+        :param message: Message to be sent, an id is added if missing
+        :param block: Raise delivery errors, otherwise return them in the future. Messages are delivered before
+        returning either way
+        :return: Completed future of the message id
+        """
+        message = self.add_id(message)
+        future = Future()
+        sent = time.perf_counter()
+
+        try:
+            if self.bus.shared:
+                self.bus.publish(topic, *self.encode_message(message), timeout=self.send_timeout)
+            else:
+                self.bus.publish(topic, message)
+        except Exception as e:
+            if block:
+                raise
+            self.send_failure(message['id'], topic, e)
+            future.set_exception(e)
+            return future
+
+        self.send_success(message['id'], topic, sent)
+        future.set_result(message['id'])
+        return future
+
+    def flush(self, timeout: float = None) -> None:
+        # Messages are delivered when sent, nothing is left in flight
+        pass
+
+    @staticmethod
+    def wait_for_future(future: Future, timeout: float = None):
+        return future.result(timeout=timeout)
+
+    def consume(self, sub_name, callback=print, timeout: int = None, flow_control: FlowControl = None):
+        """
+        :param sub_name: Subscriber to consume
+        :param callback: Called with each decoded message
+        :param timeout: Stop after this many seconds without messages, None = consume indefinitely
+        :param flow_control: Limits on messages pulled but not yet handled, defaults from settings
+        """
+        flow_control = flow_control or FlowControl()
+
+        for messages in self.consume_batches(sub_name, timeout=timeout, flow_control=flow_control):
+            for message in messages:
+                try:
+                    callback(message)
+                finally:
+                    flow_control.release()
+
+    def consume_batches(self, sub_name: str, max_messages: int = 100, max_wait: float = 1.,
+                        timeout: float = None, flow_control: FlowControl = None) -> Iterator[List[Dict]]:
+        """
+        :param sub_name: Subscriber to pull from
+        :param max_messages: Maximum number of messages in a batch
+        :param max_wait: Maximum time (seconds) to wait for messages, available messages are returned straight away
+        :param timeout: Stop after this many seconds without messages, None = pull indefinitely
+        :param flow_control: Acquires every message pulled, which the caller releases once handled. Pulling stops
+        while it is full. Messages of an unshared bus are not serialized, so only count towards max_messages. None =
+        no limit
+        :return: Generator of decoded message batches
+        """
+        print(f"Beginning consumption of subscriber: {sub_name}")
+
+        last_message = time.monotonic()
+        while timeout is None or time.monotonic() - last_message < timeout:
+            if flow_control is not None:
+                if flow_control.full:
+                    self.wait_for_capacity(sub_name, flow_control, max_wait)
+                    last_message = time.monotonic()
+                batch_size = flow_control.limit(max_messages)
+            else:
+                batch_size = max_messages
+
+            messages = self.bus.pull(sub_name, batch_size, max_wait)
+            if not messages:
+                continue
+
+            if flow_control is not None:
+                flow_control.acquire(len(messages), sum(len(data) for data, _ in messages) if self.bus.shared else 0)
+
+            if self.bus.shared:
+                messages = [self.decode_data(data, metadata) for data, metadata in messages]
+            else:
+                self.consumer_lag(sub_name).set(self.bus.subscriptions[sub_name].qsize())
+
+            self.consumed_total.inc(len(messages))
+            yield messages
+            last_message = time.monotonic()
+
+    @staticmethod
+    def broker_callback(message, nested_callback=print) -> None:
+        nested_callback(message)
+
+    def close(self) -> None:
+        super().close()
+        if self.bus.shared:
+            self.bus.close()
@@ -0,0 +1,39 @@
+import logging
+import sys
+from UnifiedAPI.settings import LOG_LEVEL
+
+LOG_LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR}
+
+# Logger of the brokers. Messages are written to stdout without decoration, as the package's other output is printed.
+# Applications can add their own handlers to it
+logger = logging.getLogger("UnifiedAPI")
+logger.setLevel(LOG_LEVELS[LOG_LEVEL])
+logger.propagate = False
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+
+
+def set_log_level(level: str) -> None:
+    """
+    :param level: Lowest level output, one of LOG_LEVELS
+    """
+    if level not in LOG_LEVELS:
+        raise ValueError(f"Unknown log level {level}, must be one of {list(LOG_LEVELS)}")
+    logger.setLevel(LOG_LEVELS[level])
+
+
+def enabled(level: str) -> bool:
+    return logger.isEnabledFor(LOG_LEVELS[level])
+
+
+def log(message: str, *args, level: str = "info") -> None:
+    """
+    Log message if level is at or above the configured level. Per message output is logged at debug with its values
+    passed as args, so that it is off and its message is not formatted unless asked for
+    :param message: Text logged, %-style format string if args are given
+    :param args: Values formatted into message, only once the message is output
+    :param level: One of LOG_LEVELS
+    """
+    logger.log(LOG_LEVELS[level], message, *args)
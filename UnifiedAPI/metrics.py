@@ -0,0 +1,244 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Sequence, Tuple
+from UnifiedAPI.settings import LATENCY_BUCKETS
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(labels: Dict[str, str], extra: Dict[str, str] = None) -> str:
+    labels = {**labels, **(extra or {})}
+    if not labels:
+        return ""
+
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    One labelled series of a metric. Updates take a lock, so a series can be shared by every thread
+    """
+
+    type = None
+
+    def __init__(self, name: str, help_text: str, labels: Dict[str, str]):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """
+        :return: (sample name, formatted labels, value) of each line of this series in the text format
+        """
+        raise NotImplementedError
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Dict[str, str]):
+        super().__init__(name, help_text, labels)
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        return [(self.name, format_labels(self.labels), self.value)]
+
+
+class Gauge(Metric):
+
+    type = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: Dict[str, str]):
+        super().__init__(name, help_text, labels)
+        self.value = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        return [(self.name, format_labels(self.labels), self.value)]
+
+
+class Histogram(Metric):
+    """
+    Counts of observations in fixed buckets, fixed so that observing is a bisect and an increment
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Dict[str, str], buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = sorted(buckets)
+        # Final count is of observations above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float, count: int = 1) -> None:
+        """
+        :param value: Observed value, e.g. a duration in seconds
+        :param count: Number of observations of value, e.g. a batch timed as a whole
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += count
+            self.sum += value * count
+            self.count += count
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        """
+        Observe the duration (seconds) of the with block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + [float("inf")], counts):
+            cumulative += bucket_count
+            samples.append((f"{self.name}_bucket", format_labels(self.labels, {'le': format_value(bound)}),
+                            cumulative))
+
+        samples.append((f"{self.name}_sum", format_labels(self.labels), total))
+        samples.append((f"{self.name}_count", format_labels(self.labels), count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Series by name and labels, created on first use and rendered in the Prometheus text format. Modules fetch their
+    series once (e.g. per broker) and keep them, so the hot path only updates a series
+    """
+
+    def __init__(self):
+        self._metrics: Dict[Tuple, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, help_text: str, labels: Dict[str, str], **kwargs) -> Metric:
+        key = (name, tuple(sorted(labels.items())))
+        try:
+            metric = self._metrics[key]
+        except KeyError:
+            with self._lock:
+                metric = self._metrics.setdefault(key, cls(name, help_text, labels, **kwargs))
+
+        if not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is a {metric.type}, not a {cls.type}")
+
+        return metric
+
+    def counter(self, name: str, help_text: str, **labels) -> Counter:
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name: str, help_text: str, **labels) -> Gauge:
+        return self._get(Gauge, name, help_text, labels)
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                  **labels) -> Histogram:
+        return self._get(Histogram, name, help_text, labels, buckets=buckets)
+
+    def render(self) -> str:
+        """
+        :return: Every series in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+
+        lines = []
+        previous = None
+        for metric in metrics:
+            if metric.name != previous:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.type}")
+                previous = metric.name
+            lines.extend(f"{name}{labels} {format_value(value)}" for name, labels, value in metric.samples())
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """
+        Export the registry over HTTP from a daemon thread, at any path
+        :param port: Port to listen on, 0 = any free port (see server.server_address)
+        :param host: Address to listen on, local only by default
+        :return: Running server, stop with shutdown()
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes are not logged
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+    def dump(self, path) -> None:
+        """
+        Write the registry to a file, replacing it in one step so readers never see a partial file
+        :param path: File written
+        """
+        part = f"{path}.part"
+        with open(part, "w") as f:
+            f.write(self.render())
+        os.replace(part, path)
+
+    def dump_every(self, path, interval: float) -> threading.Event:
+        """
+        Dump the registry to a file every interval seconds from a daemon thread
+        :param path: File written
+        :param interval: Time (seconds) between dumps
+        :return: Event, set to stop dumping after a final dump
+        """
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                self.dump(path)
+            self.dump(path)
+
+        threading.Thread(target=run, daemon=True).start()
+        return stop
+
+
+# Registry shared by the brokers and the predictor
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,238 @@
+import threading
+import time
+from concurrent.futures import TimeoutError, wait
+from typing import Dict, Iterator, List
+from google.api_core.exceptions import AlreadyExists, DeadlineExceeded, NotFound
+from google.cloud.pubsub_v1 import PublisherClient, SubscriberClient, publisher, types
+from UnifiedAPI.adapter import FlowControl, MessageBroker
+from UnifiedAPI.serializers import Serializer
+from UnifiedAPI.settings import LINGER_MS, BATCH_BYTES
+
+
+class PubsubBroker(MessageBroker):
+
+    name = "pubsub"
+
+    def __init__(self, project, serializer: Serializer = None, linger_ms: float = LINGER_MS,
+                 batch_bytes: int = BATCH_BYTES):
+        """
+        :param project: Google Cloud project
+        :param serializer: Serializer used to encode sent messages, JSON by default
+        :param linger_ms: Maximum time (milliseconds) a message waits for others to be published in the same batch
+        :param batch_bytes: Maximum size (bytes) of a published batch
+        """
+        super().__init__(serializer)
+        self.project = project
+        self.batch_settings = types.BatchSettings(max_bytes=batch_bytes, max_latency=linger_ms / 1000)
+        # Futures of published messages not yet delivered, waited on by flush
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+
+    @property
+    def subscriber(self) -> SubscriberClient:
+        return self.get_client("subscriber", SubscriberClient)
+
+    @property
+    def producer(self) -> PublisherClient:
+        # Stopping the publisher sends any messages still batched
+        return self.get_client("producer", lambda: PublisherClient(batch_settings=self.batch_settings),
+                               close=lambda client: client.stop())
+
+    def create_topic(self, topic, **kwargs) -> publisher.futures.Future:
+
+        topic_path = self.get_topic_path(topic)
+        response = {}
+
+        try:
+            response = self.producer.create_topic(name=topic_path, **kwargs)
+            print(f"Created topic {topic} in {self.project}")
+
+        except AlreadyExists:
+            print(f"{topic} already exists in {self.project}")
+
+        return response
+
+    def delete_topic(self, topic):
+
+        topic_path = self.get_topic_path(topic)
+        try:
+            self.producer.delete_topic(topic=topic_path)
+            print(f"Topic: {topic} deleted from project: {self.project}")
+        except NotFound:
+            print(f"Topic: {topic} does not exist in project: {self.project}")
+
+    def create_subscriber(self, name, topic, **kwargs) -> None:
+
+        sub_path = self.get_subscriber_path(name)
+        topic_path = self.get_topic_path(topic)
+
+        # subs = self.subscriber.list_subscriptions(project=f"projects/{self.project}")
+        # TODO: Not a great way to do this, but can't assign sub to new topic without deleting (possibly detaching)
+        #  first. Above expression makes it difficult to get names, otherwise would use that
+        for _ in range(2):
+            try:
+                self.subscriber.create_subscription(
+                    name=sub_path, topic=topic_path, **kwargs
+                )
+                print(f"Subscription created {name} in {self.project}")
+                break
+            except AlreadyExists:
+                print(f"Subscription {name} already exists in {self.project}")
+                self.delete_subscriber(name)
+
+    def delete_subscriber(self, name) -> None:
+
+        subscription_path = self.get_subscriber_path(name)
+        self.subscriber.delete_subscription(subscription=subscription_path)
+
+        print(f"Subscription deleted: {subscription_path}.")
+
+    def send_message(self, topic: str, message: Dict, block: bool = True) -> publisher.futures.Future:
+        """
+        :param topic: Topic to send message to
+        :param message: Message to be sent, an id is added if missing
+        :param block: Wait for the message to be delivered, otherwise return straight away and report delivery from
+        a callback
+        :return: Future of the published message
+        """
+        topic_path = self.get_topic_path(topic)
+        message = self.add_id(message)
+        encoded_message, metadata = self.encode_message(message)
+
+        sent = time.perf_counter()
+        future = self.producer.publish(topic_path, encoded_message, **metadata)
+
+        if block:
+            if isinstance(future.exception(), NotFound):
+                raise NotFound(f"Topic: {topic} not found in project: {self.project}")
+
+            self.send_success(message['id'], topic, sent)
+        else:
+            with self.pending_lock:
+                self.pending.add(future)
+            future.add_done_callback(lambda f: self.on_delivery(f, message['id'], topic, sent))
+
+        return future
+
+    def on_delivery(self, future: publisher.futures.Future, message_id: str, topic: str, sent: float = None) -> None:
+        with self.pending_lock:
+            self.pending.discard(future)
+
+        exception = future.exception()
+        if exception is None:
+            self.send_success(message_id, topic, sent)
+        else:
+            self.send_failure(message_id, topic, exception)
+
+    def flush(self, timeout: float = None) -> None:
+        """
+        Block until every message sent without blocking has been delivered or has failed
+        :param timeout: Maximum time (seconds) to wait, None = no limit
+        """
+        with self.pending_lock:
+            pending = list(self.pending)
+
+        wait(pending, timeout=timeout)
+
+    @staticmethod
+    def wait_for_future(future: publisher.futures.Future, timeout: float = None):
+        return future.result(timeout=timeout)
+
+    def consume(self, sub_name, callback=print, timeout: int = None, flow_control: FlowControl = None):
+        """
+        Pass messages to callback as they arrive, each acknowledged once callback returns
+        :param sub_name: Subscriber to consume
+        :param callback: Called with each decoded message, from the subscriber client's threads
+        :param timeout: Stop after this many seconds, None = consume indefinitely
+        :param flow_control: Limits on messages leased but not yet acknowledged, defaults from settings
+        """
+        flow_control = flow_control or FlowControl()
+        sub_path = self.get_subscriber_path(sub_name)
+        future = self.subscriber.subscribe(
+            sub_path,
+            lambda message: self.broker_callback(message, callback),
+            flow_control=types.FlowControl(max_messages=flow_control.max_messages, max_bytes=flow_control.max_bytes),
+        )
+        print(f"Beginning consumption of subscriber: {sub_name}")
+
+        # When `timeout` is not set, result() will block indefinitely,
+        # unless an exception is encountered first.
+        try:
+            future.result(timeout=timeout)
+        except (TimeoutError, KeyboardInterrupt):
+            future.cancel()  # Trigger the shutdown.
+            future.result()  # Block until the shutdown is complete.
+
+    def consume_batches(self, sub_name: str, max_messages: int = 100, max_wait: float = 1.,
+                        timeout: float = None, flow_control: FlowControl = None) -> Iterator[List[Dict]]:
+        """
+        Pull batches of messages, acknowledging each batch only once the loop body handling it has finished. A batch
+        left unacknowledged (e.g. by an exception or break) is redelivered after its acknowledgement deadline
+        :param sub_name: Subscriber to pull from
+        :param max_messages: Maximum number of messages in a batch
+        :param max_wait: Maximum time (seconds) to wait for messages, available messages are returned straight away
+        :param timeout: Stop after this many seconds without messages, None = pull indefinitely
+        :param flow_control: Acquires every message pulled, which the caller releases once handled. Pulling stops
+        while it is full. None = no limit
+        :return: Generator of decoded message batches
+        """
+        sub_path = self.get_subscriber_path(sub_name)
+        print(f"Beginning batch consumption of subscriber: {sub_name}")
+
+        last_message = time.monotonic()
+        while timeout is None or time.monotonic() - last_message < timeout:
+            if flow_control is not None:
+                if flow_control.full:
+                    self.wait_for_capacity(sub_name, flow_control, max_wait)
+                    last_message = time.monotonic()
+                batch_size = flow_control.limit(max_messages)
+            else:
+                batch_size = max_messages
+
+            try:
+                response = self.subscriber.pull(
+                    request={'subscription': sub_path, 'max_messages': batch_size}, timeout=max_wait
+                )
+            except DeadlineExceeded:
+                continue
+
+            received = response.received_messages
+            if not received:
+                continue
+
+            if flow_control is not None:
+                flow_control.acquire(len(received), sum(len(r.message.data) for r in received))
+
+            # Backlog of a subscription is only available from Cloud Monitoring, so no lag is recorded here
+            self.consumed_total.inc(len(received))
+            yield [self.decode_data(r.message.data, dict(r.message.attributes)) for r in received]
+
+            # One acknowledgement request for the whole batch
+            self.subscriber.acknowledge(
+                request={'subscription': sub_path, 'ack_ids': [r.ack_id for r in received]}
+            )
+            last_message = time.monotonic()
+
+    def get_topic_path(self, topic):
+
+        topic_name = 'projects/{project_id}/topics/{topic}'.format(
+            project_id=self.project,
+            topic=topic,
+        )
+
+        return topic_name
+
+    def get_subscriber_path(self, subscription_id):
+
+        subscription_name = 'projects/{project_id}/subscriptions/{sub}'.format(
+            project_id=self.project,
+            sub=subscription_id,
+        )
+
+        return subscription_name
+
+    @staticmethod
+    def broker_callback(message, nested_callback=print) -> None:
+        decoded_data = MessageBroker.decode_data(message.data, dict(message.attributes))
+        nested_callback(decoded_data)
+        message.ack()
@@ -0,0 +1,247 @@
+import json
+import zlib
+from typing import Dict, Tuple
+from UnifiedAPI.binary import CONTENT_TYPE_KEY, JSON_CONTENT_TYPE, IMAGE_CONTENT_TYPE, is_image_message, \
+    encode_image_message, decode_image_message
+
+# Optional faster codecs and compression, unavailable options fall back to the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Message attribute (Pub/Sub) or header (Kafka) naming the compression applied, absent if uncompressed
+CONTENT_ENCODING_KEY = "content-encoding"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+
+
+class Codec:
+    """
+    Converts messages to and from bytes. Codecs sharing a content type produce interchangeable output.
+    """
+
+    name = None
+    content_type = None
+    available = True
+
+    @staticmethod
+    def encode(message: Dict) -> bytes:
+        raise NotImplementedError
+
+    @staticmethod
+    def decode(data: bytes) -> Dict:
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+
+    name = "json"
+    content_type = JSON_CONTENT_TYPE
+
+    @staticmethod
+    def encode(message: Dict) -> bytes:
+        return json.dumps(message).encode("utf-8")
+
+    @staticmethod
+    def decode(data: bytes) -> Dict:
+        return json.loads(bytes(data).decode("utf-8"))
+
+
+class OrjsonCodec(Codec):
+
+    name = "orjson"
+    content_type = JSON_CONTENT_TYPE
+    available = orjson is not None
+
+    @staticmethod
+    def encode(message: Dict) -> bytes:
+        return orjson.dumps(message)
+
+    @staticmethod
+    def decode(data: bytes) -> Dict:
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+
+    name = "msgpack"
+    content_type = MSGPACK_CONTENT_TYPE
+    available = msgpack is not None
+
+    @staticmethod
+    def encode(message: Dict) -> bytes:
+        return msgpack.packb(message)
+
+    @staticmethod
+    def decode(data: bytes) -> Dict:
+        return msgpack.unpackb(data)
+
+
+class ImageCodec(Codec):
+    """
+    Binary image format, used for any message holding a numpy image regardless of the chosen codec
+    """
+
+    name = "image"
+    content_type = IMAGE_CONTENT_TYPE
+
+    @staticmethod
+    def encode(message: Dict) -> bytes:
+        return encode_image_message(message)
+
+    @staticmethod
+    def decode(data: bytes) -> Dict:
+        return decode_image_message(data)
+
+
+class Compressor:
+
+    name = None
+    available = True
+
+    @staticmethod
+    def compress(data: bytes) -> bytes:
+        raise NotImplementedError
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class ZlibCompressor(Compressor):
+
+    name = "zlib"
+
+    @staticmethod
+    def compress(data: bytes) -> bytes:
+        # Fastest level, messages are compressed on the hot path
+        return zlib.compress(data, 1)
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class Lz4Compressor(Compressor):
+
+    name = "lz4"
+    available = lz4 is not None
+
+    @staticmethod
+    def compress(data: bytes) -> bytes:
+        return lz4.frame.compress(data)
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return lz4.frame.decompress(data)
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec, OrjsonCodec, MsgpackCodec)}
+COMPRESSORS = {compressor.name: compressor for compressor in (ZlibCompressor, Lz4Compressor)}
+
+# Decoders by content type, preferring the fastest available
+DECODERS = {
+    JSON_CONTENT_TYPE: OrjsonCodec if OrjsonCodec.available else JsonCodec,
+    MSGPACK_CONTENT_TYPE: MsgpackCodec,
+    IMAGE_CONTENT_TYPE: ImageCodec,
+}
+
+
+def get_codec(name: str) -> Codec:
+    """
+    :param name: Name of codec within CODECS
+    :return: Codec, or JsonCodec if the codec's package is not installed
+    """
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec {name}, must be one of {list(CODECS)}")
+
+    codec = CODECS[name]
+    if not codec.available:
+        print(f"Codec {name} is not installed, falling back to {JsonCodec.name}")
+        return JsonCodec
+
+    return codec
+
+
+def get_compressor(name: str = None) -> Compressor:
+    """
+    :param name: Name of compressor within COMPRESSORS, None = no compression
+    :return: Compressor, or ZlibCompressor if the compressor's package is not installed. None if name is None
+    """
+    if name is None:
+        return None
+
+    if name not in COMPRESSORS:
+        raise ValueError(f"Unknown compression {name}, must be one of {list(COMPRESSORS)}")
+
+    compressor = COMPRESSORS[name]
+    if not compressor.available:
+        print(f"Compression {name} is not installed, falling back to {ZlibCompressor.name}")
+        return ZlibCompressor
+
+    return compressor
+
+
+class Serializer:
+    """
+    Serialization strategy of a message broker: a codec, and optional compression of messages above a size threshold.
+    The codec and compression used are returned as message metadata, so that consumers can decode any message.
+    """
+
+    def __init__(self, codec: str = "json", compression: str = None, compress_threshold: int = 1024):
+        """
+        :param codec: Name of codec used for messages without a numpy image, within CODECS
+        :param compression: Name of compression within COMPRESSORS, None = no compression
+        :param compress_threshold: Minimum encoded size (bytes) of a message to be compressed
+        """
+        self.codec = get_codec(codec)
+        self.compressor = get_compressor(compression)
+        self.compress_threshold = compress_threshold
+
+    def encode(self, message: Dict) -> Tuple[bytes, Dict[str, str]]:
+        """
+        :param message: Message to be sent
+        :return: Encoded message, and metadata to send alongside it
+        """
+        codec = ImageCodec if is_image_message(message) else self.codec
+        data = codec.encode(message)
+        metadata = {CONTENT_TYPE_KEY: codec.content_type}
+
+        if self.compressor is not None and len(data) >= self.compress_threshold:
+            data = self.compressor.compress(data)
+            metadata[CONTENT_ENCODING_KEY] = self.compressor.name
+
+        return data, metadata
+
+    @staticmethod
+    def decode(data: bytes, metadata: Dict[str, str] = None) -> Dict:
+        """
+        Decode a message sent by any serializer
+        :param data: Encoded message
+        :param metadata: Metadata sent alongside message, messages without metadata are uncompressed JSON
+        :return: Decoded message
+        """
+        metadata = metadata or {}
+
+        encoding = metadata.get(CONTENT_ENCODING_KEY)
+        if encoding is not None:
+            if encoding not in COMPRESSORS or not COMPRESSORS[encoding].available:
+                raise ValueError(f"Cannot decompress message with unsupported encoding {encoding}")
+            data = COMPRESSORS[encoding].decompress(data)
+
+        content_type = metadata.get(CONTENT_TYPE_KEY, JSON_CONTENT_TYPE)
+        decoder = DECODERS.get(content_type)
+        if decoder is None or not decoder.available:
+            raise ValueError(f"Cannot decode message with unsupported content type {content_type}")
+
+        return decoder.decode(data)
@@ -1,9 +1,37 @@
+import pathlib
+import tempfile
 from os import environ as env
 
 PROJECT = "vectorassignment"
 TEST_TOPIC = "test_topic"
 TEST_SUB = "test_sub"
-BROKERS = ["pubsub", "kafka"]
+BROKERS = ["pubsub", "kafka", "local"]
+# Producer batching: maximum wait (milliseconds) for a batch to fill, and maximum batch size (bytes)
+LINGER_MS = 5
+BATCH_BYTES = 256 * 1024
+
+# Consumer flow control: maximum number and size (bytes) of messages consumed but not yet handled, 0 = no limit
+MAX_OUTSTANDING_MESSAGES = 1000
+MAX_OUTSTANDING_BYTES = 100 * 2 ** 20
+
+# Kafka partitions created per planned consumer, spare partitions allow consumers to be added later
+PARTITIONS_PER_WORKER = 2
+
+# Local broker shared between processes: directory of topic and subscription files (in memory where /dev/shm exists),
+# capacity (bytes) of each subscription, and time (seconds) between checks of an empty or full subscription
+LOCAL_DIR = pathlib.Path("/dev/shm" if pathlib.Path("/dev/shm").is_dir() else tempfile.gettempdir(), "unifiedapi")
+LOCAL_RING_BYTES = 16 * 2 ** 20
+LOCAL_POLL_INTERVAL = 0.001
+
+# Printed messages below this level are hidden: debug (every message sent), info, warning or error
+LOG_LEVEL = env.get("UNIFIEDAPI_LOG_LEVEL", "info")
+
+# Metrics: histogram buckets of durations (seconds) and batch sizes, port of the HTTP endpoint (0 = disabled), and
+# time (seconds) between dumps to file
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5.)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+METRICS_PORT = 8000
+METRICS_INTERVAL = 60
 
 try:
     KAFKA_HOST = env["KAFKA_HOST"]
@@ -1,9 +1,32 @@
+import asyncio
+import itertools
+import multiprocessing as mp
+import subprocess
+import sys
+import tempfile
+import threading
+import urllib.request
 import unittest
 import uuid
 import time
-from UnifiedAPI import adapter
-from UnifiedAPI.settings import PROJECT, TEST_TOPIC, TEST_SUB
+from concurrent.futures import Future, ThreadPoolExecutor
+import pathlib
+import numpy as np
+from typing import Dict
+from UnifiedAPI import adapter, async_adapter, kafka_broker, pubsub_broker, log, metrics
+from UnifiedAPI.binary import CONTENT_TYPE_KEY, IMAGE_CONTENT_TYPE, encode_image_message, decode_image_message
+from UnifiedAPI.serializers import Serializer, CONTENT_ENCODING_KEY, CODECS
+from UnifiedAPI.local import SharedRing
+from UnifiedAPI import consumer_group
+from UnifiedAPI.settings import PROJECT, TEST_TOPIC, TEST_SUB, LOG_LEVEL
+from google.api_core.exceptions import DeadlineExceeded
 from unittest import mock
+from kafka.future import Future as KafkaFuture
+from kafka.structs import TopicPartition
+
+# Partitions of polled Kafka records
+P0 = TopicPartition(TEST_TOPIC, 0)
+P1 = TopicPartition(TEST_TOPIC, 1)
 
 
 # Wrapping abstract test class in blank class so that is not called for testing
@@ -69,9 +92,754 @@ class KafkaTest(AdapterTest.SystemTests):
 
     def test_send_message(self):
         future = self.broker.send_message(TEST_TOPIC, {"id": str(uuid.uuid4())})
+        # Kafka sends do not block by default
+        self.broker.flush()
         self.assertEqual(future.is_done, True)
         self.assertEqual(future.exception, None)
 
 
+class LocalTest(AdapterTest.SystemTests):
+
+    def setUp(self) -> None:
+        self.broker = adapter.LocalBroker(PROJECT, shared=False)
+        self.broker.create_topic(TEST_TOPIC)
+
+    def test_send_message(self):
+        future = self.broker.send_message(TEST_TOPIC, {"id": str(uuid.uuid4())})
+        self.assertTrue(future.done())
+        self.assertEqual(future.exception(), None)
+
+
+class SharedLocalTest(LocalTest):
+
+    def setUp(self) -> None:
+        self.root = tempfile.TemporaryDirectory()
+        self.broker = adapter.LocalBroker(PROJECT, root=self.root.name)
+        self.broker.create_topic(TEST_TOPIC)
+
+    def tearDown(self) -> None:
+        super().tearDown()
+        self.broker.close()
+        self.root.cleanup()
+
+
+def send_local_images(root: str, count: int) -> None:
+    """
+    Send images to TEST_TOPIC from another process
+    """
+    with adapter.LocalBroker(PROJECT, root=root) as broker:
+        for i in range(count):
+            broker.send_message(TEST_TOPIC, {'id': str(i), 'image': np.full((28, 28), i, dtype=np.uint8)})
+
+
+def recreate_local_subscription(root: str) -> None:
+    """
+    Recreate TEST_SUB from another process, as a restarted subscriber does
+    """
+    with adapter.LocalBroker(PROJECT, root=root) as broker:
+        broker.create_subscriber(TEST_SUB, TEST_TOPIC)
+
+
+@mock.patch('builtins.print')
+class LocalBrokerTest(unittest.TestCase):
+
+    def test_fan_out_without_serialization(self, mock_print):
+        broker = adapter.LocalBroker(PROJECT, shared=False)
+        broker.create_topic("fan_out")
+        broker.create_subscriber("sub_a", "fan_out")
+        broker.create_subscriber("sub_b", "fan_out")
+
+        image = np.zeros((28, 28), dtype=np.uint8)
+        broker.send_messages("fan_out", [{'id': "a", 'image': image}, {'id': "b", 'image': image}])
+
+        for sub in ("sub_a", "sub_b"):
+            messages = next(broker.consume_batches(sub, max_messages=10))
+            self.assertEqual([m['id'] for m in messages], ["a", "b"])
+            # Same process, so the image object itself is handed over
+            self.assertIs(messages[0]['image'], image)
+
+        broker.delete_topic("fan_out")
+
+    def test_ring_wraps_around(self, mock_print):
+        with tempfile.TemporaryDirectory() as root:
+            ring = SharedRing(pathlib.Path(root, "test.ring"), capacity=100)
+            for i in range(50):
+                data = bytes([i]) * (i % 30 + 1)
+                self.assertTrue(ring.put(data, b"{}"))
+                self.assertEqual(ring.get(10), [(data, b"{}")])
+
+            # Messages that do not fit are refused until space is freed
+            self.assertTrue(ring.put(b"x" * 60))
+            self.assertFalse(ring.put(b"y" * 60))
+            self.assertEqual(len(ring.get(10)), 1)
+            self.assertTrue(ring.put(b"y" * 60))
+            ring.close()
+
+    def test_shared_between_processes(self, mock_print):
+        with tempfile.TemporaryDirectory() as root:
+            with adapter.LocalBroker(PROJECT, root=root) as broker:
+                broker.create_topic(TEST_TOPIC)
+                broker.create_subscriber(TEST_SUB, TEST_TOPIC)
+
+                process = mp.get_context("spawn").Process(target=send_local_images, args=(root, 20))
+                process.start()
+
+                received = []
+                for messages in broker.consume_batches(TEST_SUB, max_messages=8, timeout=30):
+                    received.extend(messages)
+                    if len(received) == 20:
+                        break
+                process.join()
+
+        self.assertEqual([m['id'] for m in received], [str(i) for i in range(20)])
+        np.testing.assert_array_equal(received[7]['image'], np.full((28, 28), 7, dtype=np.uint8))
+
+    def test_subscription_recreated_by_another_process(self, mock_print):
+        with tempfile.TemporaryDirectory() as root:
+            with adapter.LocalBroker(PROJECT, root=root, ring_bytes=256, send_timeout=5) as publisher, \
+                    adapter.LocalBroker(PROJECT, root=root) as subscriber:
+                publisher.create_topic(TEST_TOPIC)
+                publisher.create_subscriber(TEST_SUB, TEST_TOPIC)
+                publisher.send_message(TEST_TOPIC, {'id': "before"})
+
+                process = mp.get_context("spawn").Process(target=recreate_local_subscription, args=(root,))
+                process.start()
+                process.join()
+
+                # Enough messages to fill the ring several times over, only possible if the publisher writes to the
+                # recreated ring the subscriber reads from
+                received = []
+                for i in range(20):
+                    publisher.send_message(TEST_TOPIC, {'id': str(i)})
+                    batches = subscriber.consume_batches(TEST_SUB, max_messages=10, timeout=2)
+                    received.extend(m['id'] for m in next(batches, []))
+
+        self.assertEqual(received, [str(i) for i in range(20)])
+
+
+class BinaryMessageTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.image = np.arange(28 * 28, dtype=np.uint8).reshape((28, 28))
+        self.message = {'id': str(uuid.uuid4()), 'image': self.image, 'top_k': 3}
+
+    def test_round_trip(self):
+        data = encode_image_message(self.message)
+        decoded = decode_image_message(data)
+
+        self.assertEqual(decoded['id'], self.message['id'])
+        self.assertEqual(decoded['top_k'], 3)
+        np.testing.assert_array_equal(decoded['image'], self.image)
+        self.assertLess(len(data), self.image.nbytes + 100)
+
+    def test_zero_copy(self):
+        decoded = decode_image_message(encode_image_message(self.message))
+        self.assertFalse(decoded['image'].flags.owndata)
+
+    def test_dtypes(self):
+        for dtype in (np.float32, np.int16):
+            image = self.image.astype(dtype)
+            decoded = decode_image_message(encode_image_message({'id': "a", 'image': image}))
+            self.assertEqual(decoded['image'].dtype, dtype)
+            np.testing.assert_array_equal(decoded['image'], image)
+
+    def test_encode_message_chooses_format(self):
+        data, metadata = Serializer().encode(self.message)
+        self.assertEqual(metadata[CONTENT_TYPE_KEY], IMAGE_CONTENT_TYPE)
+        data, metadata = Serializer().encode({'id': "a", 'image': self.image.tolist()})
+        self.assertEqual(adapter.MessageBroker.decode_data(data, metadata)['image'], self.image.tolist())
+
+    def test_broker_callbacks_read_content_type(self):
+        data, metadata = Serializer().encode(self.message)
+        callback = mock.Mock()
+
+        pubsub_message = mock.Mock(data=data, attributes=metadata)
+        adapter.PubsubBroker.broker_callback(pubsub_message, callback)
+        np.testing.assert_array_equal(callback.call_args.args[0]['image'], self.image)
+        pubsub_message.ack.assert_called_once()
+
+        kafka_message = mock.Mock(value=data, headers=[(k, v.encode("utf-8")) for k, v in metadata.items()])
+        adapter.KafkaBroker.broker_callback(kafka_message, callback)
+        np.testing.assert_array_equal(callback.call_args.args[0]['image'], self.image)
+
+        # Messages sent without a content type are JSON
+        legacy = mock.Mock(value=b'{"id": "a"}', headers=[])
+        adapter.KafkaBroker.broker_callback(legacy, callback)
+        self.assertEqual(callback.call_args.args[0], {'id': "a"})
+
+
+class SerializerTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.message = {'id': str(uuid.uuid4()), 'predictions': {'Bag': 0.9, 'Coat': 0.1}}
+
+    def test_codecs_round_trip(self):
+        # Unavailable codecs fall back to JSON, so every codec name can be used
+        for codec in CODECS:
+            data, metadata = Serializer(codec).encode(self.message)
+            self.assertEqual(Serializer.decode(data, metadata), self.message)
+
+    def test_compression_above_threshold(self):
+        serializer = Serializer(compression="zlib", compress_threshold=100)
+
+        data, metadata = serializer.encode(self.message)
+        self.assertNotIn(CONTENT_ENCODING_KEY, metadata)
+
+        large = {'id': "a", 'image': [0] * 1000}
+        data, metadata = serializer.encode(large)
+        self.assertEqual(metadata[CONTENT_ENCODING_KEY], "zlib")
+        self.assertLess(len(data), 100)
+        self.assertEqual(Serializer.decode(data, metadata), large)
+
+    def test_compressed_image(self):
+        image = np.zeros((32, 28, 28), dtype=np.uint8)
+        data, metadata = Serializer(compression="lz4", compress_threshold=0).encode({'id': "a", 'image': image})
+        np.testing.assert_array_equal(Serializer.decode(data, metadata)['image'], image)
+
+    def test_missing_metadata_is_json(self):
+        self.assertEqual(Serializer.decode(b'{"id": "a"}'), {'id': "a"})
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            Serializer("pickle")
+
+
+class ClientLifecycleTest(unittest.TestCase):
+
+    @mock.patch.object(kafka_broker, "KafkaProducer")
+    def test_client_reused(self, producer_class):
+        broker = adapter.KafkaBroker(PROJECT)
+        with ThreadPoolExecutor(8) as executor:
+            producers = list(executor.map(lambda _: broker.producer, range(32)))
+
+        producer_class.assert_called_once()
+        self.assertTrue(all(producer is producers[0] for producer in producers))
+
+    @mock.patch.object(kafka_broker, "KafkaProducer")
+    def test_context_manager_closes(self, producer_class):
+        with adapter.KafkaBroker(PROJECT) as broker:
+            producer = broker.producer
+            broker.subscriptions['sub'] = consumer = mock.Mock()
+
+        producer.close.assert_called_once()
+        consumer.close.assert_called_once()
+        self.assertEqual(broker.subscriptions, {})
+
+        # A closed broker creates a new client when used again
+        broker.producer
+        self.assertEqual(producer_class.call_count, 2)
+
+    @mock.patch.object(pubsub_broker, "PublisherClient")
+    def test_publisher_stopped(self, publisher_class):
+        with adapter.PubsubBroker(PROJECT) as broker:
+            publisher = broker.producer
+
+        publisher.stop.assert_called_once()
+
+    def test_subscriptions_per_instance(self):
+        self.assertIsNot(adapter.KafkaBroker(PROJECT).subscriptions, adapter.KafkaBroker(PROJECT).subscriptions)
+
+
+@mock.patch('builtins.print')
+class PublishTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        # Deliveries are logged at debug
+        log.set_log_level("debug")
+
+    def tearDown(self) -> None:
+        log.set_log_level(LOG_LEVEL)
+
+    @mock.patch.object(kafka_broker, "KafkaProducer")
+    def test_kafka_non_blocking(self, producer_class, mock_print):
+        broker = adapter.KafkaBroker(PROJECT, linger_ms=20, batch_bytes=1024)
+        with self.assertLogs(log.logger, "DEBUG") as logs:
+            future = broker.send_message(TEST_TOPIC, {'id': "a"}, block=False)
+
+            self.assertEqual(producer_class.call_args.kwargs['linger_ms'], 20)
+            self.assertEqual(producer_class.call_args.kwargs['batch_size'], 1024)
+            future.get.assert_not_called()
+
+            # Delivery is reported by the callback, not when the message is sent
+            self.assertEqual(logs.output, [])
+            future.add_callback.call_args.args[0](None)
+            self.assertIn("delivered", logs.output[-1])
+
+        # Kafka sends only block when asked to
+        broker.send_message(TEST_TOPIC, {'id': "b"})
+        broker.producer.send.return_value.get.assert_not_called()
+        broker.send_message(TEST_TOPIC, {'id': "c"}, block=True)
+        broker.producer.send.return_value.get.assert_called_once()
+
+        broker.flush(timeout=1)
+        broker.producer.flush.assert_called_once_with(timeout=1)
+
+    @mock.patch.object(pubsub_broker, "PublisherClient")
+    def test_pubsub_send_messages(self, publisher_class, mock_print):
+        futures = [Future() for _ in range(3)]
+        publisher_class.return_value.publish.side_effect = futures
+
+        broker = adapter.PubsubBroker(PROJECT, linger_ms=20)
+        report = broker.send_messages(TEST_TOPIC, [{'id': str(i)} for i in range(3)])
+
+        self.assertAlmostEqual(publisher_class.call_args.kwargs['batch_settings'].max_latency, 0.02)
+        self.assertEqual(len(report), 3)
+        self.assertEqual(len(broker.pending), 3)
+
+        futures[0].set_result("1")
+        futures[1].set_result("2")
+
+        with self.assertLogs(log.logger, "WARNING") as logs:
+            futures[2].set_exception(RuntimeError("failed"))
+
+        broker.flush(timeout=1)
+        self.assertEqual(broker.pending, set())
+        self.assertEqual(report.wait(timeout=1), 1)
+        self.assertIsInstance(report.errors[0], RuntimeError)
+        self.assertIn("failed delivery", logs.output[0])
+
+
+class FakeKafkaConsumer:
+    """
+    Consumer of fixed records, tracking the position of each partition and the offsets committed
+    """
+
+    def __init__(self, records: Dict[TopicPartition, int]):
+        """
+        :param records: Number of records of each partition
+        """
+        self.records = records
+        self.positions = {tp: 0 for tp in records}
+        self.committed = {}
+
+    def poll(self, timeout_ms=0, max_records=None):
+        polled = {}
+        for tp, end in self.records.items():
+            n = min(end - self.positions[tp], max_records - sum(len(messages) for messages in polled.values()))
+            if n > 0:
+                polled[tp] = [ConsumeBatchesTest.kafka_record(self.positions[tp] + i) for i in range(n)]
+                self.positions[tp] += n
+        return polled
+
+    def seek(self, tp, offset):
+        self.positions[tp] = offset
+
+    def assignment(self):
+        return set(self.records)
+
+    def highwater(self, tp):
+        return self.records[tp]
+
+    def commit(self):
+        self.committed = dict(self.positions)
+
+    def close(self):
+        pass
+
+
+@mock.patch('builtins.print')
+class ConsumeBatchesTest(unittest.TestCase):
+
+    @staticmethod
+    def pubsub_message(i):
+        data, metadata = Serializer().encode({'id': str(i)})
+        return mock.Mock(ack_id=f"ack{i}", message=mock.Mock(data=data, attributes=metadata))
+
+    @staticmethod
+    def kafka_record(i):
+        data, metadata = Serializer().encode({'id': str(i)})
+        return mock.Mock(value=data, headers=[(k, v.encode("utf-8")) for k, v in metadata.items()],
+                         serialized_value_size=len(data), offset=i)
+
+    @mock.patch.object(pubsub_broker, "SubscriberClient")
+    def test_pubsub_ack_after_batch(self, subscriber_class, mock_print):
+        subscriber = subscriber_class.return_value
+        subscriber.pull.side_effect = itertools.chain(
+            [DeadlineExceeded("no messages"), mock.Mock(received_messages=[self.pubsub_message(i) for i in range(3)])],
+            itertools.repeat(mock.Mock(received_messages=[])),
+        )
+
+        broker = adapter.PubsubBroker(PROJECT)
+        batches = broker.consume_batches(TEST_SUB, max_messages=3, timeout=0.05)
+
+        self.assertEqual(next(batches), [{'id': "0"}, {'id': "1"}, {'id': "2"}])
+        subscriber.acknowledge.assert_not_called()
+
+        self.assertEqual(list(batches), [])
+        subscriber.acknowledge.assert_called_once()
+        self.assertEqual(subscriber.acknowledge.call_args.kwargs['request']['ack_ids'], ["ack0", "ack1", "ack2"])
+        self.assertEqual(subscriber.pull.call_args.kwargs['request']['max_messages'], 3)
+
+    def test_kafka_commit_after_batch(self, mock_print):
+        broker = adapter.KafkaBroker(PROJECT)
+        consumer = broker.subscriptions[TEST_SUB] = mock.Mock()
+        consumer.poll.side_effect = itertools.chain(
+            [{}, {P0: [self.kafka_record(0)], P1: [self.kafka_record(1)]}], itertools.repeat({})
+        )
+        consumer.highwater.return_value = 5
+
+        batches = broker.consume_batches(TEST_SUB, max_messages=2, timeout=0.05)
+        self.assertEqual(next(batches), [{'id': "0"}, {'id': "1"}])
+        consumer.commit.assert_not_called()
+
+        self.assertEqual(list(batches), [])
+        consumer.commit.assert_called_once()
+        self.assertEqual(consumer.poll.call_args.kwargs['max_records'], 2)
+
+        # Lag from the high watermark of each partition and the last offset consumed
+        lag = [metrics.REGISTRY.gauge("broker_consumer_lag", "", broker="kafka", subscription=TEST_SUB,
+                                      partition=str(partition)).value for partition in (0, 1)]
+        self.assertEqual(lag, [4, 3])
+
+    def test_kafka_failed_batch_redelivered(self, mock_print):
+        broker = adapter.KafkaBroker(PROJECT)
+        consumer = broker.subscriptions[TEST_SUB] = FakeKafkaConsumer({P0: 3, P1: 2})
+
+        with self.assertRaises(RuntimeError):
+            for _ in broker.consume_batches(TEST_SUB, max_messages=2):
+                raise RuntimeError("handler failed")
+        self.assertEqual(consumer.positions, {P0: 0, P1: 0})
+
+        # Closing the generator, as the predictor does when a batch fails, rewinds it too
+        batches = broker.consume_batches(TEST_SUB, max_messages=4)
+        self.assertEqual(len(next(batches)), 4)
+        batches.close()
+        self.assertEqual(consumer.positions, {P0: 0, P1: 0})
+        self.assertEqual(consumer.committed, {})
+
+        # The next generator polls the same records again, committing each batch once handled
+        received = [message['id'] for batch in broker.consume_batches(TEST_SUB, max_messages=2, max_wait=0.01,
+                                                                       timeout=0.05) for message in batch]
+        self.assertEqual(sorted(received), ["0", "0", "1", "1", "2"])
+        self.assertEqual(consumer.committed, {P0: 3, P1: 2})
+
+    @mock.patch.object(kafka_broker, "KafkaConsumer")
+    def test_kafka_no_auto_commit(self, consumer_class, mock_print):
+        adapter.KafkaBroker(PROJECT).create_subscriber(TEST_SUB, TEST_TOPIC)
+        self.assertFalse(consumer_class.call_args.kwargs['enable_auto_commit'])
+
+
+@mock.patch('builtins.print')
+class FlowControlTest(unittest.TestCase):
+
+    def test_limits(self, mock_print):
+        flow_control = adapter.FlowControl(max_messages=4, max_bytes=100)
+        self.assertEqual(flow_control.limit(10), 4)
+
+        flow_control.acquire(3, 30)
+        self.assertFalse(flow_control.full)
+        self.assertEqual(flow_control.limit(10), 1)
+
+        flow_control.acquire(1, 10)
+        self.assertTrue(flow_control.full)
+        self.assertFalse(flow_control.wait(0.01))
+
+        # Released messages free the mean size of those outstanding
+        flow_control.release(2)
+        self.assertEqual((flow_control.messages, flow_control.bytes), (2, 20))
+        self.assertTrue(flow_control.wait(0))
+
+        flow_control.acquire(1, 200)
+        self.assertTrue(flow_control.full)
+        flow_control.release(3)
+        self.assertEqual((flow_control.messages, flow_control.bytes), (0, 0))
+
+    def test_local_waits_for_release(self, mock_print):
+        broker = adapter.LocalBroker(PROJECT, shared=False)
+        broker.create_topic("flow")
+        broker.create_subscriber("flow_sub", "flow")
+        broker.send_messages("flow", [{'id': str(i)} for i in range(6)])
+
+        flow_control = adapter.FlowControl(max_messages=4)
+        batches = broker.consume_batches("flow_sub", max_messages=10, max_wait=0.01, flow_control=flow_control)
+        self.assertEqual(len(next(batches)), 4)
+
+        # Nothing more is pulled until handled messages are released
+        threading.Timer(0.05, flow_control.release, args=(4,)).start()
+        start = time.monotonic()
+        self.assertEqual(len(next(batches)), 2)
+        self.assertGreater(time.monotonic() - start, 0.04)
+        broker.delete_topic("flow")
+
+    @mock.patch.object(pubsub_broker, "SubscriberClient")
+    def test_pubsub_consume_flow_control(self, subscriber_class, mock_print):
+        broker = adapter.PubsubBroker(PROJECT)
+        broker.consume(TEST_SUB, timeout=1, flow_control=adapter.FlowControl(max_messages=5, max_bytes=1024))
+
+        settings = subscriber_class.return_value.subscribe.call_args.kwargs['flow_control']
+        self.assertEqual((settings.max_messages, settings.max_bytes), (5, 1024))
+
+    def test_kafka_pauses_while_full(self, mock_print):
+        broker = adapter.KafkaBroker(PROJECT)
+        consumer = broker.subscriptions[TEST_SUB] = mock.Mock()
+        consumer.assignment.return_value = {P0}
+        consumer.highwater.return_value = None
+        consumer.paused.return_value = {P0}
+        records = itertools.chain([{P0: [ConsumeBatchesTest.kafka_record(i) for i in range(2)]}],
+                                  itertools.repeat({}))
+        consumer.poll.side_effect = lambda *args, **kwargs: next(records)
+
+        flow_control = adapter.FlowControl(max_messages=2)
+        batches = broker.consume_batches(TEST_SUB, max_wait=0.01, timeout=0.1, flow_control=flow_control)
+        self.assertEqual(len(next(batches)), 2)
+        self.assertEqual(consumer.poll.call_args.kwargs['max_records'], 2)
+        self.assertEqual(flow_control.bytes, sum(len(Serializer().encode({'id': str(i)})[0]) for i in range(2)))
+
+        # Partitions stay paused, while still being polled, until the batch is released
+        threading.Timer(0.05, flow_control.release, args=(2,)).start()
+        self.assertEqual(list(batches), [])
+        consumer.pause.assert_called_once_with(P0)
+        consumer.resume.assert_called_once_with(P0)
+        self.assertIn(mock.call(timeout_ms=0), consumer.poll.call_args_list)
+
+
+@mock.patch('builtins.print')
+class AsyncBrokerTest(unittest.TestCase):
+
+    def test_kafka_send(self, mock_print):
+        futures = []
+
+        def send(*args, **kwargs):
+            futures.append(KafkaFuture())
+            return futures[-1]
+
+        async def run(broker):
+            sending = asyncio.ensure_future(broker.send_many(TEST_TOPIC, [{'id': "a"}, {'id': "b"}]))
+            await asyncio.sleep(0.01)
+            # Delivery is completed from another thread, as by the producer's IO thread
+            threading.Thread(target=lambda: (futures[0].success("ok"), futures[1].failure(RuntimeError()))).start()
+            return await sending
+
+        with mock.patch.object(kafka_broker, "KafkaProducer") as producer_class:
+            producer_class.return_value.send.side_effect = send
+            results = asyncio.run(run(async_adapter.AsyncKafkaBroker(PROJECT)))
+
+        self.assertEqual(results[0], "ok")
+        self.assertIsInstance(results[1], RuntimeError)
+
+    @mock.patch.object(pubsub_broker, "PublisherClient")
+    def test_pubsub_send(self, publisher_class, mock_print):
+        future = Future()
+        publisher_class.return_value.publish.return_value = future
+        threading.Timer(0.01, future.set_result, ("1",)).start()
+
+        broker = async_adapter.AsyncPubsubBroker(PROJECT)
+        self.assertEqual(asyncio.run(broker.send(TEST_TOPIC, {'id': "a"})), "1")
+
+    def test_kafka_consume(self, mock_print):
+        broker = async_adapter.AsyncKafkaBroker(PROJECT, poll_interval=0.001)
+        threads = set()
+
+        class Consumer(FakeKafkaConsumer):
+            # Records the threads consumers are used from
+
+            def poll(self, **kwargs):
+                threads.add(threading.current_thread())
+                return super().poll(**kwargs)
+
+            def commit_async(self):
+                threads.add(threading.current_thread())
+                self.commit()
+
+        consumers = {'a': Consumer({P0: 3}), 'b': Consumer({P1: 2})}
+        broker.broker.subscriptions.update(consumers)
+
+        async def consume(sub_name):
+            return [message['id'] async for batch in broker.consume_batches(sub_name, max_messages=2, max_wait=0.01,
+                                                                            timeout=0.05) for message in batch]
+
+        async def consume_after_failure(sub_name):
+            # Leaving the generator rewinds the consumer, so the batch is consumed again
+            batches = broker.consume_batches(sub_name, max_messages=2, max_wait=0.01)
+            self.assertEqual(len(await batches.__anext__()), 2)
+            await batches.aclose()
+            return await consume(sub_name)
+
+        async def run():
+            received = await asyncio.gather(consume_after_failure("a"), consume("b"))
+            poller = broker.poller
+            await broker.close()
+            self.assertFalse(poller._thread.is_alive())
+            return received
+
+        self.assertEqual(asyncio.run(run()), [["0", "1", "2"], ["0", "1"]])
+        self.assertEqual(consumers["a"].committed, {P0: 3})
+        self.assertEqual(consumers["b"].committed, {P1: 2})
+        # Every call to either consumer is made by the one poller thread, not the event loop's
+        self.assertEqual([thread.name for thread in threads], ["KafkaPoller"])
+
+    @mock.patch("google.pubsub_v1.SubscriberAsyncClient")
+    def test_pubsub_consume(self, subscriber_class, mock_print):
+        subscriber = subscriber_class.return_value = mock.AsyncMock()
+        subscriber.pull.side_effect = itertools.chain(
+            [mock.Mock(received_messages=[ConsumeBatchesTest.pubsub_message(i) for i in range(2)])],
+            itertools.repeat(mock.Mock(received_messages=[])),
+        )
+
+        async def run():
+            async with async_adapter.AsyncPubsubBroker(PROJECT) as broker:
+                return [batch async for batch in broker.consume_batches(TEST_SUB, timeout=0.05)]
+
+        self.assertEqual(asyncio.run(run()), [[{'id': "0"}, {'id': "1"}]])
+        self.assertEqual(subscriber.acknowledge.call_args.kwargs['request']['ack_ids'], ["ack0", "ack1"])
+        subscriber.transport.close.assert_awaited_once()
+
+
+@mock.patch('builtins.print')
+class WorkerGroupTest(unittest.TestCase):
+
+    @mock.patch.object(kafka_broker, "KafkaConsumer")
+    @mock.patch.object(kafka_broker, "KafkaAdminClient")
+    def test_create_topic_sized_for_workers(self, admin_class, consumer_class, mock_print):
+        broker = adapter.KafkaBroker(PROJECT)
+        broker.create_topic(TEST_TOPIC, workers=4, partitions_per_worker=2)
+        self.assertEqual(admin_class.return_value.create_topics.call_args.args[0][0].num_partitions, 8)
+
+        # Existing topics with too few partitions are grown
+        admin_class.return_value.create_topics.side_effect = kafka_broker.TopicAlreadyExistsError
+        consumer_class.return_value.partitions_for_topic.return_value = {0, 1}
+        broker.create_topic(TEST_TOPIC, workers=2)
+        new_partitions = admin_class.return_value.create_partitions.call_args.args[0][TEST_TOPIC]
+        self.assertEqual(new_partitions.total_count, 4)
+
+        # Without a size, new topics have one partition and existing topics are left as they are
+        admin_class.return_value.create_partitions.reset_mock()
+        consumer_class.return_value.partitions_for_topic.return_value = {0}
+        broker.create_topic(TEST_TOPIC)
+        self.assertEqual(admin_class.return_value.create_topics.call_args.args[0][0].num_partitions, 1)
+        admin_class.return_value.create_partitions.assert_not_called()
+
+    @mock.patch.object(consumer_group, "KafkaConsumer")
+    def test_workers_share_messages(self, consumer_class, mock_print):
+        records = {}
+        lock = threading.Lock()
+
+        def consumer(*args, **kwargs):
+            # Each worker's consumer owns one partition of four messages
+            partition = len(records)
+            records[partition] = [ConsumeBatchesTest.kafka_record(partition * 4 + i) for i in range(4)]
+            instance = mock.Mock()
+            instance.poll.side_effect = itertools.chain([{partition: records[partition]}], itertools.repeat({}))
+            instance.assignment.return_value = set()
+            return instance
+
+        consumer_class.side_effect = consumer
+        received = []
+
+        def callback(message):
+            with lock:
+                received.append(message['id'])
+
+        with mock.patch.object(kafka_broker, "KafkaConsumer"):
+            broker = adapter.KafkaBroker(PROJECT)
+            broker.create_subscriber(TEST_SUB, TEST_TOPIC, group="workers")
+            broker.consume_parallel(TEST_SUB, callback, num_workers=3, timeout=0.1, report_interval=None)
+
+        self.assertEqual(sorted(received, key=int), [str(i) for i in range(12)])
+        self.assertEqual(consumer_class.call_count, 3)
+        self.assertEqual(consumer_class.call_args.kwargs['group_id'], "workers")
+
+    @mock.patch.object(consumer_group, "KafkaConsumer")
+    def test_resize(self, consumer_class, mock_print):
+        consumer_class.return_value.poll.return_value = {}
+        consumer_class.return_value.assignment.return_value = set()
+
+        group = consumer_group.KafkaWorkerGroup("host", TEST_TOPIC, "workers", print, num_workers=2)
+        with group:
+            group.add_worker()
+            self.assertEqual(group.size, 3)
+            group.remove_worker()
+            self.assertEqual(group.size, 2)
+
+        self.assertEqual(group.size, 0)
+        self.assertEqual(consumer_class.return_value.close.call_count, 3)
+
+
+class BrokerFactoryTest(unittest.TestCase):
+
+    def test_backends_imported_on_demand(self):
+        # Importing the adapter alone must not pull in either client library
+        code = "import sys, UnifiedAPI.adapter; print('kafka' in sys.modules, 'google.cloud.pubsub_v1' in sys.modules)"
+        result = subprocess.run([sys.executable, "-c", code], cwd=pathlib.Path(__file__).parents[1],
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.split(), ["False", "False"])
+
+    def test_create_broker(self):
+        with adapter.create_broker("local", PROJECT, shared=False) as broker:
+            self.assertIsInstance(broker, adapter.LocalBroker)
+
+        self.assertIs(adapter.get_broker_class("kafka"), kafka_broker.KafkaBroker)
+        with self.assertRaises(ValueError):
+            adapter.get_broker_class("unknown")
+
+        with self.assertRaises(AttributeError):
+            adapter.UnknownBroker
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.registry = metrics.MetricsRegistry()
+
+    def test_render(self):
+        self.registry.counter("sent_total", "Messages sent", broker="kafka").inc(3)
+        self.registry.gauge("lag", "Messages waiting").set(7)
+        histogram = self.registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.))
+        for value in (0.05, 0.5, 2.):
+            histogram.observe(value)
+
+        lines = self.registry.render().splitlines()
+        self.assertIn("# TYPE sent_total counter", lines)
+        self.assertIn('sent_total{broker="kafka"} 3', lines)
+        self.assertIn("lag 7", lines)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 2', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn("latency_seconds_count 3", lines)
+
+        # Series are shared by name and labels, a name keeps its type
+        self.assertIs(self.registry.counter("sent_total", "", broker="kafka"), self.registry.counter("sent_total", "",
+                                                                                                      broker="kafka"))
+        with self.assertRaises(ValueError):
+            self.registry.gauge("sent_total", "", broker="kafka")
+
+    @mock.patch('builtins.print')
+    def test_http_and_file(self, mock_print):
+        self.registry.counter("requests_total", "Requests").inc()
+
+        server = self.registry.serve(0)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+                self.assertIn("requests_total 1", response.read().decode())
+                self.assertTrue(response.headers['Content-Type'].startswith("text/plain"))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp, "metrics.prom")
+            self.registry.dump_every(path, interval=60).set()
+            deadline = time.monotonic() + 5
+            while not path.exists() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertIn("requests_total 1", path.read_text())
+
+    @mock.patch('builtins.print')
+    def test_broker_metrics(self, mock_print):
+        broker = adapter.LocalBroker(PROJECT, shared=False)
+        broker.create_topic("metrics")
+        broker.create_subscriber("metrics_sub", "metrics")
+        sent = broker.sent_total.value
+        with mock.patch.object(log.logger, "handle") as handle:
+            broker.send_messages("metrics", [{'id': str(i)} for i in range(3)])
+        next(broker.consume_batches("metrics_sub", max_messages=2))
+        broker.delete_topic("metrics")
+
+        self.assertEqual(broker.sent_total.value - sent, 3)
+        self.assertEqual(broker.consumer_lag("metrics_sub").value, 1)
+        # Per message output is hidden at the default level, without being formatted
+        handle.assert_not_called()
+
+
 if __name__ == "__main__":
     unittest.main()
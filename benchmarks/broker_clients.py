@@ -0,0 +1,122 @@
+import argparse
+import time
+import uuid
+from unittest import mock
+from UnifiedAPI import adapter
+from UnifiedAPI.settings import PROJECT, TEST_TOPIC
+
+
+class StandInFuture:
+    """
+    Already completed send, matching the parts of the Kafka and Pub/Sub futures used by the brokers
+    """
+
+    def add_callback(self, *args, **kwargs):
+        return self
+
+    def add_errback(self, *args, **kwargs):
+        return self
+
+    def add_done_callback(self, *args, **kwargs):
+        pass
+
+    def get(self, timeout=None):
+        return None
+
+    def exception(self, timeout=None):
+        return None
+
+
+class StandInClient:
+    """
+    Local stand-in for a producer client. Creating one costs a connection and metadata handshake, sending is free
+    """
+
+    connect_ms = 0.
+    connections = 0
+
+    def __init__(self, *args, **kwargs):
+        StandInClient.connections += 1
+        time.sleep(self.connect_ms / 1000)
+
+    def send(self, *args, **kwargs) -> StandInFuture:
+        return StandInFuture()
+
+    def publish(self, *args, **kwargs) -> StandInFuture:
+        return StandInFuture()
+
+    def close(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def send_throughput(broker: adapter.MessageBroker, messages: int, reuse: bool) -> float:
+    """
+    :param broker: Broker whose producer client is a StandInClient
+    :param messages: Number of messages sent
+    :param reuse: Whether the producer client is reused between messages, otherwise it is closed after each message,
+    creating a new client per message
+    :return: Messages sent per second
+    """
+    start = time.perf_counter()
+    for _ in range(messages):
+        broker.send_message(TEST_TOPIC, {'id': str(uuid.uuid4())})
+        if not reuse:
+            broker.close()
+
+    return messages / (time.perf_counter() - start)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Compare send_message throughput with a client per message against a reused client"
+    )
+
+    parser.add_argument("--broker",
+                        default=["kafka", "pubsub"],
+                        nargs="+",
+                        choices=["kafka", "pubsub"],
+                        help="Brokers to benchmark",
+                        )
+
+    parser.add_argument("--messages",
+                        default=200,
+                        type=int,
+                        help="Number of messages sent per run",
+                        )
+
+    parser.add_argument("--connect-ms",
+                        default=10.,
+                        type=float,
+                        help="Simulated cost (milliseconds) of creating a client, i.e. connecting to the broker",
+                        )
+
+    args = parser.parse_args()
+
+    StandInClient.connect_ms = args.connect_ms
+
+    # Producer client replaced by the stand-in, by broker name
+    clients = {'kafka': "UnifiedAPI.kafka_broker.KafkaProducer", 'pubsub': "UnifiedAPI.pubsub_broker.PublisherClient"}
+
+    # Silencing per message delivery prints, which would otherwise dominate the timings
+    with mock.patch("builtins.print"):
+        results = []
+        for name in args.broker:
+            with mock.patch(clients[name], StandInClient):
+                for reuse in (False, True):
+                    StandInClient.connections = 0
+                    with adapter.create_broker(name, PROJECT) as broker:
+                        rate = send_throughput(broker, args.messages, reuse)
+                    results.append((name, reuse, rate, StandInClient.connections))
+
+    print(f"{'broker':<8} {'client':<12} {'messages/s':>12} {'connections':>12}")
+    for name, reuse, rate, connections in results:
+        print(f"{name:<8} {'reused' if reuse else 'per message':<12} {rate:>12.1f} {connections:>12}")
+
+
+if __name__ == "__main__":
+
+    main()
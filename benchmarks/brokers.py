@@ -0,0 +1,112 @@
+import argparse
+import threading
+import time
+import numpy as np
+from functools import partial
+from unittest import mock
+from UnifiedAPI import adapter
+from UnifiedAPI.settings import PROJECT
+from ImageClassifier.settings import IMG_HEIGHT, IMG_WIDTH
+
+BENCHMARK_TOPIC = "benchmark_topic"
+BENCHMARK_SUB = "benchmark_sub"
+
+# Brokers by name, local brokers need no running services and give the baseline cost of the adapter itself
+BROKERS = {
+    'local': partial(adapter.create_broker, "local", PROJECT, shared=False),
+    'local-shared': partial(adapter.create_broker, "local", PROJECT, shared=True),
+    'kafka': partial(adapter.create_broker, "kafka", PROJECT),
+    'pubsub': partial(adapter.create_broker, "pubsub", PROJECT),
+}
+
+
+def round_trip(broker: adapter.MessageBroker, messages: int, batch_size: int, images: bool) -> np.ndarray:
+    """
+    Send messages from one thread while consuming them in batches from another
+    :param broker: Broker with BENCHMARK_TOPIC and BENCHMARK_SUB created
+    :param messages: Number of messages sent
+    :param batch_size: Maximum number of messages consumed at once
+    :param images: Send an image in each message, otherwise only an id and send time
+    :return: Latency (milliseconds) from sending to consuming each message
+    """
+    image = np.zeros((IMG_HEIGHT, IMG_WIDTH), dtype=np.uint8)
+
+    def send():
+        for i in range(messages):
+            message = {'id': str(i), 'sent': time.perf_counter()}
+            if images:
+                message['image'] = image
+            broker.send_message(BENCHMARK_TOPIC, message, block=False)
+        broker.flush()
+
+    sender = threading.Thread(target=send)
+    sender.start()
+
+    latencies = []
+    for batch in broker.consume_batches(BENCHMARK_SUB, max_messages=batch_size, timeout=30):
+        received = time.perf_counter()
+        latencies.extend((received - message['sent']) * 1000 for message in batch)
+        if len(latencies) >= messages:
+            break
+
+    sender.join()
+    return np.array(latencies)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Measure send to consume throughput and latency of each broker, the local brokers giving a "
+                    "baseline without network or broker overhead"
+    )
+
+    parser.add_argument("--broker",
+                        default=["local", "local-shared"],
+                        nargs="+",
+                        choices=list(BROKERS),
+                        help="Brokers to benchmark, kafka and pubsub require running services",
+                        )
+
+    parser.add_argument("--messages",
+                        default=5000,
+                        type=int,
+                        help="Number of messages sent per broker",
+                        )
+
+    parser.add_argument("--batch-size",
+                        default=32,
+                        type=int,
+                        help="Maximum number of messages consumed at once",
+                        )
+
+    parser.add_argument("--no-images",
+                        action="store_true",
+                        help="Send small control messages rather than images",
+                        )
+
+    args = parser.parse_args()
+
+    results = []
+    for name in args.broker:
+        # Silencing per message delivery prints, which would otherwise dominate the timings
+        with mock.patch("builtins.print"), BROKERS[name]() as broker:
+            broker.create_topic(BENCHMARK_TOPIC)
+            broker.create_subscriber(BENCHMARK_SUB, BENCHMARK_TOPIC)
+
+            start = time.perf_counter()
+            latencies = round_trip(broker, args.messages, args.batch_size, not args.no_images)
+            elapsed = time.perf_counter() - start
+
+            broker.delete_subscriber(BENCHMARK_SUB)
+            broker.delete_topic(BENCHMARK_TOPIC)
+
+        results.append((name, len(latencies) / elapsed, *np.percentile(latencies, [50, 99])))
+
+    print(f"{'broker':<14} {'messages/s':>12} {'p50 ms':>10} {'p99 ms':>10}")
+    for name, rate, p50, p99 in results:
+        print(f"{name:<14} {rate:>12.1f} {p50:>10.3f} {p99:>10.3f}")
+
+
+if __name__ == "__main__":
+
+    main()
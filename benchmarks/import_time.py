@@ -0,0 +1,87 @@
+import argparse
+import pathlib
+import subprocess
+import sys
+from typing import List, Tuple
+
+# Modules imported by each entry point, and by each broker backend
+ENTRY_POINTS = [
+    "client",
+    "predictor",
+    "trainer",
+    "UnifiedAPI.adapter",
+    "UnifiedAPI.async_adapter",
+    "UnifiedAPI.local",
+    "UnifiedAPI.kafka_broker",
+    "UnifiedAPI.pubsub_broker",
+]
+
+ROOT = pathlib.Path(__file__).parents[1]
+
+
+def import_times(module: str) -> List[Tuple[str, int, int]]:
+    """
+    Import module in a fresh interpreter with -X importtime
+    :param module: Module to import
+    :return: (module name, self microseconds, cumulative microseconds) of every module imported
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        # Lines are "import time: self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times.append((name.strip(), int(self_us), int(cumulative_us)))
+
+    return times
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Summarise -X importtime of each entry point: total time and the slowest top level packages"
+    )
+
+    parser.add_argument("--module",
+                        default=ENTRY_POINTS,
+                        nargs="+",
+                        help="Modules to import",
+                        )
+
+    parser.add_argument("--top",
+                        default=5,
+                        type=int,
+                        help="Number of slowest top level packages shown per module",
+                        )
+
+    args = parser.parse_args()
+
+    for module in args.module:
+        try:
+            times = import_times(module)
+        except RuntimeError as e:
+            # e.g. a module whose optional dependencies are not installed
+            print(f"{module:<26} failed: {str(e).splitlines()[-1]}")
+            continue
+
+        total = next(cumulative for name, _, cumulative in times if name == module)
+
+        # Self time of every sub-module summed into its top level package
+        packages = {}
+        for name, self_us, _ in times:
+            package = name.split(".")[0]
+            packages[package] = packages.get(package, 0) + self_us
+
+        slowest = sorted(packages.items(), key=lambda item: -item[1])[:args.top]
+        print(f"{module:<26} {total / 1000:8.1f} ms  " +
+              ", ".join(f"{package} {us / 1000:.0f} ms" for package, us in slowest))
+
+
+if __name__ == "__main__":
+
+    main()
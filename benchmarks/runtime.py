@@ -0,0 +1,79 @@
+import argparse
+import pathlib
+import time
+import numpy as np
+import tensorflow as tf
+from ImageClassifier.settings import MODEL_DIR, DEFAULT_MNIST_MODEL, IMG_HEIGHT, IMG_WIDTH
+from ImageClassifier.runtime import ServingRuntime
+
+
+def time_calls(func, batch: np.ndarray, iterations: int) -> np.ndarray:
+    """
+    Time repeated calls of func on the same batch
+    :param func: Function taking batch as its only argument
+    :param batch: Model input
+    :param iterations: Number of timed calls
+    :return: Latency of each call in milliseconds
+    """
+    latencies = np.empty(iterations)
+    for i in range(iterations):
+        start = time.perf_counter()
+        func(batch)
+        latencies[i] = (time.perf_counter() - start) * 1000
+
+    return latencies
+
+
+def summarise(name: str, latencies: np.ndarray) -> None:
+    p50, p99 = np.percentile(latencies, [50, 99])
+    print(f"{name:<16} p50: {p50:8.3f} ms  p99: {p99:8.3f} ms  mean: {latencies.mean():8.3f} ms")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Compare model.predict latency against the traced ServingRuntime"
+    )
+
+    parser.add_argument("-model",
+                        default=DEFAULT_MNIST_MODEL,
+                        help=f"Name of trained model directory within {MODEL_DIR}"
+                        )
+
+    parser.add_argument("--batch-sizes",
+                        default=[1, 32],
+                        type=int,
+                        nargs="+",
+                        help="Batch sizes to benchmark",
+                        )
+
+    parser.add_argument("--iterations",
+                        default=200,
+                        type=int,
+                        help="Number of timed calls per batch size and inference path",
+                        )
+
+    args = parser.parse_args()
+
+    model_path = pathlib.Path(MODEL_DIR, args.model)
+    if not pathlib.Path.is_dir(model_path):
+        raise NotADirectoryError(f"Model {args.model} not found in {MODEL_DIR}")
+
+    model = tf.keras.models.load_model(model_path)
+    runtime = ServingRuntime(model, warmup_batch_sizes=args.batch_sizes)
+
+    rng = np.random.default_rng(0)
+    for batch_size in args.batch_sizes:
+        batch = rng.integers(0, 256, size=(batch_size, IMG_HEIGHT, IMG_WIDTH), dtype=np.uint8)
+        # model.predict expects the channel dimension the runtime adds internally
+        predict_batch = np.expand_dims(batch, -1)
+        model.predict(predict_batch, verbose=0)
+
+        print(f"\nBatch size: {batch_size}")
+        summarise("model.predict", time_calls(lambda x: model.predict(x, verbose=0), predict_batch, args.iterations))
+        summarise("runtime.infer", time_calls(runtime.infer, batch, args.iterations))
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import time
+import uuid
+import numpy as np
+from typing import Dict
+from UnifiedAPI.binary import is_image_message
+from UnifiedAPI.serializers import Serializer, CODECS, COMPRESSORS
+from ImageClassifier.settings import IMG_HEIGHT, IMG_WIDTH
+
+
+def time_calls(func, iterations: int) -> float:
+    """
+    :param func: Function called without arguments
+    :param iterations: Number of timed calls
+    :return: Mean time per call in microseconds
+    """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def payloads(batch_size: int) -> Dict[str, Dict]:
+    """
+    :param batch_size: Number of images in batched payloads
+    :return: Messages from small control messages up to batched image envelopes, by name
+    """
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, size=(IMG_HEIGHT, IMG_WIDTH), dtype=np.uint8)
+    batch = rng.integers(0, 256, size=(batch_size, IMG_HEIGHT, IMG_WIDTH), dtype=np.uint8)
+    message_id = str(uuid.uuid4())
+
+    return {
+        'control': {'id': message_id},
+        'prediction': {'id': message_id, 'predictions': {'Ankle boot': 0.91, 'Sandal': 0.06, 'Sneaker': 0.03}},
+        'image_list': {'id': message_id, 'image': image.tolist()},
+        'image': {'id': message_id, 'image': image},
+        f'batch{batch_size}_list': {'id': message_id, 'image': batch.tolist()},
+        f'batch{batch_size}': {'id': message_id, 'image': batch},
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Compare encode/decode time and message size of each codec and compression"
+    )
+
+    parser.add_argument("--iterations",
+                        default=500,
+                        type=int,
+                        help="Number of timed calls per payload, serializer and direction",
+                        )
+
+    parser.add_argument("--batch-size",
+                        default=32,
+                        type=int,
+                        help="Number of images in batched payloads",
+                        )
+
+    args = parser.parse_args()
+
+    codecs = [name for name, codec in CODECS.items() if codec.available]
+    compressions = [None] + [name for name, compressor in COMPRESSORS.items() if compressor.available]
+
+    print(f"{'payload':<14} {'codec':<8} {'compression':<12} {'bytes':>9} {'encode us':>10} {'decode us':>10}")
+    for payload_name, message in payloads(args.batch_size).items():
+        # numpy images are always sent in the binary image format, so only one codec applies
+        payload_codecs = ["image"] if is_image_message(message) else codecs
+
+        for codec in payload_codecs:
+            for compression in compressions:
+                serializer = Serializer("json" if codec == "image" else codec, compression, compress_threshold=0)
+                data, metadata = serializer.encode(message)
+
+                encode_time = time_calls(lambda: serializer.encode(message), args.iterations)
+                decode_time = time_calls(lambda: Serializer.decode(data, metadata), args.iterations)
+
+                print(f"{payload_name:<14} {codec:<8} {str(compression):<12} {len(data):>9} "
+                      f"{encode_time:>10.1f} {decode_time:>10.1f}")
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,338 @@
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from typing import Callable, Dict, List, Tuple
+from unittest import mock
+
+ROOT = pathlib.Path(__file__).parents[1]
+DEFAULT_BASELINE = pathlib.Path(__file__).with_name("baseline.json")
+
+# Allowed relative change of a result before it counts as a regression
+TOLERANCE = 0.1
+
+INFERENCE_BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512]
+
+# Benchmark cases by name, each returning results by metric name. Metric names end in _per_sec (higher is better) or
+# _ms (lower is better), which compare uses to decide the direction of a regression
+CASES: Dict[str, Callable[[float], Dict[str, float]]] = {}
+
+
+def case(name: str):
+    def register(func):
+        CASES[name] = func
+        return func
+    return register
+
+
+def measure(func: Callable[[], None], min_time: float, min_calls: int = 3) -> Tuple[float, float]:
+    """
+    Call func repeatedly for at least min_time seconds, after one untimed warm up call
+    :param func: Function called without arguments
+    :param min_time: Minimum total time (seconds) of timed calls
+    :param min_calls: Minimum number of timed calls
+    :return: Calls per second, and median latency (milliseconds) of a call
+    """
+    func()
+    latencies = []
+    start = time.perf_counter()
+    while len(latencies) < min_calls or time.perf_counter() - start < min_time:
+        call_start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - call_start)
+
+    return len(latencies) / sum(latencies), float(np.median(latencies) * 1000)
+
+
+@case("serialization")
+def serialization(min_time: float) -> Dict[str, float]:
+    from UnifiedAPI.adapter import MessageBroker
+    from UnifiedAPI.binary import is_image_message
+    from UnifiedAPI.serializers import Serializer
+    from benchmarks.serialization import payloads
+
+    results = {}
+    for name, message in payloads(32).items():
+        if is_image_message(message):
+            # numpy images are only sent in the binary image format
+            serializer = Serializer()
+            data, metadata = serializer.encode(message)
+            encode, decode = (lambda: serializer.encode(message)), (lambda: Serializer.decode(data, metadata))
+        else:
+            data = MessageBroker.encode_data(message)
+            encode, decode = (lambda: MessageBroker.encode_data(message)), (lambda: MessageBroker.decode_data(data))
+
+        results[f"serialization/{name}/encode_per_sec"] = measure(encode, min_time)[0]
+        results[f"serialization/{name}/decode_per_sec"] = measure(decode, min_time)[0]
+
+    return results
+
+
+@case("inference")
+def inference(min_time: float) -> Dict[str, float]:
+    from ImageClassifier.runtime import ServingRuntime
+    from ImageClassifier.settings import IMG_HEIGHT, IMG_WIDTH
+    from predictor import format_message_data
+    from trainer import create_model
+
+    # Untrained weights, inference time does not depend on them
+    runtime = ServingRuntime(create_model(10), warmup_batch_sizes=(1, max(INFERENCE_BATCH_SIZES)))
+    rng = np.random.default_rng(0)
+
+    results = {}
+    for batch_size in INFERENCE_BATCH_SIZES:
+        messages = [{'image': image} for image in
+                    rng.integers(0, 256, size=(batch_size, IMG_HEIGHT, IMG_WIDTH), dtype=np.uint8)]
+        calls_per_sec, latency = measure(lambda: runtime.infer(format_message_data(messages)), min_time)
+        results[f"inference/batch{batch_size}/images_per_sec"] = calls_per_sec * batch_size
+        results[f"inference/batch{batch_size}/latency_ms"] = latency
+
+    return results
+
+
+@case("postprocess")
+def postprocess_batches(min_time: float) -> Dict[str, float]:
+    from App.postprocess import postprocess
+    from predictor import CLASS_NAMES
+
+    rng = np.random.default_rng(0)
+    results = {}
+    for batch_size in (1, 32, 512):
+        probs = rng.dirichlet(np.ones(len(CLASS_NAMES)), size=batch_size).astype(np.float32)
+        for name, kwargs in (("threshold", {}), ("top3_compact", {'top_k': 3, 'compact': True})):
+            calls_per_sec, _ = measure(lambda: postprocess(probs, CLASS_NAMES, **kwargs), min_time)
+            results[f"postprocess/{name}/batch{batch_size}/rows_per_sec"] = calls_per_sec * batch_size
+
+    return results
+
+
+@case("broker")
+def broker_round_trip(min_time: float) -> Dict[str, float]:
+    from UnifiedAPI import adapter
+    from UnifiedAPI.settings import PROJECT
+    from benchmarks.brokers import BENCHMARK_TOPIC, BENCHMARK_SUB, round_trip
+
+    # Local brokers stand in for Kafka and Pub/Sub, measuring the adapter, serialization and batching without a network
+    messages = max(500, int(5000 * min_time))
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        for name, kwargs in (("local", {'shared': False}), ("local-shared", {'shared': True, 'root': root})):
+            with mock.patch("builtins.print"), adapter.create_broker("local", PROJECT, **kwargs) as broker:
+                broker.create_topic(BENCHMARK_TOPIC)
+                broker.create_subscriber(BENCHMARK_SUB, BENCHMARK_TOPIC)
+
+                start = time.perf_counter()
+                latencies = round_trip(broker, messages, batch_size=32, images=True)
+                elapsed = time.perf_counter() - start
+                broker.delete_topic(BENCHMARK_TOPIC)
+
+            results[f"broker/{name}/messages_per_sec"] = len(latencies) / elapsed
+            results[f"broker/{name}/p50_ms"], results[f"broker/{name}/p99_ms"] = np.percentile(latencies, [50, 99])
+
+    return {key: float(value) for key, value in results.items()}
+
+
+@case("pipeline")
+def input_pipeline(min_time: float) -> Dict[str, float]:
+    import tensorflow as tf
+    from ImageClassifier import shards
+    from ImageClassifier.settings import IMG_HEIGHT, IMG_WIDTH
+    from trainer import preprocess, configure_for_performance
+
+    # Synthetic image directory in the layout preprocess expects: one subdirectory of PNG images per class
+    num_images = max(200, int(2000 * min_time))
+    rng = np.random.default_rng(0)
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        dataset_path = pathlib.Path(root, "dataset")
+        for i in range(num_images):
+            class_dir = dataset_path.joinpath(f"class{i % 10}")
+            class_dir.mkdir(parents=True, exist_ok=True)
+            image = rng.integers(0, 256, size=(IMG_HEIGHT, IMG_WIDTH, 1), dtype=np.uint8)
+            tf.io.write_file(str(class_dir.joinpath(f"{i}.png")), tf.io.encode_png(image))
+
+        shard_dir = pathlib.Path(root, "shards")
+        start = time.perf_counter()
+        manifest = shards.ingest(dataset_path, shard_dir)
+        results["pipeline/ingest/images_per_sec"] = num_images / (time.perf_counter() - start)
+
+        image_ds = configure_for_performance(preprocess(dataset_path)[0])
+        shard_ds = configure_for_performance(shards.read_split(shard_dir, manifest, "train", shuffle=True))
+
+        # First epoch reads every file (decoding images, or parsing records), later epochs are served from the cache
+        for name, train_ds in (("images", image_ds), ("shards", shard_ds)):
+            for epoch in ("first_epoch", "cached_epoch"):
+                images = 0
+                start = time.perf_counter()
+                for batch, _ in train_ds:
+                    images += len(batch)
+                results[f"pipeline/{name}/{epoch}/images_per_sec"] = images / (time.perf_counter() - start)
+
+    return results
+
+
+def machine_info() -> Dict:
+    info = {
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+    }
+    if "tensorflow" in sys.modules:
+        info['tensorflow'] = sys.modules["tensorflow"].__version__
+
+    try:
+        info['git_commit'] = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+    return info
+
+
+def run(cases: List[str], min_time: float) -> Dict:
+    """
+    :param cases: Names of cases to run
+    :param min_time: Minimum time (seconds) each measurement runs for
+    :return: Results by metric name, cases skipped (e.g. missing optional dependencies) and machine information
+    """
+    results, skipped = {}, {}
+    for name in cases:
+        print(f"Running {name}")
+        try:
+            results.update(CASES[name](min_time))
+        except ImportError as e:
+            print(f"Skipping {name}: {e}")
+            skipped[name] = str(e)
+
+    return {
+        'created': datetime.datetime.now().isoformat(timespec="seconds"),
+        'machine': machine_info(),
+        'min_time': min_time,
+        'results': results,
+        'skipped': skipped,
+    }
+
+
+def compare(baseline: Dict, current: Dict, tolerance: float = TOLERANCE) -> List[Tuple[str, float, float, float, bool]]:
+    """
+    :param baseline: Results of a stored run
+    :param current: Results of the run being checked
+    :param tolerance: Allowed relative change in the worse direction
+    :return: (metric, baseline value, current value, relative change, regressed) of each metric in both runs. A
+    positive change is an improvement, whichever direction is better for the metric
+    """
+    rows = []
+    for metric in sorted(set(baseline['results']) & set(current['results'])):
+        before, after = baseline['results'][metric], current['results'][metric]
+        if not before:
+            continue
+
+        change = (after - before) / before
+        if metric.endswith("_ms"):
+            change = -change
+        rows.append((metric, before, after, change, change < -tolerance))
+
+    return rows
+
+
+def missing_metrics(baseline: Dict, current: Dict) -> List[str]:
+    """
+    :param baseline: Results of a stored run
+    :param current: Results of the run being checked
+    :return: Metrics of the baseline absent from the current run, e.g. of a renamed, failed or skipped case
+    """
+    return sorted(set(baseline['results']) - set(current['results']))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark suite: run cases and write JSON results, or compare results against a baseline"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run benchmark cases")
+
+    run_parser.add_argument("--cases",
+                            default=list(CASES),
+                            nargs="+",
+                            choices=list(CASES),
+                            help="Cases to run, all by default",
+                            )
+
+    run_parser.add_argument("--min-time",
+                            default=1.,
+                            type=float,
+                            help="Minimum time (seconds) each measurement runs for, lower is faster but noisier",
+                            )
+
+    run_parser.add_argument("--output",
+                            default="benchmark_results.json",
+                            help="JSON file results are written to",
+                            )
+
+    compare_parser = subparsers.add_parser("compare", help="Flag regressions of results against a baseline")
+
+    compare_parser.add_argument("results",
+                                help="JSON results of the run being checked",
+                                )
+
+    compare_parser.add_argument("--baseline",
+                                default=DEFAULT_BASELINE,
+                                help="JSON results of a stored run, written by run --output",
+                                )
+
+    compare_parser.add_argument("--tolerance",
+                                default=TOLERANCE,
+                                type=float,
+                                help="Allowed relative change in the worse direction, e.g. 0.1 = 10%%",
+                                )
+
+    compare_parser.add_argument("--allow-missing",
+                                action="store_true",
+                                help="Do not count baseline metrics missing from the results as regressions",
+                                )
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run(args.cases, args.min_time)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        current = json.load(f)
+
+    if baseline['machine'].get('processor') != current['machine'].get('processor'):
+        print("Warning: baseline was recorded on a different processor")
+
+    rows = compare(baseline, current, args.tolerance)
+    missing = missing_metrics(baseline, current)
+    print(f"{'metric':<48} {'baseline':>12} {'current':>12} {'change':>8}")
+    for metric, before, after, change, regressed in rows:
+        print(f"{metric:<48} {before:>12.3f} {after:>12.3f} {change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+    for metric in missing:
+        print(f"{metric:<48} {baseline['results'][metric]:>12.3f} {'missing':>12} {'':>8}"
+              f"{'' if args.allow_missing else '  REGRESSION'}")
+
+    regressions = sum(regressed for *_, regressed in rows) + (0 if args.allow_missing else len(missing))
+    print(f"{regressions} of {len(rows) + len(missing)} metrics regressed beyond {args.tolerance:.0%} or missing")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,63 @@
+import json
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+from benchmarks.suite import compare, main, missing_metrics
+
+
+def results(metrics):
+    return {'machine': {}, 'results': metrics}
+
+
+class CompareTest(unittest.TestCase):
+
+    def test_directions(self):
+        baseline = results({"a/images_per_sec": 100., "b/images_per_sec": 100.,
+                            "a/latency_ms": 100., "b/latency_ms": 100.})
+        current = results({"a/images_per_sec": 80., "b/images_per_sec": 120.,
+                           "a/latency_ms": 120., "b/latency_ms": 80.})
+
+        rows = {metric: (change, regressed) for metric, _, _, change, regressed in compare(baseline, current, 0.1)}
+        # Fewer per second and more milliseconds are both worse, and reported as a negative change
+        self.assertEqual(rows, {
+            "a/images_per_sec": (-0.2, True),
+            "b/images_per_sec": (0.2, False),
+            "a/latency_ms": (-0.2, True),
+            "b/latency_ms": (0.2, False),
+        })
+
+    def test_tolerance_edge(self):
+        baseline = results({"a/images_per_sec": 100., "a/latency_ms": 100., "b/latency_ms": 100.})
+        current = results({"a/images_per_sec": 90., "a/latency_ms": 110., "b/latency_ms": 110.5})
+
+        regressed = {metric: regressed for metric, *_, regressed in compare(baseline, current, 0.1)}
+        # Changes of exactly the tolerance are allowed
+        self.assertEqual(regressed, {"a/images_per_sec": False, "a/latency_ms": False, "b/latency_ms": True})
+
+    def test_missing(self):
+        baseline = results({"a/images_per_sec": 100., "b/latency_ms": 100., "c/latency_ms": 0.})
+        current = results({"a/images_per_sec": 100., "d/latency_ms": 100.})
+
+        self.assertEqual([row[0] for row in compare(baseline, current)], ["a/images_per_sec"])
+        self.assertEqual(missing_metrics(baseline, current), ["b/latency_ms", "c/latency_ms"])
+        self.assertEqual(missing_metrics(current, current), [])
+
+    @mock.patch('builtins.print')
+    def test_missing_fails_compare(self, mock_print):
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [Path(tmp, "baseline.json"), Path(tmp, "results.json")]
+            for path, metrics in zip(paths, [{"a/latency_ms": 100., "b/latency_ms": 100.}, {"a/latency_ms": 100.}]):
+                path.write_text(json.dumps(results(metrics)))
+
+            for extra_args, status in (([], 1), (["--allow-missing"], 0)):
+                argv = ["suite.py", "compare", str(paths[1]), "--baseline", str(paths[0]), *extra_args]
+                with mock.patch.object(sys, "argv", argv), self.assertRaises(SystemExit) as exit_info:
+                    main()
+                self.assertEqual(exit_info.exception.code, status)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import argparse
+import json
+import pathlib
+import sys
+import tempfile
+import numpy as np
+import tensorflow as tf
+from typing import Dict, List
+from ImageClassifier import shards
+from ImageClassifier.distributed import get_strategy, launch_local_workers, shard_options, worker_info
+from ImageClassifier.settings import BATCH_SIZE, IMG_HEIGHT, IMG_WIDTH
+from ImageClassifier.training import ThroughputCallback
+from benchmarks.suite import machine_info
+
+
+def make_dataset(root: pathlib.Path, num_images: int, max_workers: int) -> pathlib.Path:
+    """
+    Write a synthetic 10 class PNG dataset and ingest it, with enough training shards to shard them by file
+    :return: Shard directory
+    """
+    rng = np.random.default_rng(0)
+    dataset_path = root.joinpath("dataset")
+    for i in range(num_images):
+        class_dir = dataset_path.joinpath(f"class{i % 10}")
+        class_dir.mkdir(parents=True, exist_ok=True)
+        image = rng.integers(0, 256, size=(IMG_HEIGHT, IMG_WIDTH, 1), dtype=np.uint8)
+        tf.io.write_file(str(class_dir.joinpath(f"{i}.png")), tf.io.encode_png(image))
+
+    shard_dir = root.joinpath("shards")
+    # Two training shards per worker of the largest run
+    shards.ingest(dataset_path, shard_dir, shard_size=max(1, num_images * 8 // 10 // (2 * max_workers)))
+    return shard_dir
+
+
+def run_worker(shard_dir: pathlib.Path, epochs: int, result: pathlib.Path) -> None:
+    """
+    Train on the ingested training split with the trainer's model and input pipeline, the chief writing the throughput
+    of each epoch to result
+    """
+    from trainer import create_model, configure_for_performance
+
+    strategy = get_strategy()
+    num_workers, _, chief = worker_info(strategy)
+    manifest = shards.load_manifest(shard_dir)
+
+    ds = shards.read_split(shard_dir, manifest, "train", shuffle=True)
+    ds = ds.with_options(shard_options(len(manifest['splits']['train']['files']), num_workers))
+    ds = configure_for_performance(ds, batch_size=BATCH_SIZE * strategy.num_replicas_in_sync)
+
+    with strategy.scope():
+        model = create_model(len(manifest['class_names']))
+    throughput = ThroughputCallback(manifest['splits']['train']['num_images'], verbose=chief)
+    model.fit(ds, epochs=epochs, callbacks=[throughput], verbose=0)
+
+    if chief:
+        with open(result, "w") as f:
+            json.dump(throughput.epochs, f)
+
+
+def scaling_report(workers: List[int], num_images: int, epochs: int) -> Dict:
+    """
+    Train with each number of local worker processes in turn
+    :return: Images per second of each run, averaged over epochs after the first (which includes tracing), with the
+    speedup and efficiency relative to the first run
+    """
+    runs = []
+    with tempfile.TemporaryDirectory() as root:
+        shard_dir = make_dataset(pathlib.Path(root), num_images, max(workers))
+
+        for num_workers in workers:
+            print(f"Training with {num_workers} workers")
+            result = pathlib.Path(root, f"{num_workers}.json")
+            command = [sys.executable, "-m", "benchmarks.training_scaling", "--worker", "--shard-dir", str(shard_dir),
+                       "--epochs", str(epochs), "--result", str(result)]
+
+            if launch_local_workers(command, num_workers) != 0 or not result.exists():
+                runs.append({'workers': num_workers, 'failed': True})
+                continue
+
+            with open(result) as f:
+                epoch_results = json.load(f)
+            steady = epoch_results[1:] or epoch_results
+            runs.append({
+                'workers': num_workers,
+                'images_per_sec': float(np.mean([epoch['images_per_sec'] for epoch in steady])),
+                'epochs': epoch_results,
+            })
+
+    baseline = next((run for run in runs if not run.get('failed')), None)
+    for run in runs:
+        if baseline is not None and not run.get('failed'):
+            run['speedup'] = run['images_per_sec'] / baseline['images_per_sec']
+            run['efficiency'] = run['speedup'] * baseline['workers'] / run['workers']
+
+    return {'machine': machine_info(), 'num_images': num_images, 'batch_size_per_worker': BATCH_SIZE, 'runs': runs}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Training throughput with 1, 2 and 4 local worker processes, to decide on multi-worker node counts"
+    )
+
+    parser.add_argument("--workers",
+                        default=[1, 2, 4],
+                        type=int,
+                        nargs="+",
+                        help="Numbers of workers to train with",
+                        )
+
+    parser.add_argument("--num-images",
+                        default=20000,
+                        type=int,
+                        help="Number of synthetic images in the dataset",
+                        )
+
+    parser.add_argument("--epochs",
+                        default=3,
+                        type=int,
+                        help="Epochs per run, the first is excluded from the throughput",
+                        )
+
+    parser.add_argument("--output",
+                        default="scaling_report.json",
+                        help="JSON file the report is written to",
+                        )
+
+    # Used by the worker processes the report launches
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--shard-dir", type=pathlib.Path, help=argparse.SUPPRESS)
+    parser.add_argument("--result", type=pathlib.Path, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.shard_dir, args.epochs, args.result)
+        return
+
+    report = scaling_report(args.workers, args.num_images, args.epochs)
+    print(f"{'workers':>8} {'images/sec':>12} {'speedup':>8} {'efficiency':>10}")
+    for run in report['runs']:
+        if run.get('failed'):
+            print(f"{run['workers']:>8} {'failed':>12}")
+        else:
+            print(f"{run['workers']:>8} {run['images_per_sec']:>12.0f} {run['speedup']:>8.2f} "
+                  f"{run['efficiency']:>10.0%}")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+
+    main()
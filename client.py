@@ -1,49 +1,138 @@
 import asyncio
 import argparse
-import tensorflow as tf
-from App.settings import REQUEST_TOPIC, CLIENT_SUB, RETURN_TOPIC
-from UnifiedAPI import adapter
-from UnifiedAPI.settings import PROJECT, BROKERS
+import json
+import time
+import uuid
+import numpy as np
+from typing import List
+from App.examples import load_test_images
+from App.loadgen import InFlight, LatencyTracker, ScheduledRequest, arrival_schedule, replay_schedule, \
+    record_schedule
+from App.settings import REQUEST_TOPIC, CLIENT_SUB, RETURN_TOPIC, MAX_IN_FLIGHT, NUM_REQUESTS, REQUEST_RATE, \
+    RESPONSE_TIMEOUT, CLIENT_RESULTS
+from UnifiedAPI import async_adapter
+from UnifiedAPI.log import LOG_LEVELS, set_log_level
+from UnifiedAPI.serializers import CODECS, COMPRESSORS, Serializer
+from UnifiedAPI.settings import PROJECT, BROKERS, LOG_LEVEL
 
 
-async def send_predictions(broker: adapter.MessageBroker) -> None:
+async def send_request(broker: async_adapter.AsyncMessageBroker, data: dict, tracker: LatencyTracker,
+                       in_flight: InFlight) -> None:
     """
-    Send request (image) to message broker topic to be consumed by model server
-    :param broker: MessageBroker concrete class used to send messages
-    :return: None, broker will print id of sent messages
+    Send one request, recording it as lost (and freeing its slot) if delivery to the broker fails
     """
-    fashion_mnist = tf.keras.datasets.fashion_mnist
+    try:
+        await broker.send(REQUEST_TOPIC, data)
+    except Exception:
+        tracker.send_failed(data['id'])
+        in_flight.complete(data['id'])
 
-    _, (test_images, test_labels) = fashion_mnist.load_data()
 
-    # Sending first 50 images for prediction
-    test_images = test_images[:50]
+async def send_predictions(broker: async_adapter.AsyncMessageBroker, schedule: List[ScheduledRequest],
+                           images: np.ndarray, tracker: LatencyTracker, in_flight: InFlight,
+                           binary: bool = True) -> None:
+    """
+    Send requests (images) to message broker topic to be consumed by model server, each at its scheduled time without
+    waiting for earlier requests to be delivered or answered (open loop), unless the in-flight limit is reached
+    :param broker: AsyncMessageBroker concrete class used to send messages
+    :param schedule: Requests to send, with their offsets (seconds) from the start of sending
+    :param images: Test images, memory-mapped so that only those sent are read
+    :param tracker: Records the send time of each request
+    :param in_flight: Requests awaiting a response, sending waits while it is full until a response arrives or a
+    request times out
+    :param binary: Send images in the binary image format, otherwise as JSON lists
+    :return: None, once every request has been delivered or has failed
+    """
+    sends = []
+    start = time.perf_counter()
+
+    for offset, index, options in schedule:
+        delay = start + offset - time.perf_counter()
+        # Yielding even when behind schedule, so responses are still received
+        await asyncio.sleep(max(delay, 0))
+
+        image = np.asarray(images[index % len(images)])
+        # Id assigned before sending, as the response may arrive before send returns
+        data = {'id': str(uuid.uuid4()), 'image': image if binary else image.tolist(), **options}
+        await in_flight.add(data['id'])
 
-    for i, e in enumerate(test_images):
-        data = {'image': e.tolist()}
-        broker.send_message(REQUEST_TOPIC, data)
-        await asyncio.sleep(1)
+        tracker.sent(data['id'], time.perf_counter(), scheduled_time=start + offset)
+        sends.append(asyncio.create_task(send_request(broker, data, tracker, in_flight)))
 
+    await asyncio.gather(*sends)
 
-async def run(broker: adapter.MessageBroker) -> None:
+
+async def receive_predictions(broker: async_adapter.AsyncMessageBroker, tracker: LatencyTracker, in_flight: InFlight,
+                              print_responses: bool = False) -> None:
     """
-    Asynchronous wrapper sending requests to model server and processing responses as they return
-    :param broker: MessageBroker concrete class to send and consume messages
-    :return: None
+    Record model server responses as they return, matched to requests by id
+    :param broker: AsyncMessageBroker concrete class consuming responses
+    :param tracker: Records the receive time of each response
+    :param in_flight: Requests awaiting a response, each response frees a slot
+    :param print_responses: Print each response
+    :return: None, consumes until cancelled
     """
-    await asyncio.gather(
-        asyncio.to_thread(broker.consume, CLIENT_SUB),
-        send_predictions(broker),
-    )
+    async for message in broker.consume(CLIENT_SUB):
+        tracker.received(message.get('id'), time.perf_counter())
+        in_flight.complete(message.get('id'))
+        if print_responses:
+            print(message)
+
+
+async def expire_requests(in_flight: InFlight, interval: float = 0.1) -> None:
+    """
+    Free the slots of requests unanswered within the response timeout, so that lost requests cannot stall sending
+    :return: None, runs until cancelled
+    """
+    while True:
+        in_flight.expire()
+        await asyncio.sleep(interval)
+
+
+async def run(broker: async_adapter.AsyncMessageBroker, schedule: List[ScheduledRequest], images: np.ndarray,
+              binary: bool = True, max_in_flight: int = MAX_IN_FLIGHT, response_timeout: float = RESPONSE_TIMEOUT,
+              print_responses: bool = False) -> LatencyTracker:
+    """
+    Send requests to model server and process responses as they return, both from the same event loop. Once every
+    request is sent, waits up to response_timeout for the remaining responses
+    :param broker: AsyncMessageBroker concrete class to send and consume messages
+    :param schedule: Requests to send, with their offsets (seconds) from the start of sending
+    :param images: Test images
+    :param binary: Send images in the binary image format, otherwise as JSON lists
+    :param max_in_flight: Maximum number of requests awaiting a response, 0 = no limit
+    :param response_timeout: Time (seconds) after which a request without response counts as timed out
+    :param print_responses: Print each response
+    :return: Send and receive times of every request
+    """
+    tracker = LatencyTracker()
+    in_flight = InFlight(max_in_flight, response_timeout)
+
+    async with broker:
+        receiver = asyncio.create_task(receive_predictions(broker, tracker, in_flight, print_responses))
+        expiry = asyncio.create_task(expire_requests(in_flight))
+        try:
+            await send_predictions(broker, schedule, images, tracker, in_flight, binary)
+
+            deadline = time.perf_counter() + response_timeout
+            while tracker.outstanding and time.perf_counter() < deadline and not receiver.done():
+                await asyncio.sleep(0.01)
+        finally:
+            receiver.cancel()
+            expiry.cancel()
+            await asyncio.gather(receiver, expiry, return_exceptions=True)
+
+    return tracker
 
 
 def main():
     """
-    Mimicking client by sending test data to model server, while simultaneously consuming responses
+    Load generator mimicking clients: sends test images to the model server at a target rate, or replays recorded
+    traffic, while consuming responses, then reports throughput and latency
     """
 
     parser = argparse.ArgumentParser(
-        description="Sending requests to model server and receive response via message broker"
+        description="Sending requests to model server and receive response via message broker, measuring throughput "
+                    "and latency"
     )
 
     parser.add_argument("--broker",
@@ -52,22 +141,127 @@ def main():
                         help=f"Broker to send messages",
                         )
 
+    parser.add_argument("--codec",
+                        default="json",
+                        choices=list(CODECS),
+                        help="Codec used to encode messages without images, falls back to json if not installed",
+                        )
+
+    parser.add_argument("--compression",
+                        default=None,
+                        choices=list(COMPRESSORS),
+                        help="Compression applied to messages above the size threshold, none by default",
+                        )
+
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="Send images as JSON lists rather than binary, for model servers without binary support",
+                        )
+
+    parser.add_argument("--num-requests",
+                        default=NUM_REQUESTS,
+                        type=int,
+                        help="Number of requests sent, test images are reused once exhausted",
+                        )
+
+    parser.add_argument("--rate",
+                        default=REQUEST_RATE,
+                        type=float,
+                        help="Target requests per second, 0 = send all at once (or as fast as --max-in-flight allows)",
+                        )
+
+    parser.add_argument("--arrivals",
+                        default="constant",
+                        choices=["constant", "poisson"],
+                        help="Constant spacing between requests, or poisson arrivals averaging --rate",
+                        )
+
+    parser.add_argument("--seed",
+                        default=None,
+                        type=int,
+                        help="Random seed of poisson arrivals",
+                        )
+
+    parser.add_argument("--replay",
+                        default=None,
+                        help="JSONL traffic file replayed instead of sending at --rate, one request per line with "
+                             "optional time (seconds from start), image (test image index) and request options",
+                        )
+
+    parser.add_argument("--time-scale",
+                        default=1.,
+                        type=float,
+                        help="Multiplier of replayed times, e.g. 0.5 replays at twice the recorded rate",
+                        )
+
+    parser.add_argument("--record",
+                        default=None,
+                        help="Write the requests sent to this JSONL traffic file, which --replay reads back",
+                        )
+
+    parser.add_argument("--max-in-flight",
+                        default=MAX_IN_FLIGHT,
+                        type=int,
+                        help="Maximum number of requests awaiting a response, sending waits once reached (0 = no "
+                             "limit, fully open loop)",
+                        )
+
+    parser.add_argument("--response-timeout",
+                        default=RESPONSE_TIMEOUT,
+                        type=float,
+                        help="Time (seconds) after which a request without response counts as timed out",
+                        )
+
+    parser.add_argument("--results",
+                        default=CLIENT_RESULTS,
+                        help="JSON file throughput and latency results are written to",
+                        )
+
+    parser.add_argument("--print-responses",
+                        action="store_true",
+                        help="Print each response as it arrives",
+                        )
+
+    parser.add_argument("--log-level",
+                        default=LOG_LEVEL,
+                        choices=list(LOG_LEVELS),
+                        help="Lowest level of messages printed, debug prints every request sent",
+                        )
+
     args = parser.parse_args()
+    set_log_level(args.log_level)
 
-    # TODO: Function in UnifiedAPI that automates this, removes double dependency between here and BROKERS variable
-    if args.broker == "pubsub":
-        broker = adapter.PubsubBroker(PROJECT)
-    elif args.broker == "kafka":
-        broker = adapter.KafkaBroker(PROJECT)
+    if args.replay:
+        schedule = list(replay_schedule(args.replay, args.time_scale))
     else:
-        raise ValueError
+        schedule = list(arrival_schedule(args.num_requests, args.rate, args.arrivals, args.seed))
+
+    if args.record:
+        record_schedule(args.record, schedule)
+
+    images = load_test_images()
+
+    # Only the client library of the chosen broker is imported
+    serializer = Serializer(args.codec, args.compression)
+    broker = async_adapter.create_async_broker(args.broker, PROJECT, serializer=serializer)
 
     # Ensure topic is created (if predictor not yet run)
     broker.create_topic(RETURN_TOPIC)
     # Create subscriber to receive model predictions
     broker.create_subscriber(CLIENT_SUB, RETURN_TOPIC)
 
-    asyncio.run(run(broker))
+    tracker = asyncio.run(run(broker, schedule, images, binary=not args.json, max_in_flight=args.max_in_flight,
+                              response_timeout=args.response_timeout, print_responses=args.print_responses))
+
+    summary = tracker.summary(args.response_timeout)
+    for key, value in summary.items():
+        print(f"{key:<18} {value:.3f}" if isinstance(value, float) else f"{key:<18} {value}")
+
+    config = {key: value for key, value in vars(args).items()
+              if key not in ("results", "print_responses", "log_level")}
+    with open(args.results, "w") as f:
+        json.dump({'config': config, 'results': summary}, f, indent=2)
+    print(f"Results written to {args.results}")
 
 
 if __name__ == "__main__":
@@ -1,54 +1,218 @@
 import argparse
+import asyncio
 import pathlib
 import numpy as np
-import tensorflow as tf
-from ImageClassifier.settings import MODEL_DIR, DEFAULT_MNIST_MODEL
-from App.settings import REQUEST_TOPIC, RETURN_TOPIC, MODEL_SUB
+from collections import Counter
+from concurrent.futures import Future
+from functools import partial
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from ImageClassifier.settings import MODEL_DIR, DEFAULT_MNIST_MODEL, IMG_HEIGHT, IMG_WIDTH, EXAMPLE_TF_DATASET, \
+    REGISTRY_PATH
+from ImageClassifier.registry import ModelRegistry
+from ImageClassifier.runtime import RUNTIMES, ServingRuntime, load_runtime
+from ImageClassifier.export import QUANTIZATION_MODES
+from App.batcher import AsyncDynamicBatcher
+from App.cache import PredictionCache, SqliteCacheBackend
+from App.postprocess import postprocess, request_options
+from App.reloader import ModelReloader
+from App.workers import WorkerPool
+from App.settings import REQUEST_TOPIC, RETURN_TOPIC, MODEL_SUB, MAX_BATCH_SIZE, MAX_WAIT_MS, MAX_QUEUE_SIZE, \
+    NUM_WORKERS, REPORT_INTERVAL, CACHE_MAX_BYTES, CACHE_TTL, RELOAD_INTERVAL, PREDICTION_THRESHOLD, TOP_K
 from UnifiedAPI import adapter
-from UnifiedAPI.settings import PROJECT, BROKERS
-# TODO: Load latest version of given model
-# TODO: Load and parse class names
-# TODO: Generalise format_message_data, implement batching in place of np.expand_dims and passing individual images
+from UnifiedAPI.log import LOG_LEVELS, set_log_level
+from UnifiedAPI.metrics import REGISTRY
+from UnifiedAPI.serializers import CODECS, COMPRESSORS, Serializer
+from UnifiedAPI.settings import PROJECT, BROKERS, MAX_OUTSTANDING_MESSAGES, MAX_OUTSTANDING_BYTES, LOG_LEVEL, \
+    METRICS_PORT, METRICS_INTERVAL, BATCH_SIZE_BUCKETS
 
+# Class names of models missing from the registry
+CLASS_NAMES = np.array(['T-shirt/top', 'Trouser', 'Pullover', 'Dress', 'Coat',
+                        'Sandal', 'Shirt', 'Sneaker', 'Bag', 'Ankle boot'])
 
-def format_message_data(data):
+# Predictor series, alongside the broker series of UnifiedAPI.adapter in the same registry
+QUEUE_WAIT_SECONDS = REGISTRY.histogram("predictor_queue_wait_seconds", "Time a request waits to be batched")
+BATCH_SIZE = REGISTRY.histogram("predictor_batch_size", "Requests per batch", buckets=BATCH_SIZE_BUCKETS)
+INFERENCE_SECONDS = REGISTRY.histogram("predictor_inference_seconds", "Time to predict a batch, including cache hits")
+POSTPROCESS_SECONDS = REGISTRY.histogram("predictor_postprocess_seconds", "Time to postprocess a batch")
+REQUESTS_TOTAL = REGISTRY.counter("predictor_requests_total", "Requests predicted")
+
+
+def format_message_data(messages: List[Dict]) -> np.ndarray:
     """
-    Format data into usable format by model
-    :param data: data extracted from client message
-    :return: numpy image
+    Format a batch of client messages into a single array usable by the model
+    :param messages: data extracted from client messages
+    :return: numpy array of images, first dimension is the batch
     """
-    img = np.array(data['image'], dtype=np.uint8)
-    img = np.expand_dims(img, 0)
-    return img
+    return np.stack([np.asarray(data['image'], dtype=np.uint8) for data in messages])
 
 
-def get_prediction(message, broker: adapter.MessageBroker) -> None:
+def get_prediction(requests: List[Tuple[Dict, adapter.MessageBroker]], runtime: ServingRuntime,
+                   cache: PredictionCache = None, **kwargs) -> None:
     """
-    Passing client requests through model to make predictions, sending back via message broker
-    :param message: Client request to be processed
-    :param broker: MessageBroker concrete class to return predictions to model server
+    Passing a batch of client requests through model in a single forward pass, sending each prediction back via
+    the message broker it was received from, under the id of its request
+    :param requests: Client requests to be processed, paired with the broker they were consumed from
+    :param runtime: Serving runtime used to make predictions
+    :param cache: Optional cache of previous predictions, only images not found are passed through the model
+    :param kwargs: Default postprocessing options passed to return_predictions
     :return:
     """
-    img = format_message_data(message)
-    probs = model.predict(img)
+    messages = [message for message, _ in requests]
+    imgs = format_message_data(messages)
 
-    result = {name: round(float(p), 2) for name, p in zip(class_names, probs[0]) if p > 0.05}
-    out = {'id': message['id'], 'predictions': result}
-    broker.send_message(RETURN_TOPIC, out)
+    with INFERENCE_SECONDS.time():
+        if cache is None:
+            probs = runtime.infer(imgs)
+        else:
+            # Clears cache if the model has changed since the last batch
+            cache.set_model(runtime.model_id)
+            probs = cache.predict(imgs, runtime.infer)
 
+    class_names = runtime.class_names if runtime.class_names is not None else CLASS_NAMES
+    return_predictions(requests, probs, class_names, **kwargs)
 
-def main():
-    # TODO: This should run all available brokers, consuming them in parallel/asynchronously
-    pass
 
+def dispatch_prediction(requests: List[Tuple[Dict, adapter.MessageBroker]], pool: WorkerPool) -> Future:
+    """
+    Hand a batch of client requests to the worker pool, predictions are returned by the pool once processed
+    :param requests: Client requests to be processed, paired with the broker they were consumed from
+    :param pool: Started WorkerPool, with return_predictions as its handler
+    :return: Future completed once the predictions have been returned
+    """
+    messages = [message for message, _ in requests]
+    return pool.submit(requests, format_message_data(messages))
 
-if __name__ == "__main__":
+
+def return_predictions(requests: List[Tuple[Dict, adapter.MessageBroker]], probs: np.ndarray,
+                       class_names: Sequence[str] = CLASS_NAMES, threshold: float = PREDICTION_THRESHOLD,
+                       top_k: int = TOP_K, compact: bool = False) -> None:
+    """
+    Send each prediction back via the message broker its request was received from. Requests may override the
+    threshold, top_k and compact options with keys of the same name, invalid values falling back to the defaults
+    :param requests: Client requests, paired with the broker they were consumed from
+    :param probs: Class probabilities, one row per request
+    :param class_names: Class names ordered by model output index
+    :param threshold: Default minimum probability of a returned class
+    :param top_k: Default maximum number of classes returned, 0 = no limit
+    :param compact: Default for returning class indices and float16 scores instead of a class name dict
+    :return:
+    """
+    with POSTPROCESS_SECONDS.time():
+        options = [request_options(message, threshold, top_k, compact) for message, _ in requests]
+        thresholds, top_ks, compacts = zip(*options)
+        results = postprocess(probs, class_names, threshold=thresholds, top_k=top_ks, compact=compacts)
+
+    # Replies are sent without blocking, so each broker's producer batches them and reports delivery by callback
+    replies = {}
+    for (message, broker), result in zip(requests, results):
+        replies.setdefault(broker, []).append({'id': message['id'], 'predictions': result})
+
+    for broker, messages in replies.items():
+        broker.send_messages(RETURN_TOPIC, messages)
+
+
+def setup_broker(broker: adapter.MessageBroker) -> None:
     """
-    Machine learning server. Receives prediction requests from client and returns results via message broker
+    Create topics and model subscriber required to serve predictions
+    :param broker: MessageBroker concrete class
+    :return: None
     """
-    class_names = np.array(['T-shirt/top', 'Trouser', 'Pullover', 'Dress', 'Coat',
-                            'Sandal', 'Shirt', 'Sneaker', 'Bag', 'Ankle boot'])
+    # Setting up client request topic and model subscriber
+    broker.create_topic(REQUEST_TOPIC)
+    broker.create_subscriber(MODEL_SUB, REQUEST_TOPIC)
+
+    # Setting up model prediction topic and client subscriber
+    broker.create_topic(RETURN_TOPIC)
+    # broker.create_subscriber(CLIENT_SUB, RETURN_TOPIC)
+
+
+async def serve(brokers: List[adapter.MessageBroker], predict: Callable[[List], Optional[Future]],
+                max_batch_size: int = MAX_BATCH_SIZE, max_wait_ms: float = MAX_WAIT_MS,
+                max_queue_size: int = MAX_QUEUE_SIZE, max_outstanding_messages: int = MAX_OUTSTANDING_MESSAGES,
+                max_outstanding_bytes: int = MAX_OUTSTANDING_BYTES) -> None:
+    """
+    Consume all brokers in parallel, feeding a single bounded queue drained by one inference worker. Consumers pull
+    batches of up to max_batch_size requests, and block while the queue is full, so no further messages are pulled
+    until the model catches up. Each pulled batch is acknowledged (Pub/Sub) or committed (Kafka) only once every
+    request in it has been answered, so that requests are redelivered if the server stops first. A batch that failed is
+    left unacknowledged, and consumption of its broker restarts. Each broker's requests are also outstanding from being
+    pulled until predict returns, and its consumer stops pulling once either outstanding limit is reached
+    :param brokers: MessageBroker concrete classes to consume requests from and return predictions to
+    :param predict: Blocking function handling each batch of (message, broker) requests, shared by all brokers.
+    Returns once the requests are answered, or returns a Future completed once they are (e.g. by a worker pool)
+    :param max_batch_size: Maximum number of requests passed through the model at once
+    :param max_wait_ms: Maximum time (milliseconds) a request waits for its batch to fill
+    :param max_queue_size: Maximum number of requests waiting to be batched
+    :param max_outstanding_messages: Maximum number of requests pulled from each broker and not yet predicted, 0 = no
+    limit
+    :param max_outstanding_bytes: Maximum size (bytes) of requests pulled from each broker and not yet predicted, 0 =
+    no limit
+    :return: None, blocks indefinitely
+    """
+    flow_controls = {broker: adapter.FlowControl(max_outstanding_messages, max_outstanding_bytes) for broker in brokers}
+
+    def settle(handled: List[Future], error: Optional[BaseException]) -> None:
+        # Lets each request's consumer resume, acknowledging its batch unless a request of it failed
+        for done in handled:
+            if error is None:
+                done.set_result(None)
+            else:
+                done.set_exception(error)
 
+    async def handle(batch: List[Tuple[Dict, adapter.MessageBroker, Future]]) -> None:
+        requests = [(message, broker) for message, broker, _ in batch]
+        handled = [done for _, _, done in batch]
+        BATCH_SIZE.observe(len(requests))
+        try:
+            answered = await asyncio.to_thread(predict, requests)
+            REQUESTS_TOTAL.inc(len(requests))
+        except Exception as e:
+            settle(handled, e)
+            raise
+        finally:
+            for broker, count in Counter(broker for _, broker in requests).items():
+                flow_controls[broker].release(count)
+
+        if isinstance(answered, Future):
+            answered.add_done_callback(lambda future: settle(handled, future.exception()))
+        else:
+            settle(handled, None)
+
+    batcher = AsyncDynamicBatcher(
+        handle,
+        max_batch_size=max_batch_size,
+        max_wait_ms=max_wait_ms,
+        max_queue_size=max_queue_size,
+        on_queue_wait=QUEUE_WAIT_SECONDS.observe,
+    )
+
+    def consume(broker: adapter.MessageBroker) -> None:
+        while True:
+            # Pulls return as soon as any requests are available, batches are filled to size by the batcher
+            batches = broker.consume_batches(MODEL_SUB, max_messages=max_batch_size, flow_control=flow_controls[broker])
+            for messages in batches:
+                handled = [Future() for _ in messages]
+                for message, done in zip(messages, handled):
+                    batcher.submit_threadsafe((message, broker, done))
+
+                # The pulled batch is acknowledged when the generator resumes, so only once every request is answered.
+                # Closing the generator instead leaves a failed batch unacknowledged, to be redelivered (Kafka rewinds
+                # the consumer to the start of the batch)
+                if any(done.exception() is not None for done in handled):
+                    print(f"Batch from {broker.name} failed, left unacknowledged and consumption restarted")
+                    batches.close()
+                    break
+
+    # Each blocking consumer runs in its own thread, tagging messages with the broker they came from
+    consumers = [asyncio.to_thread(consume, broker) for broker in brokers]
+
+    await asyncio.gather(batcher.run(), *consumers)
+
+
+def main():
+    """
+    Machine learning server. Receives prediction requests from client and returns results via message brokers
+    """
     parser = argparse.ArgumentParser(
         description="Using a saved tensorflow model to predict and return client requests"
     )
@@ -59,33 +223,241 @@ if __name__ == "__main__":
                         )
 
     parser.add_argument("--broker",
-                        default=BROKERS[0],
+                        default=BROKERS,
                         choices=BROKERS,
-                        help=f"Broker to send messages",
+                        nargs="+",
+                        help="Brokers to consume requests from, all are consumed in parallel by default",
+                        )
+
+    parser.add_argument("--codec",
+                        default="json",
+                        choices=list(CODECS),
+                        help="Codec used to encode messages without images, falls back to json if not installed",
+                        )
+
+    parser.add_argument("--compression",
+                        default=None,
+                        choices=list(COMPRESSORS),
+                        help="Compression applied to messages above the size threshold, none by default",
+                        )
+
+    parser.add_argument("--runtime",
+                        default="keras",
+                        choices=list(RUNTIMES),
+                        help="Runtime used for inference, tflite requires the model to be trained with --tflite",
+                        )
+
+    parser.add_argument("--jit",
+                        action="store_true",
+                        help="Compile inference with XLA (keras runtime), models trained with --mixed-precision are "
+                             "served in their training precision either way",
+                        )
+
+    parser.add_argument("--quantization",
+                        default="dynamic",
+                        choices=QUANTIZATION_MODES,
+                        help="Quantized TFLite export to serve with the tflite runtime",
+                        )
+
+    parser.add_argument("--tflite-threads",
+                        default=None,
+                        type=int,
+                        help="Number of threads used by the TFLite interpreter, defaults to interpreter choice",
+                        )
+
+    parser.add_argument("--max-batch-size",
+                        default=MAX_BATCH_SIZE,
+                        type=int,
+                        help="Maximum number of requests passed through the model at once",
+                        )
+
+    parser.add_argument("--max-wait-ms",
+                        default=MAX_WAIT_MS,
+                        type=float,
+                        help="Maximum time (milliseconds) a request waits for its batch to fill",
+                        )
+
+    parser.add_argument("--max-queue-size",
+                        default=MAX_QUEUE_SIZE,
+                        type=int,
+                        help="Maximum number of requests waiting to be batched before consumption blocks",
+                        )
+
+    parser.add_argument("--max-outstanding-messages",
+                        default=MAX_OUTSTANDING_MESSAGES,
+                        type=int,
+                        help="Maximum number of requests consumed from each broker but not yet predicted, "
+                             "consumption pauses once reached (0 = no limit)",
+                        )
+
+    parser.add_argument("--max-outstanding-bytes",
+                        default=MAX_OUTSTANDING_BYTES,
+                        type=int,
+                        help="Maximum size (bytes) of requests consumed from each broker but not yet predicted, "
+                             "consumption pauses once reached (0 = no limit)",
+                        )
+
+    parser.add_argument("--threshold",
+                        default=PREDICTION_THRESHOLD,
+                        type=float,
+                        help="Default minimum probability of a returned class, requests may set their own",
+                        )
+
+    parser.add_argument("--top-k",
+                        default=TOP_K,
+                        type=int,
+                        help="Default maximum number of classes returned, 0 = no limit. Requests may set their own",
+                        )
+
+    parser.add_argument("--compact",
+                        action="store_true",
+                        help="Return class indices and float16 scores by default, instead of class names",
+                        )
+
+    parser.add_argument("--workers",
+                        default=NUM_WORKERS,
+                        type=int,
+                        help="Number of worker processes each running a copy of the model, 0 = predict in process",
+                        )
+
+    parser.add_argument("--report-interval",
+                        default=REPORT_INTERVAL,
+                        type=float,
+                        help="Time (seconds) between per worker throughput reports",
+                        )
+
+    parser.add_argument("--cache-size",
+                        default=CACHE_MAX_BYTES,
+                        type=int,
+                        help="Maximum size (bytes) of in-process prediction cache, 0 = disabled. Not used with workers",
+                        )
+
+    parser.add_argument("--cache-ttl",
+                        default=CACHE_TTL,
+                        type=float,
+                        help="Time (seconds) a cached prediction remains valid",
+                        )
+
+    parser.add_argument("--cache-db",
+                        default=None,
+                        type=pathlib.Path,
+                        help="Path to sqlite file used to share cached predictions between predictors on one host",
+                        )
+
+    parser.add_argument("--reload-interval",
+                        default=RELOAD_INTERVAL,
+                        type=float,
+                        help="Time (seconds) between checks for newly registered models, 0 = never reload. "
+                             "Not used with workers",
+                        )
+
+    parser.add_argument("--metrics-port",
+                        default=METRICS_PORT,
+                        type=int,
+                        help="Local port serving broker and predictor metrics in the Prometheus text format, 0 = "
+                             "disabled",
+                        )
+
+    parser.add_argument("--metrics-file",
+                        default=None,
+                        help="File metrics are also written to every --metrics-interval seconds",
+                        )
+
+    parser.add_argument("--metrics-interval",
+                        default=METRICS_INTERVAL,
+                        type=float,
+                        help="Time (seconds) between writes of --metrics-file",
+                        )
+
+    parser.add_argument("--log-level",
+                        default=LOG_LEVEL,
+                        choices=list(LOG_LEVELS),
+                        help="Lowest level of messages printed, debug prints every reply sent",
                         )
 
     args = parser.parse_args()
+    set_log_level(args.log_level)
 
     model_path = pathlib.Path(MODEL_DIR, args.model)
     if not pathlib.Path.is_dir(model_path):
         raise NotADirectoryError(f"Model {args.model} not found in {MODEL_DIR}")
 
-    model = tf.keras.models.load_model(model_path)
+    serializer = Serializer(args.codec, args.compression)
+    # Only the client libraries of the chosen brokers are imported
+    brokers = [adapter.create_broker(name, PROJECT, serializer=serializer) for name in args.broker]
+    for broker in brokers:
+        setup_broker(broker)
 
-    if args.broker == "pubsub":
-        broker = adapter.PubsubBroker(PROJECT)
-    elif args.broker == "kafka":
-        broker = adapter.KafkaBroker(PROJECT)
+    postprocess_kwargs = {'threshold': args.threshold, 'top_k': args.top_k, 'compact': args.compact}
+    runtime_kwargs = {'runtime': args.runtime}
+    if args.runtime == "keras":
+        runtime_kwargs.update(jit_compile=args.jit)
+    elif args.runtime == "tflite":
+        runtime_kwargs.update(quantization=args.quantization, num_threads=args.tflite_threads)
+
+    # Class names of the model, also giving the width of its output
+    registry = ModelRegistry(REGISTRY_PATH)
+    entry = registry.get(args.model)
+    class_names = entry['class_names'] if entry else CLASS_NAMES
+
+    pool = None
+    cache = None
+    reloader = None
+    if args.workers:
+        pool = WorkerPool(model_path, args.workers, len(class_names), (IMG_HEIGHT, IMG_WIDTH),
+                          handler=partial(return_predictions, class_names=class_names, **postprocess_kwargs),
+                          max_batch_size=args.max_batch_size, report_interval=args.report_interval,
+                          runtime_kwargs=runtime_kwargs)
+        predict = partial(dispatch_prediction, pool=pool)
     else:
-        raise ValueError
+        def load_model(name: str, class_names: Sequence[str] = None) -> ServingRuntime:
+            # Warming up smallest and largest batches, tracing is done once for any batch size
+            return load_runtime(pathlib.Path(MODEL_DIR, name), warmup_batch_sizes=(1, args.max_batch_size),
+                                class_names=class_names, **runtime_kwargs)
 
-    # Setting up client request topic and model subscriber
-    broker.create_topic(REQUEST_TOPIC)
-    broker.create_subscriber(MODEL_SUB, REQUEST_TOPIC)
+        runtime = load_model(args.model, class_names)
 
-    # Setting up model prediction topic and client subscriber
-    broker.create_topic(RETURN_TOPIC)
-    # broker.create_subscriber(CLIENT_SUB, RETURN_TOPIC)
+        if args.cache_size:
+            backend = SqliteCacheBackend(args.cache_db) if args.cache_db is not None else None
+            cache = PredictionCache(args.cache_size, args.cache_ttl, runtime.model_id, backend=backend)
+
+        if args.reload_interval:
+            reloader = ModelReloader(registry, lambda e: load_model(e['name'], e['class_names']), runtime,
+                                     args.model, entry['dataset'] if entry else EXAMPLE_TF_DATASET,
+                                     args.reload_interval)
+
+            def predict(requests):
+                # Runtime is looked up once per batch, so a reload is swapped in between batches
+                get_prediction(requests, reloader.runtime, cache, **postprocess_kwargs)
+        else:
+            predict = partial(get_prediction, runtime=runtime, cache=cache, **postprocess_kwargs)
+
+    metrics_server = REGISTRY.serve(args.metrics_port) if args.metrics_port else None
+    metrics_dump = REGISTRY.dump_every(args.metrics_file, args.metrics_interval) if args.metrics_file else None
+
+    try:
+        if pool is not None:
+            pool.start()
+        if reloader is not None:
+            reloader.start()
+        asyncio.run(serve(brokers, predict, args.max_batch_size, args.max_wait_ms, args.max_queue_size,
+                          args.max_outstanding_messages, args.max_outstanding_bytes))
+    finally:
+        if pool is not None:
+            pool.stop()
+        if reloader is not None:
+            reloader.stop()
+        if cache is not None:
+            print(f"Prediction cache: {cache.stats()}")
+        for broker in brokers:
+            broker.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        if metrics_dump is not None:
+            metrics_dump.set()
+            REGISTRY.dump(args.metrics_file)
+
+
+if __name__ == "__main__":
 
-    # No timeout set, will block indefinitely
-    broker.consume(MODEL_SUB, callback=lambda message: get_prediction(message, broker))
+    main()
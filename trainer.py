@@ -1,33 +1,60 @@
 import os
+import sys
+import json
 import pathlib
+import shutil
+import tempfile
 import argparse
 import tensorflow as tf
-import tensorflow_datasets as tfds
 import numpy as np
-from ImageClassifier.settings import MODEL_DIR, DATASET_DIR, IMG_WIDTH, IMG_HEIGHT, BATCH_SIZE, EXAMPLE_TF_DATASET
+from ImageClassifier.settings import MODEL_DIR, DATASET_DIR, IMG_WIDTH, IMG_HEIGHT, BATCH_SIZE, EXAMPLE_TF_DATASET, \
+    REGISTRY_PATH, SHARD_DIR, SPLITS, TRAINING_REPORT, CHECKPOINT_DIR, EPOCHS, MONITOR, EARLY_STOPPING_PATIENCE
+from ImageClassifier import shards
+from ImageClassifier.training import ThroughputCallback, checkpoint_callbacks, precision_policy
+from ImageClassifier.distributed import TF_CONFIG, get_strategy, launch_local_workers, load_cluster, shard_options, \
+    tf_config, worker_info
+from ImageClassifier.registry import ModelRegistry
+from ImageClassifier.export import QUANTIZATION_MODES, export_all
 from datetime import datetime
+from typing import Optional
 
 
-def create_model(num_classes: int) -> tf.keras.Sequential:
+def create_model(num_classes: int, jit_compile: bool = False, policy: str = "float32") -> tf.keras.Sequential:
+    """
+    :param num_classes: Number of model outputs
+    :param jit_compile: Compile training and evaluation steps with XLA
+    :param policy: Keras dtype policy of every layer but the output, e.g. mixed_bfloat16 (see precision_policy)
+    """
 
     model = tf.keras.Sequential([
         # TODO: Remove rescaling from model, use in data preparation phase
-        tf.keras.layers.Rescaling(1./255),  # Normalising image to max of 1
+        tf.keras.layers.Rescaling(1./255, dtype=policy),  # Normalising image to max of 1
         tf.keras.layers.Conv2D(filters=32, kernel_size=3, strides=1, padding="SAME", activation="relu",
-                               input_shape=[IMG_HEIGHT, IMG_WIDTH, 1]),  # Convolution with zero padding
-        tf.keras.layers.MaxPooling2D(pool_size=2),  # Taking max value from 2x2 sub-matrices
-        tf.keras.layers.Flatten(),  # Re-stacks layers n to single m * n array
-        tf.keras.layers.Dense(128, activation='relu'),  # Fully connected layer
-        tf.keras.layers.Dropout(0.5),  # 50% dropout to avoid over fitting
-        tf.keras.layers.Dense(num_classes),  # Fully connected layer with number of nodes = number of classes
-        tf.keras.layers.Softmax()  # Normalise output to class probabilities
+                               input_shape=[IMG_HEIGHT, IMG_WIDTH, 1], dtype=policy),  # Convolution with zero padding
+        tf.keras.layers.MaxPooling2D(pool_size=2, dtype=policy),  # Taking max value from 2x2 sub-matrices
+        tf.keras.layers.Flatten(dtype=policy),  # Re-stacks layers n to single m * n array
+        tf.keras.layers.Dense(128, activation='relu', dtype=policy),  # Fully connected layer
+        tf.keras.layers.Dropout(0.5, dtype=policy),  # 50% dropout to avoid over fitting
+        # Fully connected layer with number of nodes = number of classes
+        tf.keras.layers.Dense(num_classes, dtype=policy),
+        # Normalise output to class probabilities, in float32 whatever the policy so that the served probabilities
+        # and the loss keep full precision
+        tf.keras.layers.Softmax(dtype="float32")
     ])
+    # Built before training, so that a resumed run's checkpoint can be restored into its weights
+    model.build([None, IMG_HEIGHT, IMG_WIDTH, 1])
+
+    optimizer = tf.keras.optimizers.Adam()
+    if policy == "mixed_float16":
+        # float16 gradients underflow without loss scaling, bfloat16 has the float32 exponent range and does not
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
 
     # Loss function measures accuracy during training
     # Accuracy = fraction of images correctly classified
-    model.compile(optimizer='adam',
+    model.compile(optimizer=optimizer,
                   loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
-                  metrics=['accuracy'])
+                  metrics=['accuracy'],
+                  jit_compile=jit_compile)
 
     return model
 
@@ -55,46 +82,98 @@ def get_image_label_from_path(file_path, class_names: np.array, channels: int =
     one_hot = parts[-2] == class_names
     # Integer encode the label
     label = tf.argmax(one_hot)
-    # Load the raw data from the file as a string
-    img = tf.io.read_file(file_path)
-    img = tf.io.decode_image(img, channels=channels, expand_animations=False)
-    img = tf.image.resize(img, [IMG_HEIGHT, IMG_WIDTH])
-    return img, label
-
-
-def configure_for_performance(ds: tf.data.Dataset) -> tf.data.Dataset:
-    ds = ds.cache()
+    return shards.load_image(file_path, channels), label
+
+
+def configure_for_performance(ds: tf.data.Dataset, cache: Optional[str] = "",
+                              batch_size: int = BATCH_SIZE) -> tf.data.Dataset:
+    """
+    :param ds: Unbatched dataset of (image, label)
+    :param cache: Cache filename, "" caches in memory, None for datasets already cached
+    :param batch_size: Global batch size, split between replicas when distributed
+    """
+    if cache is not None:
+        ds = ds.cache(cache)
     ds = ds.shuffle(buffer_size=1000)
-    ds = ds.batch(BATCH_SIZE)
+    ds = ds.batch(batch_size)
     ds = ds.prefetch(buffer_size=tf.data.AUTOTUNE)
     return ds
 
 
-def train(dataset_name: str, dataset_path=None, epochs: int = 10) -> None:
+def train(dataset_name: str, dataset_path=None, epochs: int = EPOCHS, tflite=(), jit_compile: bool = False,
+          mixed_precision: bool = False, strategy: tf.distribute.Strategy = None,
+          patience: int = EARLY_STOPPING_PATIENCE, resume: bool = False) -> None:
+    """
+    Train until epochs or early stopping, checkpointing every epoch to MODEL_DIR/CHECKPOINT_DIR/dataset_name. The model
+    saved is the best epoch's, by MONITOR
+    :param strategy: Distribution strategy (see ImageClassifier.distributed.get_strategy), single process by default.
+        With a multi-worker strategy every worker runs train on its shard of the data, and the chief saves, exports
+        and registers the model
+    :param patience: Epochs without improvement in MONITOR before stopping, 0 = never stop early
+    :param resume: Continue from the last completed epoch of the dataset's interrupted run, with its optimizer state
+    """
+    strategy = strategy or tf.distribute.get_strategy()
+    num_workers, worker_index, chief = worker_info(strategy)
 
     if dataset_name == EXAMPLE_TF_DATASET or dataset_path is None:
 
         print('Training fashion mnist example')
         train_ds, val_ds, test_ds, class_names = get_example()
+        train_ds, val_ds, test_ds = (ds.with_options(shard_options()) for ds in (train_ds, val_ds, test_ds))
+        cache = ""
     else:
         print(f"Getting data from {dataset_path}")
-        train_ds, val_ds, test_ds, class_names = preprocess(dataset_path)
+        train_ds, val_ds, test_ds, class_names = get_sharded(dataset_path, num_workers, worker_index)
+        cache = None
+
+    num_images = len(train_ds)
+    # Per replica batch stays BATCH_SIZE, so adding workers adds images per step
+    batch_size = BATCH_SIZE * strategy.num_replicas_in_sync
+    train_ds = configure_for_performance(train_ds, cache, batch_size)
+    val_ds = configure_for_performance(val_ds, cache, batch_size)
+    test_ds = configure_for_performance(test_ds, cache, batch_size)
+
+    policy = precision_policy(mixed_precision)
+    print(f"Training with {policy} precision{', XLA compiled' if jit_compile else ''}"
+          f"{f' on {num_workers} workers' if num_workers > 1 else ''}")
+    with strategy.scope():
+        model = create_model(len(class_names), jit_compile=jit_compile, policy=policy)
+    throughput = ThroughputCallback(num_images, verbose=chief)
+    checkpoint_dir = pathlib.Path(MODEL_DIR, CHECKPOINT_DIR, dataset_name)
+    # Set to the best epoch's weights on every worker once fit returns
+    callbacks, _ = checkpoint_callbacks(checkpoint_dir, patience, resume, chief)
+    model.fit(train_ds, validation_data=val_ds, epochs=epochs, callbacks=[throughput, *callbacks],
+              verbose="auto" if chief else 0)
+
+    # Evaluated over every worker's shard of the test data
+    test_loss, test_acc = model.evaluate(test_ds, verbose=2 if chief else 0)
 
-    train_ds = configure_for_performance(train_ds)
-    val_ds = configure_for_performance(val_ds)
-    test_ds = configure_for_performance(test_ds)
+    # Saving
+    timestamp = datetime.now()
+    model_name = '_'.join((dataset_name, timestamp.strftime("%Y%m%d-%H%M%S")))
+    if not chief:
+        # Every worker must save, as saving distributed variables runs collective operations, but only the chief's
+        # copy is kept
+        with tempfile.TemporaryDirectory() as tmp:
+            model.save(pathlib.Path(tmp, model_name))
+        return
 
-    model = create_model(len(class_names))
-    model.fit(train_ds, validation_data=val_ds, epochs=epochs)
-    test_loss, test_acc = model.evaluate(test_ds, verbose=2)
     print(f"\nTest accuracy: {round(test_acc * 100, 2)}%")
-
-    # TODO: Save class names
-    # Saving
     pathlib.Path.mkdir(pathlib.Path(MODEL_DIR), exist_ok=True)
-    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-    model_name = '_'.join((dataset_name, timestamp))
-    model.save(pathlib.Path(MODEL_DIR, model_name))
+    model_path = pathlib.Path(MODEL_DIR, model_name)
+    model.save(model_path)
+    with open(model_path.joinpath(TRAINING_REPORT), "w") as f:
+        json.dump({'jit_compile': jit_compile, 'precision': policy, 'workers': num_workers,
+                   'epochs': throughput.epochs}, f, indent=2)
+
+    if tflite:
+        # Calibrating from training data, test data is kept for the comparison against the Keras model
+        export_all(model, model_path, tflite, calibration_ds=train_ds, test_ds=test_ds)
+
+    # Registering once saved, so that predictors watching the registry only see complete models
+    ModelRegistry(REGISTRY_PATH).register(model_name, dataset_name, class_names, [IMG_HEIGHT, IMG_WIDTH, 1], timestamp)
+    # Run complete, nothing left to resume
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
 
 
 def preprocess(dataset_path: pathlib.Path):
@@ -112,7 +191,30 @@ def preprocess(dataset_path: pathlib.Path):
     return train_ds, val_ds, test_ds, class_names
 
 
+def get_sharded(dataset_path: pathlib.Path, num_workers: int = 1, worker_index: int = 0):
+    """
+    Ingest dataset into shards (skipped if unchanged since last ingested), then read the shards of each split
+    :param dataset_path: Dataset in the format dataset_name/class_names/class_images
+    :param num_workers: Number of workers each split is sharded over when distributed, by shard file if possible
+    :param worker_index: Task index of this worker, naming its on-disk caches when distributed
+    :return: Train, validation and test datasets, each cached in memory or on disk, and class names
+    """
+    shard_dir = SHARD_DIR.joinpath(dataset_path.name)
+    manifest = shards.ingest(dataset_path, shard_dir)
+
+    datasets = []
+    for split in SPLITS:
+        ds = shards.read_split(shard_dir, manifest, split, shuffle=split == "train")
+        ds = ds.with_options(shard_options(len(manifest['splits'][split]['files']), num_workers))
+        datasets.append(ds.cache(shards.cache_path(shard_dir, manifest, split,
+                                                   worker_index if num_workers > 1 else None)))
+
+    return (*datasets, np.array(manifest['class_names']))
+
+
 def get_example():
+    # Only needed for the example dataset, so that the model and pipeline can be used without it installed
+    import tensorflow_datasets as tfds
 
     (train_ds, val_ds, test_ds), metadata = tfds.load(
         EXAMPLE_TF_DATASET,
@@ -121,7 +223,8 @@ def get_example():
         as_supervised=True,
     )
 
-    class_names = np.array(sorted(metadata.features["label"].names))
+    # Labels index the names in their original order, so they must not be sorted
+    class_names = np.array(metadata.features["label"].names)
     return train_ds, val_ds, test_ds, class_names
 
 
@@ -137,9 +240,59 @@ def main():
                         )
 
     parser.add_argument("--epochs",
-                        default=50,
+                        default=EPOCHS,
+                        type=int,
+                        help="Maximum number of training cycles",
+                        )
+
+    parser.add_argument("--patience",
+                        default=EARLY_STOPPING_PATIENCE,
+                        type=int,
+                        help=f"Epochs without improvement in {MONITOR} before training stops early, 0 = never",
+                        )
+
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="Continue the dataset's interrupted run from its last completed epoch, restoring the "
+                             "model, optimizer and callback state",
+                        )
+
+    parser.add_argument("--jit",
+                        action="store_true",
+                        help="Compile training steps with XLA",
+                        )
+
+    parser.add_argument("--mixed-precision",
+                        action="store_true",
+                        help="Compute in bfloat16 (float16 on GPUs) with float32 variables, if the CPU has bfloat16 "
+                             "instructions",
+                        )
+
+    parser.add_argument("--cluster",
+                        default=None,
+                        help="JSON cluster spec of a multi-worker run, e.g. {\"worker\": [\"host1:12345\", "
+                             "\"host2:12345\"]}, run once per worker with its --task-index. Without it, a cluster "
+                             "described by the TF_CONFIG environment variable is used",
+                        )
+
+    parser.add_argument("--task-index",
+                        default=0,
                         type=int,
-                        help=f"Number of training cycles",
+                        help="Index of this worker in --cluster, worker 0 saves the model",
+                        )
+
+    parser.add_argument("--local-workers",
+                        default=0,
+                        type=int,
+                        help="Train with this many local worker processes standing in for hosts",
+                        )
+
+    parser.add_argument("--tflite",
+                        default=[],
+                        nargs="*",
+                        choices=QUANTIZATION_MODES,
+                        help="Quantized TFLite models to export alongside the saved model, reporting their accuracy "
+                             "and latency against the Keras model",
                         )
 
     # TODO: Allow image size to be set, potentially remove from settings or change to DEFAULT_IMG_SIZE
@@ -154,7 +307,24 @@ def main():
         if not pathlib.Path.is_dir(dataset_path):
             raise NotADirectoryError(f"Dataset {args.dataset} not found in {DATASET_DIR}")
 
-    train(args.dataset, dataset_path, epochs=args.epochs)
+    if args.local_workers:
+        if dataset_path is not None:
+            # Ingested once up front, rather than by every worker at once
+            shards.ingest(dataset_path)
+
+        worker_argv, argv = [], iter(sys.argv[1:])
+        for arg in argv:
+            if arg == "--local-workers":
+                next(argv, None)
+            elif not arg.startswith("--local-workers="):
+                worker_argv.append(arg)
+        sys.exit(launch_local_workers([sys.executable, __file__, *worker_argv], args.local_workers))
+
+    if args.cluster:
+        os.environ[TF_CONFIG] = tf_config(load_cluster(args.cluster), args.task_index)
+
+    train(args.dataset, dataset_path, epochs=args.epochs, tflite=args.tflite, jit_compile=args.jit,
+          mixed_precision=args.mixed_precision, strategy=get_strategy(), patience=args.patience, resume=args.resume)
 
 
 if __name__ == "__main__":